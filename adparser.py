@@ -0,0 +1,219 @@
+# Single-pass parser for BLE advertising data.
+#
+# AdIndex.parse() walks the AD structures of a payload once and records the
+# type, data offset and data length of every field in preallocated arrays,
+# plus a table of the first field of each AD type. Lookups go through the
+# index and return memoryviews into the payload, so nothing is copied and
+# the payload is never scanned again.
+# A zero length byte ends the payload (the rest is padding); a field running
+# past the end of the payload stops the walk and sets malformed, keeping the
+# fields before it.
+#
+# No MicroPython-only modules are used, so the same parser runs on the Pico
+# and in a host gateway:
+#
+#   index = AdIndex()
+#   index.parse(payload)
+#   data = index.service_data16(0xFCD2)
+
+import struct
+from array import array
+
+# AD types
+FLAGS = 0x01
+UUID16_MORE = 0x02
+UUID16_COMPLETE = 0x03
+UUID32_MORE = 0x04
+UUID32_COMPLETE = 0x05
+UUID128_MORE = 0x06
+UUID128_COMPLETE = 0x07
+NAME_SHORT = 0x08
+NAME_COMPLETE = 0x09
+TX_POWER = 0x0A
+SERVICE_DATA_UUID16 = 0x16
+APPEARANCE = 0x19
+SERVICE_DATA_UUID32 = 0x20
+SERVICE_DATA_UUID128 = 0x21
+MANUFACTURER_DATA = 0xFF
+
+# Bluetooth base UUID, 16 and 32-bit UUIDs are short forms of it
+_BASE_UUID = "%08x-0000-1000-8000-00805f9b34fb"
+
+
+# Desc: 128-bit UUID string of a 16 or 32-bit UUID
+def uuid_string(uuid):
+    return _BASE_UUID % uuid
+
+
+class AdIndex:
+    # Args: max_fields - Most fields indexed per payload
+    def __init__(self, max_fields=32):
+        self._max = max_fields
+        self._types = bytearray(max_fields)
+        self._offsets = array("H", bytes(2 * max_fields))
+        self._lengths = array("H", bytes(2 * max_fields))
+        # AD type -> index of its first field + 1, 0 if the type is not in the payload
+        self._first = bytearray(256)
+        self.count = 0
+        self.malformed = False
+        self.payload = None
+        self._view = None
+
+    # Desc: Indexes the fields of a payload
+    # Args: payload - bytes, bytearray or memoryview, kept (not copied) until the next parse
+    # Returns: Number of fields
+    def parse(self, payload):
+        data = payload
+        types = self._types
+        offsets = self._offsets
+        lengths = self._lengths
+        first = self._first
+        for i in range(self.count):
+            first[types[i]] = 0
+        n = len(data)
+        i = 0
+        count = 0
+        malformed = False
+        while i < n:
+            length = data[i]
+            if length == 0:
+                break
+            if i + 1 + length > n or count == self._max:
+                malformed = True
+                break
+            t = data[i + 1]
+            types[count] = t
+            offsets[count] = i + 2
+            lengths[count] = length - 1
+            count += 1
+            if not first[t]:
+                first[t] = count
+            i += 1 + length
+        self.payload = payload
+        self._view = None
+        self.count = count
+        self.malformed = malformed
+        return count
+
+    def type(self, i):
+        return self._types[i]
+
+    # Desc: memoryview of payload[start:end], the view of the payload is made on first use
+    def _slice(self, start, end):
+        if self._view is None:
+            self._view = memoryview(self.payload)
+        return self._view[start:end]
+
+    # Desc: Data of field i
+    def field(self, i):
+        offset = self._offsets[i]
+        return self._slice(offset, offset + self._lengths[i])
+
+    # Returns: Index of the first field of this type at or after start, -1 if there is none
+    def find(self, adv_type, start=0):
+        if start == 0:
+            return self._first[adv_type] - 1
+        types = self._types
+        for i in range(start, self.count):
+            if types[i] == adv_type:
+                return i
+        return -1
+
+    # Returns: Data of the first field of this type, None if there is none
+    def get(self, adv_type):
+        i = self.find(adv_type)
+        return None if i < 0 else self.field(i)
+
+    def flags(self):
+        i = self.find(FLAGS)
+        return self.payload[self._offsets[i]] if i >= 0 and self._lengths[i] else None
+
+    # Returns: Complete name, else shortened name, else None
+    def name(self):
+        i = self.find(NAME_COMPLETE)
+        if i < 0:
+            i = self.find(NAME_SHORT)
+        return None if i < 0 else str(self.field(i), "utf-8")
+
+    # Returns: TX power level in dBm or None
+    def tx_power(self):
+        i = self.find(TX_POWER)
+        if i < 0 or not self._lengths[i]:
+            return None
+        v = self.payload[self._offsets[i]]
+        return v - 256 if v > 127 else v
+
+    def appearance(self):
+        i = self.find(APPEARANCE)
+        if i < 0 or self._lengths[i] < 2:
+            return None
+        return struct.unpack_from("<H", self.payload, self._offsets[i])[0]
+
+    def _uuids(self, more, complete, size, fmt, out):
+        if not (self._first[more] or self._first[complete]):
+            return out
+        for i in range(self.count):
+            t = self._types[i]
+            if t == more or t == complete:
+                offset = self._offsets[i]
+                for k in range(self._lengths[i] // size):
+                    if fmt:
+                        out.append(struct.unpack_from(fmt, self.payload, offset + k * size)[0])
+                    else:
+                        out.append(bytes(self.payload[offset + k * size:offset + (k + 1) * size]))
+        return out
+
+    # Returns: List of the 16-bit service UUIDs as ints
+    def uuids16(self):
+        return self._uuids(UUID16_MORE, UUID16_COMPLETE, 2, "<H", [])
+
+    # Returns: List of the 32-bit service UUIDs as ints
+    def uuids32(self):
+        return self._uuids(UUID32_MORE, UUID32_COMPLETE, 4, "<I", [])
+
+    # Returns: List of the 128-bit service UUIDs as 16 bytes, little-endian as sent
+    def uuids128(self):
+        return self._uuids(UUID128_MORE, UUID128_COMPLETE, 16, None, [])
+
+    # Returns: Data (after the UUID) of the service data field for this 16-bit UUID, None if there is none
+    def service_data16(self, uuid):
+        lo = uuid & 0xFF
+        hi = uuid >> 8
+        data = self.payload
+        start = self._first[SERVICE_DATA_UUID16] - 1
+        if start < 0:
+            return None
+        for i in range(start, self.count):
+            if self._types[i] == SERVICE_DATA_UUID16 and self._lengths[i] >= 2:
+                offset = self._offsets[i]
+                if data[offset] == lo and data[offset + 1] == hi:
+                    return self._slice(offset + 2, offset + self._lengths[i])
+        return None
+
+    # Returns: List of (UUID, data) for every service data field; 16 and 32-bit UUIDs are ints,
+    #          128-bit UUIDs 16 bytes little-endian
+    def service_data(self):
+        out = []
+        for i in range(self.count):
+            t = self._types[i]
+            offset = self._offsets[i]
+            length = self._lengths[i]
+            if t == SERVICE_DATA_UUID16 and length >= 2:
+                out.append((struct.unpack_from("<H", self.payload, offset)[0], self._slice(offset + 2, offset + length)))
+            elif t == SERVICE_DATA_UUID32 and length >= 4:
+                out.append((struct.unpack_from("<I", self.payload, offset)[0], self._slice(offset + 4, offset + length)))
+            elif t == SERVICE_DATA_UUID128 and length >= 16:
+                out.append((bytes(self.payload[offset:offset + 16]), self._slice(offset + 16, offset + length)))
+        return out
+
+    # Returns: List of (company id, data) for every manufacturer specific data field
+    def manufacturer_data(self):
+        out = []
+        if not self._first[MANUFACTURER_DATA]:
+            return out
+        for i in range(self.count):
+            if self._types[i] == MANUFACTURER_DATA and self._lengths[i] >= 2:
+                offset = self._offsets[i]
+                out.append((struct.unpack_from("<H", self.payload, offset)[0],
+                            self._slice(offset + 2, offset + self._lengths[i])))
+        return out
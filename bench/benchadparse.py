@@ -0,0 +1,163 @@
+# Advertising data parser check and benchmark on the host.
+#
+# Checks AdIndex against hand-built payloads (every supported AD type and
+# malformed lengths), then measures advertisements parsed per second for a
+# scanning gateway's typical lookups (name, 16-bit services, BTHome service
+# data, manufacturer data) against the slice-per-lookup decoding that
+# ble_advertising used before.
+
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import adparser
+import bthome
+import snapshot
+
+
+def field(adv_type, data):
+    return bytes((len(data) + 1, adv_type)) + data
+
+
+def bthome_payload():
+    s = snapshot.Snapshot()
+    s.set_time(1000)
+    s.set_bmp280(2508, 101325)
+    s.set_dht22(4550)
+    s.set_heat(True)
+    return (field(adparser.FLAGS, b"\x06")
+            + field(adparser.SERVICE_DATA_UUID16, struct.pack("<H", bthome.UUID) + bthome.service_data(s.buffer, 7)))
+
+
+PAYLOADS = [
+    bthome_payload(),
+    field(adparser.FLAGS, b"\x06") + field(adparser.NAME_COMPLETE, b"PicoSensor")
+    + field(adparser.UUID16_COMPLETE, struct.pack("<HH", 0x181A, 0x180F)),
+    field(adparser.FLAGS, b"\x1a") + field(adparser.MANUFACTURER_DATA, struct.pack("<H", 0x004C) + bytes(23)),
+    field(adparser.NAME_SHORT, b"Pico") + field(adparser.TX_POWER, b"\xf4") + field(adparser.APPEARANCE, b"\x00\x03")
+    + field(adparser.UUID128_MORE, bytes(range(16))),
+    # truncated last field, and zero padding
+    field(adparser.FLAGS, b"\x06") + b"\x1e\xff\x4c\x00",
+    field(adparser.FLAGS, b"\x06") + bytes(10),
+]
+
+
+def check():
+    index = adparser.AdIndex()
+    payload = (field(adparser.FLAGS, b"\x06") + field(adparser.NAME_SHORT, b"Pi")
+               + field(adparser.NAME_COMPLETE, b"PicoSensor") + field(adparser.TX_POWER, b"\xf4")
+               + field(adparser.APPEARANCE, struct.pack("<H", 0x0300))
+               + field(adparser.UUID16_MORE, struct.pack("<H", 0x181A))
+               + field(adparser.UUID16_COMPLETE, struct.pack("<H", 0xFCD2))
+               + field(adparser.UUID32_COMPLETE, struct.pack("<I", 0x12345678))
+               + field(adparser.UUID128_COMPLETE, bytes(range(16)))
+               + field(adparser.SERVICE_DATA_UUID16, b"\xd2\xfc\x40\x00\x01")
+               + field(adparser.SERVICE_DATA_UUID32, struct.pack("<I", 0xAABBCCDD) + b"x")
+               + field(adparser.SERVICE_DATA_UUID128, bytes(range(16)) + b"y")
+               + field(adparser.MANUFACTURER_DATA, b"\x4c\x00\x02\x15"))
+    assert index.parse(payload) == 13 and not index.malformed
+    assert index.flags() == 6
+    assert index.name() == "PicoSensor"
+    assert index.tx_power() == -12
+    assert index.appearance() == 0x0300
+    assert index.uuids16() == [0x181A, 0xFCD2]
+    assert index.uuids32() == [0x12345678]
+    assert index.uuids128() == [bytes(range(16))]
+    assert bytes(index.service_data16(0xFCD2)) == b"\x40\x00\x01"
+    assert index.service_data16(0x181A) is None
+    assert [(u, bytes(d)) for u, d in index.service_data()] == [
+        (0xFCD2, b"\x40\x00\x01"), (0xAABBCCDD, b"x"), (bytes(range(16)), b"y")]
+    assert [(c, bytes(d)) for c, d in index.manufacturer_data()] == [(0x004C, b"\x02\x15")]
+
+    # a length running past the end keeps the fields before it
+    assert index.parse(PAYLOADS[4]) == 1 and index.malformed and index.flags() == 6
+    # zero length ends the payload
+    assert index.parse(PAYLOADS[5]) == 1 and not index.malformed
+    # every truncation of a valid payload parses without raising
+    for n in range(len(payload)):
+        index.parse(payload[:n])
+        index.name(), index.uuids16(), index.service_data(), index.manufacturer_data()
+    assert index.parse(b"") == 0 and index.parse(b"\x01") == 0 and index.malformed
+    # more fields than the index holds
+    small = adparser.AdIndex(2)
+    assert small.parse(payload) == 2 and small.malformed
+    index.parse(PAYLOADS[0])
+    assert bthome.decode(index.service_data16(bthome.UUID)) == {
+        "packet_id": 7, "temperature": 25.08, "humidity": 45.5, "pressure": 101325, "heat": True}
+    print("parser checks ok")
+
+
+# Decoding as ble_advertising did before AdIndex: one scan and one slice per lookup
+def legacy_field(payload, adv_type):
+    i = 0
+    result = []
+    while i + 1 < len(payload):
+        if payload[i + 1] == adv_type:
+            result.append(payload[i + 2:i + payload[i] + 1])
+        i += 1 + payload[i]
+    return result
+
+
+def legacy(payload):
+    name = legacy_field(payload, adparser.NAME_COMPLETE)
+    services = [struct.unpack_from("<H", u, k)[0] for u in legacy_field(payload, adparser.UUID16_COMPLETE)
+                for k in range(0, len(u) - 1, 2)]
+    data = [d[2:] for d in legacy_field(payload, adparser.SERVICE_DATA_UUID16) if d[:2] == b"\xd2\xfc"]
+    maker = [(struct.unpack("<H", d[:2])[0], d[2:]) for d in legacy_field(payload, adparser.MANUFACTURER_DATA)]
+    return name, services, data, maker
+
+
+def indexed(index, payload):
+    index.parse(payload)
+    return index.name(), index.uuids16(), index.service_data16(bthome.UUID), index.manufacturer_data()
+
+
+# A gateway only picking out BTHome service data
+def legacy_bthome(payload):
+    for d in legacy_field(payload, adparser.SERVICE_DATA_UUID16):
+        if d[:2] == b"\xd2\xfc":
+            return d[2:]
+    return None
+
+
+def indexed_bthome(index, payload):
+    index.parse(payload)
+    return index.service_data16(bthome.UUID)
+
+
+# Returns: Bytes held by the result of one call, as seen by tracemalloc
+def allocated(fn):
+    fn(PAYLOADS[0])
+    tracemalloc.start()
+    result = fn(PAYLOADS[0])
+    size = tracemalloc.get_traced_memory()[0]
+    del result
+    tracemalloc.stop()
+    return size
+
+
+def rate(fn, runs):
+    start = time.perf_counter()
+    for i in range(runs):
+        for payload in PAYLOADS:
+            fn(payload)
+    return runs * len(PAYLOADS) / (time.perf_counter() - start)
+
+
+def main():
+    check()
+    index = adparser.AdIndex()
+    runs = 20000
+    for label, old, new in (("all lookups", legacy, lambda payload: indexed(index, payload)),
+                            ("bthome only", legacy_bthome, lambda payload: indexed_bthome(index, payload))):
+        oldRate = rate(old, runs)
+        newRate = rate(new, runs)
+        print("%s: legacy %.0f ads/s (%d bytes held), indexed %.0f ads/s (%d bytes held), %.1fx" % (
+            label, oldRate, allocated(old), newRate, allocated(new), newRate / oldRate))
+    print("parse only: %.0f ads/s, %d bytes allocated" % (rate(index.parse, runs), allocated(index.parse)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Host-side equivalence check and benchmark for the BMP280 compensation paths.
+#
+# Checks the integer-only path (temperature_int / pressure_int) against the
+# float path on the datasheet test calibration and data
+# (load_test_calibration / load_test_data) and on a sweep of raw readings,
+# checks that read()/measure() read the data registers once, then reports the
+# per-sample cost of both paths.
+#
+# Temperature must match exactly. The 32-bit pressure formula is less precise
+# than the 64-bit one the float path uses (the datasheet example gives 100656
+# vs 100653.27 Pa), so pressure may differ by up to PRESSURE_TOLERANCE_PA.
+#
+# Under the MicroPython unix port the heap allocation per sample is measured
+# with gc.mem_alloc(); CPython boxes every int so it only reports timings.
+#
+# Usage: python bench/benchbmp280.py [samples]
+
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import sim
+sim.install()
+
+import machine
+from bmp280 import BMP280
+
+PRESSURE_TOLERANCE_PA = 8
+DATASHEET_T_CENTI = 2508
+DATASHEET_P_INT32 = 100656
+
+
+def make_sensor():
+    bmp = BMP280(machine.I2C(0), use_case=None)
+    bmp.load_test_calibration()
+    bmp.load_test_data()
+    return bmp
+
+
+def set_raw(bmp, t_raw, p_raw):
+    bmp.load_test_data()
+    bmp._t_raw = t_raw
+    bmp._p_raw = p_raw
+
+
+def check():
+    bmp = make_sensor()
+    assert bmp.temperature_int == DATASHEET_T_CENTI, bmp.temperature_int
+    assert bmp.pressure_int == DATASHEET_P_INT32, bmp.pressure_int
+
+    worst = 0
+    cases = 0
+    # roughly -40..85 C and 300..1100 hPa
+    for t_raw in range(420000, 620001, 4000):
+        for p_raw in range(240000, 600001, 4000):
+            set_raw(bmp, t_raw, p_raw)
+            t_float = bmp.temperature
+            p_float = bmp.pressure
+            t_int = bmp.temperature_int
+            p_int = bmp.pressure_int
+            assert t_int == int(round(t_float * 100)), (t_raw, t_int, t_float)
+            diff = abs(p_int - p_float)
+            assert diff <= PRESSURE_TOLERANCE_PA, (t_raw, p_raw, p_int, p_float)
+            worst = max(worst, diff)
+            cases += 1
+    print("equivalence: %d cases ok, worst pressure difference %.2f Pa" % (cases, worst))
+
+    # read()/measure() and their _int variants: one data read per call, both values from that sample
+    bmp = BMP280(machine.I2C(0), use_case=None)
+    bmp.freshness_ms = 0
+    reads = []
+    _read = bmp._read
+    bmp._read = lambda addr, size=1: reads.append(addr) or _read(addr, size)
+    for method in (bmp.read, bmp.measure, bmp.read_int, bmp.measure_int):
+        del reads[:]
+        method()
+        assert len(reads) == 1, (method.__name__, reads)
+    print("read/measure: 1 bus read per call")
+
+
+def bench_float(bmp, n):
+    for i in range(n):
+        bmp._t_fine = 0
+        bmp._t = 0
+        bmp._p = 0
+        bmp.temperature
+        bmp.pressure
+
+
+def bench_int(bmp, n):
+    for i in range(n):
+        bmp._t_fine = 0
+        bmp.temperature_int
+        bmp.pressure_int
+
+
+def measure(name, func, n):
+    bmp = make_sensor()
+    start = time.perf_counter()
+    func(bmp, n)
+    elapsed = time.perf_counter() - start
+    line = "%-6s %8.2f us/sample" % (name, elapsed * 1e6 / n)
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        func(bmp, n)
+        line += "  %6.1f bytes alloc/sample" % ((gc.mem_alloc() - before) / n)
+        gc.enable()
+    print(line)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    check()
+    measure("float", bench_float, n)
+    measure("int", bench_int, n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Flash log check and benchmark on the host, against a temporary directory.
+#
+# Writes a day of samples (7 metrics per minute) through FlashLog, reopens
+# the log from the directory, checks that "records since T" queries return
+# exactly the expected records, and reports how many flash writes the
+# batching saves and how a query compares with scanning the whole log.
+# Then reboots with the clock back at the RTC reset date and checks that
+# nothing is logged until the clock is set, and the history is kept.
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import flashlog
+
+METRICS = 7
+MINUTES = 24 * 60
+# Pico RTC after a reset (2021-01-01) and the earliest time accepted
+RESET_TS = 1609459200
+MIN_TS = 1704067200
+
+
+def fill(root, batch):
+    log = flashlog.FlashLog(root, batch_records=batch)
+    expected = []
+    for minute in range(MINUTES):
+        ts = MIN_TS + 60 * minute
+        for metric in range(METRICS):
+            value = (minute * 7 + metric * 1000) % 30000
+            log.append(metric, ts, value)
+            expected.append((metric, ts, value))
+    log.flush()
+    return log, expected
+
+
+def read_since(log, since, buf):
+    data = bytearray()
+    for n in log.chunks(since, buf):
+        data += buf[:n]
+    return flashlog.decode(data)
+
+
+def main():
+    buf = bytearray(4096)
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        log, expected = fill(root, 64)
+        elapsed = time.perf_counter() - start
+        kept = expected[-len(log):]
+        print("%d records, %d segments on disk, %d flash writes (%.1f records/write), %.0f records/s" % (
+            len(log), len(os.listdir(root)), log.writes, len(expected) / log.writes, len(expected) / elapsed))
+
+        reopened = flashlog.FlashLog(root)
+        assert len(reopened) == len(log)
+        for since in (0, kept[0][1], kept[len(kept) // 2][1] + 1, kept[-1][1], kept[-1][1] + 1):
+            want = [r for r in kept if r[1] >= since]
+            assert read_since(reopened, since, buf) == want, since
+            assert reopened.count_since(since) == len(want), since
+        print("since queries ok")
+
+        recent = kept[-1][1] - 3600
+        runs = 20
+        start = time.perf_counter()
+        for i in range(runs):
+            read_since(reopened, recent, buf)
+        indexed = (time.perf_counter() - start) / runs
+        start = time.perf_counter()
+        for i in range(runs):
+            [r for r in read_since(reopened, 0, buf) if r[1] >= recent]
+        scan = (time.perf_counter() - start) / runs
+        print("last hour: indexed %.2f ms, full scan %.2f ms" % (indexed * 1000, scan * 1000))
+
+    with tempfile.TemporaryDirectory() as root:
+        unbatched, expected = fill(root, 1)
+        print("unbatched: %d flash writes" % unbatched.writes)
+
+    with tempfile.TemporaryDirectory() as root:
+        log, expected = fill(root, 64)
+        kept = expected[-len(log):]
+        lastTs = kept[-1][1]
+        # reboot: the clock restarts at the reset date until a central sets it
+        rebooted = flashlog.FlashLog(root, min_ts=MIN_TS)
+        for minute in range(30):
+            assert not rebooted.append(0, RESET_TS + 60 * minute, 1)
+        rebooted.flush()
+        assert rebooted.dropped == 30 and len(rebooted) == len(kept)
+        setTs = lastTs + 7200
+        for minute in range(3):
+            assert rebooted.append(0, setTs + 60 * minute, 2)
+        # a clock going back is dropped too, not stored with a later timestamp
+        assert not rebooted.append(0, setTs, 3)
+        rebooted.flush()
+        want = kept + [(0, setTs + 60 * minute, 2) for minute in range(3)]
+        assert read_since(flashlog.FlashLog(root), 0, buf) == want
+        print("reboot with clock reset: %d records dropped, history kept" % rebooted.dropped)
+
+
+if __name__ == "__main__":
+    main()
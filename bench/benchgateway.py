@@ -0,0 +1,76 @@
+# Gateway load test on the host, with the fake backend.
+#
+# Runs gateway.Gateway against simulated sensors (sim/fakeble.py) with
+# connection failures and link drops, consumes the event stream and checks
+# it is in order, then reports the events per second, the delay from arrival
+# to consumption, how long it took to fill the session pool and what the
+# gateway dropped.
+#
+# Usage: python bench/benchgateway.py [sensors] [max sessions] [seconds]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gateway
+from sim.fakeble import FakeBackend
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+async def run(sensors, maxSessions, seconds):
+    backend = FakeBackend.with_sensors(sensors, adv_interval_s=0.5, notify_s=0.2, connect_s=0.05,
+                                       fail=0.05, drop=0.002)
+    gw = gateway.Gateway(backend, "pico", maxSessions, refresh_s=1, connect_timeout_s=2, backoff_s=0.5,
+                         max_connecting=8)
+    task = asyncio.ensure_future(gw.run())
+    delays = []
+    counts = {}
+    lastSeq = -1
+    full = None
+    start = time.monotonic()
+    events = gw.events()
+    while time.monotonic() - start < seconds:
+        try:
+            event = await asyncio.wait_for(events.__anext__(), 1)
+        except asyncio.TimeoutError:
+            continue
+        now = time.monotonic()
+        assert event.seq > lastSeq, "stream out of order"
+        lastSeq = event.seq
+        delays.append(now - event.time)
+        counts[event.uuid] = counts.get(event.uuid, 0) + 1
+        if full is None and gw.connects >= maxSessions:
+            full = now - start
+    elapsed = time.monotonic() - start
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert gw.sessions == 0
+
+    total = len(delays)
+    print("%d sensors, %d sessions max, %.0f s" % (sensors, maxSessions, elapsed))
+    print("events: %d (%.0f/s), %d notifications, %d broadcasts, %d dropped, stream in order" % (
+        total, total / elapsed, counts.get(gateway.SNAPSHOT_UUID, 0), counts.get(gateway.BTHOME_UUID, 0),
+        gw.dropped))
+    print("delay to consumer: p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        percentile(delays, 0.5) * 1000, percentile(delays, 0.99) * 1000, max(delays) * 1000))
+    print("%d sessions subscribed after %.2f s, %d connects, %d failed attempts, %d link drops" % (
+        maxSessions, full or 0, gw.connects, gw.failures, sum(s.drops for s in backend.sensors.values())))
+    connected = sum(1 for s in backend.sensors.values() if s.connects)
+    print("%d of %d sensors were connected at some point" % (connected, sensors))
+
+
+def main():
+    sensors = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    maxSessions = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    asyncio.run(run(sensors, maxSessions, seconds))
+
+
+if __name__ == "__main__":
+    main()
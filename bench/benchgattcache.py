@@ -0,0 +1,104 @@
+# GATT cache benchmark on the host, with the fake backend.
+#
+# Drops the link of a simulated sensor over and over and measures the time
+# from the dropout to the first reading of the new session, without the
+# cache (full discovery on every connection) and with gattcache.GattCache
+# (only the cached services, handles checked against the database hash).
+# Discovery costs discover_s per attribute, one ATT round trip at a 7.5 ms
+# connection interval. A firmware update that moves the handles checks that
+# a stale cache is detected and rebuilt. Last, a gateway starting with many
+# new sensors counts the cache file rewrites, on every miss and with
+# save_delay_s batching them.
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gateway
+from gattcache import GattCache
+from sim.fakeble import FakeBackend
+
+DROPS = 20
+CONNECT_S = 0.03
+DISCOVER_S = 0.0075
+
+
+async def dropouts(cache, drops=DROPS, update=None):
+    backend = FakeBackend.with_sensors(1, adv_interval_s=0.005, notify_s=60, connect_s=CONNECT_S,
+                                       discover_s=DISCOVER_S)
+    sensor = next(iter(backend.sensors.values()))
+    gw = gateway.Gateway(backend, max_sessions=1, refresh_s=60, cache=cache, backoff_s=0)
+    task = asyncio.ensure_future(gw.run())
+    events = gw.events()
+    times = []
+    discovered = []
+    dropped = None
+    while len(times) < drops:
+        event = await events.__anext__()
+        # broadcasts, and the notifications queued before the drop
+        if event.uuid == gateway.BTHOME_UUID or (dropped is not None and event.time < dropped):
+            continue
+        if dropped is not None:
+            times.append(time.monotonic() - dropped)
+            discovered.append(sensor.client.discovered)
+        if update is not None and len(times) == update:
+            # new firmware without the snapshot characteristic: handles move
+            sensor.snapshot_char = False
+            sensor.build_gatt()
+        dropped = time.monotonic()
+        sensor.client.drop_link()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return times, discovered
+
+
+async def startup(cache, sensors):
+    backend = FakeBackend.with_sensors(sensors, adv_interval_s=0.05, notify_s=60)
+    gw = gateway.Gateway(backend, max_sessions=sensors, max_connecting=sensors, refresh_s=60, cache=cache)
+    task = asyncio.ensure_future(gw.run())
+    start = time.perf_counter()
+    while cache.misses < sensors:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    cache.save()
+    assert len(GattCache(cache.path)) == sensors
+    return elapsed
+
+
+def report(label, times, discovered):
+    times = sorted(times)
+    print("%-9s time to first data: median %.0f ms, max %.0f ms, %d-%d attributes discovered" % (
+        label, times[len(times) // 2] * 1000, times[-1] * 1000, min(discovered), max(discovered)))
+
+
+async def run():
+    report("no cache", *await dropouts(None))
+    with tempfile.TemporaryDirectory() as root:
+        cache = GattCache(os.path.join(root, "gatt.json"))
+        report("cache", *await dropouts(cache))
+        print("cache: %d hits, %d misses" % (cache.hits, cache.misses))
+
+        cache = GattCache(os.path.join(root, "update.json"))
+        times, discovered = await dropouts(cache, 4, update=2)
+        assert cache.stale == 1
+        print("firmware update: stale entry found and rebuilt, %s ms to first data" % (
+            ", ".join("%.0f" % (t * 1000) for t in times)))
+
+        for delay in (0, 1):
+            cache = GattCache(os.path.join(root, "startup%d.json" % delay), save_delay_s=delay)
+            elapsed = await startup(cache, 500)
+            print("500 new sensors, save_delay_s=%d: %d file writes, all cached after %.2f s" % (
+                delay, cache.saves, elapsed))
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Notification decoding benchmark on the host.
+#
+# Builds the notifications of many sensors (the six Environmental Sensing
+# characteristics, or snapshots with some readings not valid), checks that
+# BatchDecoder gives the values of the per-message decoding, then times:
+#   - per message: struct.unpack and scaling of each notification, as in
+#     testBleRead's characteristicUpdate, or snapshot.decode,
+#   - batch: BatchDecoder.add for each notification and one decode(),
+# with NumPy if it is installed and with the array/struct fallback.
+#
+# Usage: python bench/benchnotifydecode.py [notifications]
+
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import notifydecode
+import snapshot
+
+CHARACTERISTICS = list(notifydecode.SCALES)[:6]
+
+
+def notifications(count, snapshots):
+    rng = random.Random(0)
+    result = []
+    s = snapshot.Snapshot()
+    for i in range(count):
+        address = "AA:BB:CC:00:%02X:%02X" % (i % 300 >> 8, i % 300 & 0xFF)
+        if snapshots:
+            s.buffer[4] = 0
+            s.set_time(1790000000 + i)
+            if rng.random() < 0.9:
+                s.set_bmp280(rng.randint(-4000, 8000), rng.randint(90000, 110000))
+            if rng.random() < 0.8:
+                s.set_dht22(rng.randint(0, 10000))
+            s.set_pms7003({field: rng.randint(0, 500) for field in snapshot.PMS_FIELDS})
+            result.append((address, notifydecode.SNAPSHOT_UUID, bytes(s.buffer), float(i)))
+        else:
+            uuid = CHARACTERISTICS[i % len(CHARACTERISTICS)]
+            result.append((address, uuid, struct.pack("<h", rng.randint(-32768, 32767)), float(i)))
+    return result
+
+
+def perMessage(batch):
+    result = []
+    for address, uuid, data, t in batch:
+        if uuid == notifydecode.SNAPSHOT_UUID:
+            result.append(snapshot.decode(data))
+        else:
+            result.append(notifydecode.decode_one(uuid, data))
+    return result
+
+
+def batched(batch):
+    decoder = notifydecode.BatchDecoder()
+    for address, uuid, data, t in batch:
+        decoder.add(address, uuid, data, t)
+    return decoder, decoder.decode()
+
+
+def check(batch):
+    decoder, columns = batched(batch)
+    expected = {}
+    for (address, uuid, data, t), value in zip(batch, perMessage(batch)):
+        device = decoder.devices.index(address)
+        if uuid == notifydecode.SNAPSHOT_UUID:
+            for metric in notifydecode._SNAPSHOT_FIELDS:
+                if metric in value:
+                    expected.setdefault(metric, []).append((t, device, value[metric]))
+        else:
+            expected.setdefault(value[0], []).append((t, device, value[1]))
+    assert sorted(columns) == sorted(expected), (sorted(columns), sorted(expected))
+    for metric, rows in expected.items():
+        c = columns[metric]
+        got = list(zip(c["time"], c["device"], c["value"]))
+        assert len(got) == len(rows), metric
+        for (t, device, value), (t2, device2, value2) in zip(rows, got):
+            assert t == t2 and device == device2 and abs(value - value2) < 1e-9, (metric, value, value2)
+    assert len(decoder) == 0 and decoder.rejected == 0
+
+
+def timed(function, batch, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    numpy = notifydecode.numpy
+    modes = [("numpy", numpy)] if numpy is not None else []
+    modes.append(("array", None))
+    for snapshots in (False, True):
+        batch = notifications(count, snapshots)
+        kind = "snapshots" if snapshots else "characteristics"
+        reference = timed(perMessage, batch)
+        print("%d %s, per message: %.0f ms (%.0f k/s)" % (count, kind, reference * 1000, count / reference / 1000))
+        for name, module in modes:
+            notifydecode.numpy = module
+            check(batch[:5000])
+            elapsed = timed(batched, batch)
+            decoder = notifydecode.BatchDecoder()
+            for address, uuid, data, t in batch:
+                decoder.add(address, uuid, data, t)
+            start = time.perf_counter()
+            decoder.decode()
+            decode = time.perf_counter() - start
+            print("  batch (%s): %.0f ms (%.0f k/s, %.1fx), decode() alone %.1f ms" % (
+                name, elapsed * 1000, count / elapsed / 1000, reference / elapsed, decode * 1000))
+        notifydecode.numpy = numpy
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# End-to-end benchmark of the sensor-to-BLE pipeline on the host simulator.
+#
+# Drives the unmodified BLETemperature through the sim stand-ins and an
+# in-process central and reports:
+#   latency     - p50/p99/max time from a central's GATT write (the refresh
+#                 request landing in BLETemperature._irq) to the notification
+#                 reaching the central, per characteristic
+#   throughput  - update_characteristic() calls and notifications per second
+#                 with 1..N connected centrals
+#   allocation  - heap use per publish cycle (gc.mem_alloc() on MicroPython,
+#                 tracemalloc peak on CPython)
+#   stall       - worst-case event loop stall seen by a 1 ms ticker task while
+#                 the latency run is going on
+#
+# Sensor timing is the modelled one (e.g. the BMP280 forced conversion and
+# the 5 ms DHT22 measurement), so latencies include it. Notification policy
+# and request rate limits are disabled so that every request is measured.
+#
+# Results are written as JSON so runs can be compared between commits:
+#   python bench/benchpipeline.py --output before.json
+#   python bench/benchpipeline.py --output after.json --compare before.json
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import sim
+sim.install()
+
+import bluetooth
+from sim.central import Central
+from sim.devices import world
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+CHARACTERISTICS = ("temperature", "humidity", "pressure", "PM1", "PM25", "PM10")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def make_sensor(connections=1):
+    """Fresh simulated world, firmware instance and connected centrals."""
+    world.reset()
+    bluetooth.BLE.reset()
+    Central.waiting = []
+    import main as firmware
+    sensor = firmware.BLETemperature(bluetooth.BLE())
+    # measure the pipeline, not the policies
+    for name in sensor.scheduler._tasks:
+        sensor.scheduler.set_rate(name, min_request_ms=0)
+    for name in CHARACTERISTICS + ("heat",):
+        sensor.publisher.set_policy(name, min_interval_ms=0, max_interval_ms=0, deadband=0)
+    # passive PMS7003 that is already warm
+    sensor.pms7003.dutyPeriod = 0
+    sensor.pms7003.startupTime = 0
+    centrals = []
+    for i in range(connections):
+        central = Central(addr=bytes((0, 0, 0, 0, 0, i)))
+        central.connect(sensor._ble)
+        centrals.append(central)
+    return firmware, sensor, centrals
+
+
+class StallMonitor:
+    """Ticks every 1 ms and records how late each tick is."""
+
+    def __init__(self):
+        self.worst_ms = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            late = (time.perf_counter() - start) * 1000 - 1
+            if late > self.worst_ms:
+                self.worst_ms = late
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+async def bench_latency(iterations):
+    firmware, sensor, (central,) = make_sensor()
+    handles = {name: sensor._handle[name] for name in CHARACTERISTICS}
+    arrived = {}
+
+    def on_notify(value_handle, data):
+        arrived.setdefault(value_handle, time.perf_counter())
+
+    central.on_notify = on_notify
+    sensor.scheduler.start()
+    monitor = StallMonitor()
+    monitor.start()
+    # let the start-up readings go out first
+    await asyncio.sleep(0.2)
+
+    results = {}
+    for name in CHARACTERISTICS:
+        samples = []
+        handle = handles[name]
+        for i in range(iterations):
+            # change the modelled reading so the notification is not suppressed
+            step = i % 2
+            world.bmp280.set_conditions(20 + step, 100000 + 500 * step)
+            world.dht22.humidity = 40 + 5 * step
+            world.pms7003.pm1 = world.pms7003.pm25 = world.pms7003.pm10 = 10 + step
+            arrived.clear()
+            start = time.perf_counter()
+            central.write(handle, b"\x00\x00")
+            deadline = start + 2
+            while handle not in arrived and time.perf_counter() < deadline:
+                await asyncio.sleep(0)
+            if handle in arrived:
+                samples.append((arrived[handle] - start) * 1000)
+        results[name] = {
+            "samples": len(samples),
+            "p50_ms": percentile(samples, 50),
+            "p99_ms": percentile(samples, 99),
+            "max_ms": max(samples) if samples else None,
+        }
+    monitor.stop()
+    sensor.scheduler.stop()
+    await asyncio.sleep(0)
+    return results, monitor.worst_ms
+
+
+def bench_throughput(connections, duration):
+    firmware, sensor, centrals = make_sensor(connections)
+    updates = 0
+    before = sensor.publisher.notifies
+    start = time.perf_counter()
+    end = start + duration
+    value = 0
+    while time.perf_counter() < end:
+        for i in range(100):
+            value = (value + 1) & 0x3FFF
+            sensor.update_characteristic("temperature", value)
+        updates += 100
+    elapsed = time.perf_counter() - start
+    return {
+        "connections": connections,
+        "updates_per_s": updates / elapsed,
+        "notifications_per_s": (sensor.publisher.notifies - before) / elapsed,
+    }
+
+
+def bench_allocation(cycles):
+    """Heap use of one publish cycle of every characteristic."""
+    firmware, sensor, centrals = make_sensor()
+    publisher = sensor.publisher
+
+    def cycle(i):
+        for name in CHARACTERISTICS:
+            publisher.stage(name, i & 0x3FFF)
+        publisher.flush()
+
+    cycle(1)
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for i in range(cycles):
+            cycle(i)
+        result = {"bytes_per_cycle": (gc.mem_alloc() - before) / cycles}
+        gc.enable()
+        return result
+    # the in-process central keeps every notification, don't count that
+    for central in centrals:
+        central._notified = lambda value_handle, data: None
+    tracemalloc.start()
+    peaks = []
+    for i in range(cycles):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        cycle(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return {"peak_bytes_per_cycle": sum(peaks) / len(peaks), "max_peak_bytes": max(peaks)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    print("\ncompared to %s:" % (previous.get("revision") or "previous run"))
+    for name, now in current["latency"].items():
+        old = previous.get("latency", {}).get(name)
+        if old and old.get("p99_ms") and now.get("p99_ms"):
+            print("  latency %-12s p99 %8.2f ms -> %8.2f ms (%+.0f%%)" % (
+                name, old["p99_ms"], now["p99_ms"], (now["p99_ms"] / old["p99_ms"] - 1) * 100))
+    old_tp = {r["connections"]: r for r in previous.get("throughput", [])}
+    for now in current["throughput"]:
+        old = old_tp.get(now["connections"])
+        if old:
+            print("  notifications/s with %d connections %10.0f -> %10.0f (%+.0f%%)" % (
+                now["connections"], old["notifications_per_s"], now["notifications_per_s"],
+                (now["notifications_per_s"] / old["notifications_per_s"] - 1) * 100))
+    if "stall_ms" in previous:
+        print("  worst loop stall %.2f ms -> %.2f ms" % (previous["stall_ms"], current["stall_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensor-to-BLE pipeline benchmark")
+    parser.add_argument("--iterations", type=int, default=50, help="requests per characteristic")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per throughput run")
+    parser.add_argument("--cycles", type=int, default=1000, help="publish cycles for the allocation run")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    latency, stall = asyncio.run(bench_latency(args.iterations))
+    results = {
+        "revision": git_revision(),
+        "python": "%s %s" % (platform.python_implementation(), platform.python_version()),
+        "timestamp": time.time(),
+        "latency": latency,
+        "stall_ms": stall,
+        "throughput": [bench_throughput(n, args.duration) for n in args.connections],
+        "allocation": bench_allocation(args.cycles),
+    }
+
+    print("request-to-notify latency:")
+    for name, r in latency.items():
+        print("  %-12s p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms  (%d samples)" % (
+            name, r["p50_ms"] or 0, r["p99_ms"] or 0, r["max_ms"] or 0, r["samples"]))
+    print("worst event loop stall: %.2f ms" % stall)
+    for r in results["throughput"]:
+        print("%d connection(s): %10.0f updates/s %10.0f notifications/s" % (
+            r["connections"], r["updates_per_s"], r["notifications_per_s"]))
+    print("allocation per publish cycle: %s" % results["allocation"])
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
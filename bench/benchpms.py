@@ -0,0 +1,192 @@
+# Host-side benchmark for the PMS7003 frame parser.
+#
+# Feeds a synthetic UART byte stream with injected noise (junk bytes between
+# frames, corrupted checksums, truncated frames) through the ring-buffer
+# FrameParser and through the original per-byte read(1) + dict parser, and
+# reports frames/second (best of three runs) and allocations per frame for both.
+#
+# Allocation is measured with gc.mem_alloc() (gc disabled) when run under the
+# MicroPython unix port, which is exactly what the Pico sees, in bytes per
+# frame. Under CPython it is the number of tracemalloc blocks allocated during
+# the run and still held at its end, per frame: CPython frees by refcount, so
+# transient objects (the legacy parser's dicts) do not show up there.
+#
+# Usage: python bench/benchpms.py [frames]
+
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import sim
+sim.install()
+
+import machine
+from pms7003 import FrameParser, PMSReading, FRAME_LENGTH
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # MicroPython, gc.mem_alloc() is used instead
+
+
+def make_frame(rng):
+    values = [rng.randrange(0, 1000) for i in range(12)]
+    body = struct.pack(">HHHHHHHHHHHHHH", 28, *values, 0x9700)
+    frame = b"\x42\x4d" + body
+    return frame + struct.pack(">H", sum(frame))
+
+
+# Desc: Builds a byte stream of 'frames' frames with noise injected
+# Returns: (stream, number of valid frames in it)
+def make_stream(frames, seed=7):
+    rng = random.Random(seed)
+    out = bytearray()
+    valid = 0
+    for i in range(frames):
+        frame = bytearray(make_frame(rng))
+        roll = rng.random()
+        if roll < 0.05:
+            # flipped payload byte -> checksum failure
+            frame[rng.randrange(4, 30)] ^= 0xFF
+        elif roll < 0.08:
+            # truncated frame
+            frame = frame[:rng.randrange(2, FRAME_LENGTH)]
+        else:
+            valid += 1
+        if rng.random() < 0.1:
+            # junk between frames, including false header bytes
+            out.extend(bytes([rng.choice((0x42, 0x4d, rng.randrange(256))) for j in range(rng.randrange(1, 8))]))
+        out.extend(frame)
+    return bytes(out), valid
+
+
+class StreamUART(machine.UART):
+    # Serves the stream in chunks the size the driver sees per poll at 9600 baud
+    def __init__(self, stream, chunk=48):
+        super().__init__(1)
+        self._stream = memoryview(stream)
+        self._pos = 0
+        self._chunk = chunk
+
+    def any(self):
+        return min(self._chunk, len(self._stream) - self._pos)
+
+    def read(self, nbytes=None):
+        n = self.any() if nbytes is None else min(nbytes, len(self._stream) - self._pos)
+        if n <= 0:
+            return None
+        data = bytes(self._stream[self._pos:self._pos + n])
+        self._pos += n
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        n = min(self.any(), len(buf) if nbytes is None else nbytes)
+        if n <= 0:
+            return None
+        buf[:n] = self._stream[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def done(self):
+        return self._pos >= len(self._stream)
+
+
+def setup_ring():
+    parser = FrameParser()
+    reading = PMSReading()
+
+    def run(uart):
+        parser.reset()
+        frames = 0
+        while not uart.done():
+            parser.fill(uart)
+            while parser.next():
+                reading.decode(parser.frame)
+                frames += 1
+        return frames
+    return run
+
+
+# The parser used before the ring buffer: read(1) per header byte and a dict per frame
+def setup_legacy():
+    return run_legacy
+
+
+def run_legacy(uart):
+    frames = 0
+    while not uart.done():
+        b = uart.read(1)
+        if b is None or ord(b) != 0x42:
+            continue
+        b = uart.read(1)
+        if b is None or ord(b) != 0x4d:
+            continue
+        data = uart.read(30)
+        if data is None or len(data) < 30:
+            continue
+        readings = {}
+        keys = ("pm1", "pm25", "pm10", "pm1env", "pm25env", "pm10env", "pbd3", "pbd5",
+                "pbd10", "pbd25", "pbd50", "pbd100", "reserved", "checksum")
+        for i, key in enumerate(keys):
+            readings[key] = data[2 * i + 2] << 8 | data[2 * i + 3]
+        checksum = 0x42 + 0x4d
+        for i in range(28):
+            checksum += data[i]
+        readings["error"] = 0 if checksum == readings["checksum"] else 1
+        if not readings["error"]:
+            frames += 1
+    return frames
+
+
+# Args: setup - Returns the function to benchmark; whatever it preallocates is not counted
+def measure(name, setup, stream, repeat=3):
+    func = setup()
+    elapsed = None
+    for i in range(repeat):
+        uart = StreamUART(stream)
+        start = time.perf_counter()
+        frames = func(uart)
+        t = time.perf_counter() - start
+        elapsed = t if elapsed is None else min(elapsed, t)
+
+    uart = StreamUART(stream)
+    gc = __import__("gc")
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        func(uart)
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        unit = "bytes alloc/frame"
+    else:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        func(uart)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                        if stat.count_diff > 0 and not stat.traceback[0].filename.endswith("tracemalloc.py"))
+        unit = "allocs/frame"
+    allocated = allocated / frames if frames else 0
+
+    print("%-8s %6d frames  %10.0f frames/s  %8.3f %s" % (
+        name, frames, frames / elapsed if elapsed else 0, allocated, unit))
+    return frames
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    stream, valid = make_stream(count)
+    print("stream: %d bytes, %d frames, %d valid" % (len(stream), count, valid))
+    ring = measure("ring", setup_ring, stream)
+    measure("legacy", setup_legacy, stream)
+    if ring != valid:
+        print("ring parser recovered %d of %d valid frames" % (ring, valid))
+
+
+if __name__ == "__main__":
+    main()
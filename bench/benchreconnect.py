@@ -0,0 +1,110 @@
+# Reconnect state machine check on the host, with the fake backend.
+#
+# Runs the gateway against healthy sensors next to flaky ones (connections
+# that mostly fail, links that drop often, one sensor that never accepts a
+# connection and one that stays connected but goes silent), then reports
+# the per-device metrics and checks that:
+#   - the healthy sensors stay subscribed almost all the time,
+#   - no sensor is tried more often than its backoff allows,
+#   - the silent sensor goes through degraded and is given up,
+#   - lost links are resubscribed.
+#
+# Usage: python bench/benchreconnect.py [seconds]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gateway
+from sim.fakeble import FakeBackend, FakeSensor
+
+BACKOFF_S = 0.2
+BACKOFF_MAX_S = 3
+REFRESH_S = 0.2
+
+
+def sensors():
+    kinds = {}
+    result = []
+    for i in range(24):
+        result.append(FakeSensor("AA:00:00:00:00:%02X" % i, "pico-ok-%d" % i, notify_s=0.1, seed=i))
+        kinds[result[-1].address] = "healthy"
+    for i in range(4):
+        result.append(FakeSensor("BB:00:00:00:00:%02X" % i, "pico-flaky-%d" % i, notify_s=0.1, fail=0.6,
+                                 drop=0.05, seed=100 + i))
+        kinds[result[-1].address] = "flaky"
+    result.append(FakeSensor("CC:00:00:00:00:00", "pico-dead", fail=1.0))
+    kinds[result[-1].address] = "dead"
+    result.append(FakeSensor("DD:00:00:00:00:00", "pico-silent", mute=True))
+    kinds[result[-1].address] = "silent"
+    return result, kinds
+
+
+# Returns: Most attempts a sensor can make in seconds with the smallest backoffs (half the nominal delay)
+def max_attempts(seconds):
+    attempts = 1
+    failures = 1
+    t = 0.0
+    while True:
+        t += min(BACKOFF_MAX_S, BACKOFF_S * 2 ** (failures - 1)) / 2
+        if t > seconds:
+            return attempts
+        attempts += 1
+        failures += 1
+
+
+async def run(seconds):
+    fakes, kinds = sensors()
+    backend = FakeBackend(fakes, adv_interval_s=0.05)
+    gw = gateway.Gateway(backend, "pico", max_sessions=32, refresh_s=REFRESH_S, connect_timeout_s=1,
+                         backoff_s=BACKOFF_S, backoff_max_s=BACKOFF_MAX_S, stable_s=2, max_connecting=4)
+    task = asyncio.ensure_future(gw.run())
+
+    async def consume():
+        async for event in gw.events():
+            pass
+
+    consumer = asyncio.ensure_future(consume())
+    await asyncio.sleep(seconds)
+    now = time.monotonic()
+    stats = {address: device.stats(now) for address, device in gw.devices.items()}
+    task.cancel()
+    consumer.cancel()
+    await asyncio.gather(task, consumer, return_exceptions=True)
+
+    print("%.0f s, %d sensors, %d notifications" % (seconds, len(fakes), gw.notifications))
+    print("%-18s %-8s %-10s %8s %8s %8s %6s %9s %9s" % (
+        "address", "kind", "state", "attempts", "connects", "up %", "resub", "reconn ms", "max ms"))
+    for address in sorted(stats):
+        s = stats[address]
+        print("%-18s %-8s %-10s %8d %8d %8.1f %6d %9s %9s" % (
+            address, kinds[address], s["state"], s["attempts"], s["connects"], s["availability"] * 100,
+            s["resubscribes"], _ms(s["reconnect_mean_s"]), _ms(s["reconnect_max_s"])))
+
+    healthy = [stats[a] for a in stats if kinds[a] == "healthy"]
+    assert min(s["availability"] for s in healthy) > 0.9
+    limit = max_attempts(seconds)
+    assert all(s["attempts"] <= limit for s in stats.values()), limit
+    dead = stats["CC:00:00:00:00:00"]
+    assert dead["connects"] == 0 and dead["attempts"] <= limit
+    silent = stats["DD:00:00:00:00:00"]
+    assert silent["resubscribes"] >= 1 and silent["disconnects"] >= 1
+    flaky = [stats[a] for a in stats if kinds[a] == "flaky"]
+    assert sum(s["disconnects"] for s in flaky) and all(s["connects"] for s in flaky)
+    print("healthy sensors >90%% up, every sensor within %d attempts, silent sensor given up, links resubscribed"
+          % limit)
+
+
+def _ms(value):
+    return "-" if value is None else "%.0f" % (value * 1000)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    asyncio.run(run(seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Time-series store benchmark on the host, against a temporary directory.
+#
+# Ingests a month of per-minute readings from several sensors, checks a
+# range query and the hourly aggregates of one series against a plain
+# Python computation, then times hourly and 5-minute aggregates over the
+# whole month for every series, twice (store reopened). The flushes that
+# sealed each day already wrote its rollups for both windows, so the first
+# pass reads them too.
+#
+# Usage: python bench/benchtsstore.py [sensors] [days]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tsstore
+
+METRICS = ("temperature", "humidity", "pressure", "pm1", "pm25", "pm10")
+START = 1790000000 - 1790000000 % tsstore.DAY_S
+
+
+def ingest(root, sensors, days):
+    store = tsstore.TimeSeriesStore(root)
+    rng = random.Random(0)
+    addresses = ["AA:BB:CC:00:00:%02X" % i for i in range(sensors)]
+    value = 2000
+    reference = []
+    start = time.perf_counter()
+    for minute in range(days * 1440):
+        ts = START + minute * 60
+        for address in addresses:
+            for metric in METRICS:
+                value = (value + rng.randint(-50, 50)) % 30000
+                store.append(address, metric, ts, value)
+                if address == addresses[0] and metric == "temperature":
+                    reference.append((ts, value))
+    store.flush()
+    elapsed = time.perf_counter() - start
+    count = days * 1440 * sensors * len(METRICS)
+    print("ingest: %d readings in %.1f s, %.0f readings/s, %d flushes, %d file writes (fsync each)" % (
+        count, elapsed, count / elapsed, store.flushes, store.writes))
+    return addresses, reference
+
+
+def check(root, address, reference):
+    store = tsstore.TimeSeriesStore(root)
+    lo, hi = reference[1000][0], reference[5000][0]
+    ts, values = store.query(address, "temperature", lo, hi)
+    assert list(zip(ts, values)) == [r for r in reference if lo <= r[0] < hi]
+    hourly = store.aggregate(address, "temperature", START, reference[-1][0] + 1, 3600)
+    windows = {}
+    for t, v in reference:
+        windows.setdefault(t - t % 3600, []).append(v)
+    assert list(hourly["time"]) == list(windows)
+    assert list(hourly["min"]) == [min(v) for v in windows.values()]
+    assert list(hourly["max"]) == [max(v) for v in windows.values()]
+    assert list(hourly["count"]) == [len(v) for v in windows.values()]
+    assert all(abs(m - sum(v) / len(v)) < 1e-9 for m, v in zip(hourly["mean"], windows.values()))
+    print("query and hourly aggregates match")
+
+
+# Desc: Crashes in the middle of a flush (one column written, then a torn write), reopens and
+#       checks that the readings stored afterwards keep their timestamps
+def check_crash(root):
+    address = "AA:BB:CC:00:01:00"
+    store = tsstore.TimeSeriesStore(root)
+    expected = []
+    for ts in range(START, START + 10):
+        store.append(address, "temperature", ts, ts - START)
+        expected.append((ts, ts - START))
+    store.flush()
+    path = store._path(address, "temperature")
+    day = START // tsstore.DAY_S
+    for torn in ((b"\x00" * 8, b""), (b"\x00" * 3, b"\x00")):
+        # timestamps of two readings written, not their values / a partial timestamp and value
+        with open("%s/%d.t" % (path, day), "ab") as f:
+            f.write(torn[0])
+        with open("%s/%d.v" % (path, day), "ab") as f:
+            f.write(torn[1])
+        store = tsstore.TimeSeriesStore(root)
+        ts = expected[-1][0] + 1
+        for i in range(3):
+            store.append(address, "temperature", ts + i, 100 + len(expected))
+            expected.append((ts + i, 100 + len(expected)))
+        store.flush()
+        ts, values = tsstore.TimeSeriesStore(root).query(address, "temperature", START, START + tsstore.DAY_S)
+        assert list(zip(ts, values)) == expected, list(zip(ts, values))
+    print("crash during a flush: recovered")
+
+
+def aggregate_all(root, addresses, end, window):
+    store = tsstore.TimeSeriesStore(root)
+    start = time.perf_counter()
+    windows = 0
+    for address in addresses:
+        for metric in METRICS:
+            windows += len(store.aggregate(address, metric, START, end, window)["time"])
+    return time.perf_counter() - start, windows
+
+
+def main():
+    sensors = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    print("numpy: %s" % ("yes" if tsstore.numpy is not None else "no, array/bisect fallback"))
+    with tempfile.TemporaryDirectory() as root:
+        addresses, reference = ingest(root, sensors, days)
+        check(root, addresses[0], reference)
+        check_crash(root)
+        end = START + days * tsstore.DAY_S
+        series = len(addresses) * len(METRICS)
+        for window in (3600, 300):
+            first, windows = aggregate_all(root, addresses, end, window)
+            again, windows = aggregate_all(root, addresses, end, window)
+            print("%d-day %ds aggregates of %d series (%d windows): %.0f ms first, %.0f ms again" % (
+                days, window, series, windows, first * 1000, again * 1000))
+        store = tsstore.TimeSeriesStore(root)
+        start = time.perf_counter()
+        ts, values = store.query(addresses[-1], "pm25", end - tsstore.DAY_S, end)
+        print("last day of raw readings of one series: %d readings in %.1f ms" % (
+            len(ts), (time.perf_counter() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,10 @@
 from micropython import const
 import struct
 import bluetooth
+from adparser import AdIndex, uuid_string
 
 # Data type describing bluetooth settings
-_ADV_TYPE_FLAGS = const(0x02)
+_ADV_TYPE_FLAGS = const(0x01)
 # Note: In data portion of the packet:
 # Bit 0 – Indicates LE Limited Discoverable Mode
 # Bit 1 – Indicates LE General Discoverable Mode
@@ -27,75 +28,233 @@ _ADV_TYPE_UUID128_MORE = const(0x6)
 
 _ADV_TYPE_APPEARANCE = const(0x19)
 
+# Service data for a 16-bit service UUID (UUID followed by the data)
+_ADV_TYPE_SERVICE_DATA_UUID16 = const(0x16)
 
-# Generate a payload to be passed to gap_advertise(adv_data=...).
-def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0):
-    payload = bytearray()
 
-    # Advertising payloads are repeated packets of the following form:
-    #   1 byte: data length (N + 1)
-    #   1 byte: data type (describes the info in the data portion of the packet)
-    #   N bytes: data that is being transmitted (must conform to data type)
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
+# Largest advertising data: legacy advertising PDU, and extended advertising
+# with chained PDUs (Bluetooth 5)
+ADV_MAX_LEGACY = const(31)
+ADV_MAX_EXTENDED = const(1650)
 
 
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
-    )
+# Advertising payloads are repeated fields of the following form:
+#   1 byte: data length (N + 1)
+#   1 byte: data type (describes the info in the data portion of the packet)
+#   N bytes: data that is being transmitted (must conform to data type)
+#
+# AdvertisingBuilder lays the fields out in one buffer once and remembers
+# where every field is, so a field can be changed in place later without
+# building a new payload:
+#
+#   adv = AdvertisingBuilder().flags().service_data(0xFCD2, size=21, key="data").build()
+#   ble.gap_advertise(500000, adv_data=adv.payload)
+#   adv.set("data", reading, offset=2)   # after the UUID
+#   ble.gap_advertise(500000, adv_data=adv.payload)
+#
+# A field added with a size can later hold up to that many bytes; the
+# fields after it move when its length changes. build() raises ValueError
+# if the payload could exceed max_length.
+class AdvertisingBuilder:
+    # Args: max_length - ADV_MAX_LEGACY or ADV_MAX_EXTENDED
+    def __init__(self, max_length=ADV_MAX_LEGACY):
+        self._max = max_length
+        self._keys = {}
+        self._types = []
+        self._values = []
+        self._sizes = []
+        self._offsets = None
+        self._lengths = None
+        self._buf = None
+        self._view = None
+        self._length = 0
+        self.payload = None
 
-    if name:
-        _append(_ADV_TYPE_NAME, name)
+    # Desc: Adds a field
+    # Args: adv_type - AD type, value - Initial data, size - Largest data the field can hold later
+    #       (default: fixed at len(value)), key - Name for set()
+    def add(self, adv_type, value=b"", size=None, key=None):
+        if self._buf is not None:
+            raise ValueError("payload already built")
+        if key is not None:
+            self._keys[key] = len(self._types)
+        self._types.append(adv_type)
+        self._values.append(bytes(value))
+        self._sizes.append(len(value) if size is None else max(size, len(value)))
+        return self
 
-    if services:
+    def flags(self, limited_disc=False, br_edr=False):
+        return self.add(_ADV_TYPE_FLAGS, bytes(((0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04),)))
+
+    def name(self, name, size=None, key="name"):
+        return self.add(_ADV_TYPE_NAME, name.encode() if isinstance(name, str) else name, size, key)
+
+    def services(self, services):
         for uuid in services:
             b = bytes(uuid)
             if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
+                self.add(_ADV_TYPE_UUID16_COMPLETE, b)
             elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
+                self.add(_ADV_TYPE_UUID32_COMPLETE, b)
             elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
+                self.add(_ADV_TYPE_UUID128_COMPLETE, b)
+        return self
 
     # See org.bluetooth.characteristic.gap.appearance.xml
+    def appearance(self, appearance):
+        return self.add(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
+
+    # Args: uuid - 16-bit service UUID, data - Initial data, size - Largest data later (without the UUID)
+    def service_data(self, uuid, data=b"", size=None, key=None):
+        return self.add(_ADV_TYPE_SERVICE_DATA_UUID16, struct.pack("<H", uuid) + data,
+                        None if size is None else size + 2, key)
+
+    # Desc: Lays out the payload buffer
+    # Returns: self
+    def build(self):
+        reserved = 0
+        for size in self._sizes:
+            reserved += 2 + size
+        if self._max is not None and reserved > self._max:
+            raise ValueError("advertising payload of up to %d bytes exceeds %d" % (reserved, self._max))
+        self._buf = bytearray(reserved)
+        self._view = memoryview(self._buf)
+        self._offsets = [0] * len(self._types)
+        self._lengths = [0] * len(self._types)
+        offset = 0
+        for i in range(len(self._types)):
+            value = self._values[i]
+            self._offsets[i] = offset
+            self._lengths[i] = len(value)
+            self._buf[offset] = len(value) + 1
+            self._buf[offset + 1] = self._types[i]
+            self._buf[offset + 2:offset + 2 + len(value)] = value
+            offset += 2 + len(value)
+        self._values = None
+        self._setLength(offset)
+        return self
+
+    def _setLength(self, length):
+        self._length = length
+        self.payload = self._view[:length]
+
+    # Desc: Changes the data length of a field, moving the fields after it
+    def _resize(self, i, length):
+        if length > self._sizes[i]:
+            raise ValueError("field %d holds at most %d bytes" % (i, self._sizes[i]))
+        delta = length - self._lengths[i]
+        if not delta:
+            return
+        buf = self._buf
+        start = self._offsets[i] + 2 + self._lengths[i]
+        end = self._length
+        if delta > 0:
+            for j in range(end - 1, start - 1, -1):
+                buf[j + delta] = buf[j]
+        else:
+            for j in range(start, end):
+                buf[j + delta] = buf[j]
+        for k in range(i + 1, len(self._offsets)):
+            self._offsets[k] += delta
+        self._lengths[i] = length
+        buf[self._offsets[i]] = length + 1
+        self._setLength(end + delta)
+
+    # Desc: Writes data into a field in place, the field's data then ends after it
+    # Args: key - Field name, value - Bytes-like data, length - Bytes of value to use (default: all),
+    #       offset - Position in the field's data (e.g. 2 to keep the UUID of service data)
+    def set(self, key, value, length=None, offset=0):
+        i = self._keys[key]
+        if length is None:
+            length = len(value)
+        self._resize(i, offset + length)
+        start = self._offsets[i] + 2 + offset
+        buf = self._buf
+        for j in range(length):
+            buf[start + j] = value[j]
+
+    # Desc: struct.pack_into() on a field's data, for fixed-size values
+    def pack_into(self, key, fmt, offset, *values):
+        i = self._keys[key]
+        struct.pack_into(fmt, self._buf, self._offsets[i] + 2 + offset, *values)
+
+
+# Generate a payload to be passed to gap_advertise(adv_data=...).
+# service_data - List of (16-bit service UUID, bytes) pairs
+# Raises ValueError if the payload is longer than max_length (None = no check).
+def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0, service_data=None,
+                        max_length=ADV_MAX_LEGACY):
+    builder = AdvertisingBuilder(max_length).flags(limited_disc, br_edr)
+    if name:
+        builder.name(name)
+    if services:
+        builder.services(services)
     if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
+        builder.appearance(appearance)
+    if service_data:
+        for uuid, data in service_data:
+            builder.service_data(uuid, data)
+    return builder.build()._buf
+
 
-    return payload
+# Index shared by the decode_* functions, each parses its payload into it and
+# returns copies, so decoding allocates no index per call
+_index = AdIndex()
 
 
+# Desc: Data of every field of a type
+# Returns: List of bytes
 def decode_field(payload, adv_type):
-    i = 0
+    index = _index
+    index.parse(payload)
     result = []
-    while i + 1 < len(payload):
-        if payload[i + 1] == adv_type:
-            result.append(payload[i + 2 : i + payload[i] + 1])
-        i += 1 + payload[i]
+    i = index.find(adv_type)
+    while i >= 0:
+        result.append(bytes(index.field(i)))
+        i = index.find(adv_type, i + 1)
     return result
 
 
 def decode_name(payload):
-    n = decode_field(payload, _ADV_TYPE_NAME)
-    return str(n[0], "utf-8") if n else ""
+    index = _index
+    index.parse(payload)
+    return index.name() or ""
 
 
 def decode_services(payload):
+    index = _index
+    index.parse(payload)
     services = []
-    for u in decode_field(payload, _ADV_TYPE_UUID16_COMPLETE):
-        services.append(bluetooth.UUID(struct.unpack("<h", u)[0]))
-    for u in decode_field(payload, _ADV_TYPE_UUID32_COMPLETE):
-        services.append(bluetooth.UUID(struct.unpack("<d", u)[0]))
-    for u in decode_field(payload, _ADV_TYPE_UUID128_COMPLETE):
+    for u in index.uuids16():
+        services.append(bluetooth.UUID(u))
+    # bluetooth.UUID takes 16-bit ints only, 32-bit UUIDs go through their 128-bit form
+    for u in index.uuids32():
+        services.append(bluetooth.UUID(uuid_string(u)))
+    for u in index.uuids128():
         services.append(bluetooth.UUID(u))
     return services
 
 
+# Returns: List of (16-bit service UUID, data) pairs
+def decode_service_data(payload):
+    index = _index
+    index.parse(payload)
+    result = []
+    i = index.find(_ADV_TYPE_SERVICE_DATA_UUID16)
+    while i >= 0:
+        data = index.field(i)
+        if len(data) >= 2:
+            result.append((data[0] | data[1] << 8, bytes(data[2:])))
+        i = index.find(_ADV_TYPE_SERVICE_DATA_UUID16, i + 1)
+    return result
+
+
 def demo():
+    # 38 bytes, too long for legacy advertising
     payload = advertising_payload(
         name="micropython",
         services=[bluetooth.UUID(0x181A), bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")],
+        max_length=ADV_MAX_EXTENDED,
     )
     print(payload)
     print(decode_name(payload))
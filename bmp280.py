@@ -1,3 +1,6 @@
+import time
+import uasyncio as asyncio
+import metrics
 from micropython import const
 from ustruct import unpack as unp
 
@@ -52,6 +55,7 @@ BMP280_OS_ULTRAHIGH = const(4)
 
 # Oversampling matrix
 # (PRESS_OS, TEMP_OS, sample time in ms)
+# Sample times are the datasheet maximum measurement times rounded up
 _BMP280_OS_MATRIX = [
     [BMP280_PRES_OS_1, BMP280_TEMP_OS_1, 7],
     [BMP280_PRES_OS_2, BMP280_TEMP_OS_1, 9],
@@ -77,6 +81,7 @@ _BMP280_CASE_MATRIX = [
     [BMP280_POWER_NORMAL, BMP280_OS_ULTRAHIGH, BMP280_IIR_FILTER_16, BMP280_STANDBY_0_5]
 ]
 
+_BMP280_REGISTER_CALIBRATION = const(0x88)  # T1..P9, 24 bytes
 _BMP280_REGISTER_ID = const(0xD0)
 _BMP280_REGISTER_RESET = const(0xE0)
 _BMP280_REGISTER_STATUS = const(0xF3)
@@ -85,28 +90,35 @@ _BMP280_REGISTER_CONFIG = const(0xF5)  # IIR filter config
 
 _BMP280_REGISTER_DATA = const(0xF7)
 
+# Register field masks and shifts
+_BMP280_MASK_1 = const(0x01)
+_BMP280_MASK_2 = const(0x03)
+_BMP280_MASK_3 = const(0x07)
+_BMP280_SHIFT_OSRS_T = const(5)  # control
+_BMP280_SHIFT_OSRS_P = const(2)  # control
+_BMP280_SHIFT_MODE = const(0)  # control
+_BMP280_SHIFT_T_SB = const(5)  # config
+_BMP280_SHIFT_FILTER = const(2)  # config
+_BMP280_SHIFT_SPI3W = const(0)  # config
+_BMP280_SHIFT_MEASURING = const(3)  # status
+_BMP280_SHIFT_IM_UPDATE = const(0)  # status
+
+# status polls (1 ms apart) after the conversion time before reading anyway
+_BMP280_FORCED_POLLS = const(3)
+
 
 class BMP280:
-    def __init__(self, i2c_bus, addr=0x76, use_case=BMP280_CASE_HANDHELD_DYN):
+    def __init__(self, i2c_bus, addr=0x76, use_case=BMP280_CASE_HANDHELD_DYN, new_read_ms=200):
         self._bmp_i2c = i2c_bus
         self._i2c_addr = addr
 
-        # read calibration data
+        # read calibration data in one burst
         # < little-endian
         # H unsigned short
         # h signed short
-        self._T1 = unp('<H', self._read(0x88, 2))[0]
-        self._T2 = unp('<h', self._read(0x8A, 2))[0]
-        self._T3 = unp('<h', self._read(0x8C, 2))[0]
-        self._P1 = unp('<H', self._read(0x8E, 2))[0]
-        self._P2 = unp('<h', self._read(0x90, 2))[0]
-        self._P3 = unp('<h', self._read(0x92, 2))[0]
-        self._P4 = unp('<h', self._read(0x94, 2))[0]
-        self._P5 = unp('<h', self._read(0x96, 2))[0]
-        self._P6 = unp('<h', self._read(0x98, 2))[0]
-        self._P7 = unp('<h', self._read(0x9A, 2))[0]
-        self._P8 = unp('<h', self._read(0x9C, 2))[0]
-        self._P9 = unp('<h', self._read(0x9E, 2))[0]
+        (self._T1, self._T2, self._T3,
+         self._P1, self._P2, self._P3, self._P4, self._P5,
+         self._P6, self._P7, self._P8, self._P9) = unp('<HhhHhhhhhhhh', self._read(_BMP280_REGISTER_CALIBRATION, 24))
 
         # output raw
         self._t_raw = 0
@@ -117,24 +129,39 @@ class BMP280:
         self._p = 0
 
         self.read_wait_ms = 0  # interval between forced measure and readout
-        self._new_read_ms = 200  # interval between
+        self._new_read_ms = new_read_ms  # samples younger than this are reused instead of read again
         self._last_read_ts = 0
+        self._has_sample = False
+
+        # shadow copies of the control and config registers, only written by this driver
+        self._ctrl, self._config = self._read(_BMP280_REGISTER_CONTROL, 2)
 
         if use_case is not None:
             self.use_case(use_case)
 
     def _read(self, addr, size=1):
-        return self._bmp_i2c.readfrom_mem(self._i2c_addr, addr, size)
+        t0 = time.ticks_us()
+        d = self._bmp_i2c.readfrom_mem(self._i2c_addr, addr, size)
+        metrics.record(metrics.I2C, t0)
+        return d
 
     def _write(self, addr, b_arr):
         if not type(b_arr) is bytearray:
             b_arr = bytearray([b_arr])
-        return self._bmp_i2c.writeto_mem(self._i2c_addr, addr, b_arr)
-
-    def _gauge(self):
-        # TODO limit new reads
+        t0 = time.ticks_us()
+        r = self._bmp_i2c.writeto_mem(self._i2c_addr, addr, b_arr)
+        metrics.record(metrics.I2C, t0)
+        return r
+
+    def _gauge(self, force=False):
+        # reuse the last sample while it is within the freshness window
+        if not force and self._has_sample and \
+                time.ticks_diff(time.ticks_ms(), self._last_read_ts) < self._new_read_ms:
+            return
         # read all data at once (as by spec)
         d = self._read(_BMP280_REGISTER_DATA, 6)
+        self._last_read_ts = time.ticks_ms()
+        self._has_sample = True
 
         self._p_raw = (d[0] << 12) + (d[1] << 4) + (d[2] >> 4)
         self._t_raw = (d[3] << 12) + (d[4] << 4) + (d[5] >> 4)
@@ -143,8 +170,45 @@ class BMP280:
         self._t = 0
         self._p = 0
 
+    @property
+    def freshness_ms(self):
+        return self._new_read_ms
+
+    @freshness_ms.setter
+    def freshness_ms(self, v):
+        assert v >= 0
+        self._new_read_ms = v
+
+    # temperature (C) and pressure (Pa) from the same sample,
+    # reusing a sample younger than freshness_ms
+    def read(self):
+        self._gauge()
+        self._calc_t_fine(gauge=False)
+        return self._temperature(), self._pressure()
+
+    # temperature (C) and pressure (Pa) from a new 6-byte data read
+    def measure(self):
+        self._gauge(force=True)
+        self._calc_t_fine(gauge=False)
+        return self._temperature(), self._pressure()
+
+    # like read(), as ints: temperature in 0.01 C and pressure in Pa
+    def read_int(self):
+        self._gauge()
+        self._calc_t_fine(gauge=False)
+        return self._temperature_int(), self._pressure_int()
+
+    # like measure(), as ints: temperature in 0.01 C and pressure in Pa
+    def measure_int(self):
+        self._gauge(force=True)
+        self._calc_t_fine(gauge=False)
+        return self._temperature_int(), self._pressure_int()
+
     def reset(self):
         self._write(_BMP280_REGISTER_RESET, 0xB6)
+        # the chip is back to its power-on control and config (sleep, no oversampling)
+        self._ctrl = self._config = 0
+        self._has_sample = False
 
     def load_test_calibration(self):
         self._T1 = 27504
@@ -163,6 +227,11 @@ class BMP280:
     def load_test_data(self):
         self._t_raw = 519888
         self._p_raw = 415148
+        self._t_fine = 0
+        self._t = 0
+        self._p = 0
+        self._last_read_ts = time.ticks_ms()
+        self._has_sample = True
 
     def print_calibration(self):
         print("T1: {} {}".format(self._T1, type(self._T1)))
@@ -178,9 +247,12 @@ class BMP280:
         print("P8: {} {}".format(self._P8, type(self._P8)))
         print("P9: {} {}".format(self._P9, type(self._P9)))
 
-    def _calc_t_fine(self):
+    # gauge=False computes t_fine from the raw values of the last _gauge(),
+    # so that temperature and pressure come from one sample and one bus read
+    def _calc_t_fine(self, gauge=True):
         # From datasheet page 22
-        self._gauge()
+        if gauge:
+            self._gauge()
         if self._t_fine == 0:
             var1 = (((self._t_raw >> 3) - (self._T1 << 1)) * self._T2) >> 11
             var2 = (((((self._t_raw >> 4) - self._T1)
@@ -192,14 +264,21 @@ class BMP280:
     @property
     def temperature(self):
         self._calc_t_fine()
+        return self._temperature()
+
+    @property
+    def pressure(self):
+        self._calc_t_fine()
+        return self._pressure()
+
+    # the _temperature/_pressure helpers expect t_fine of the current sample
+    def _temperature(self):
         if self._t == 0:
             self._t = ((self._t_fine * 5 + 128) >> 8) / 100.
         return self._t
 
-    @property
-    def pressure(self):
+    def _pressure(self):
         # From datasheet page 22
-        self._calc_t_fine()
         if self._p == 0:
             var1 = self._t_fine - 128000
             var2 = var1 * var1 * self._P6
@@ -220,78 +299,143 @@ class BMP280:
             self._p = p / 256.0
         return self._p
 
-    def _write_bits(self, address, value, length, shift=0):
-        d = self._read(address)[0]
-        m = int('1' * length, 2) << shift
-        d &= ~m
-        d |= m & value << shift
-        self._write(address, d)
+    # Integer-only compensation. Uses the datasheet's 32-bit fixed point
+    # formulas (page 45) so that for sensor readings in the operating range
+    # every intermediate value stays a MicroPython small int and a read
+    # allocates neither floats nor bigints.
+
+    @property
+    def temperature_int(self):
+        # temperature in 0.01 C
+        self._calc_t_fine()
+        return self._temperature_int()
 
-    def _read_bits(self, address, length, shift=0):
-        d = self._read(address)[0]
-        return d >> shift & int('1' * length, 2)
+    @property
+    def pressure_int(self):
+        # pressure in Pa
+        self._calc_t_fine()
+        return self._pressure_int()
+
+    def _temperature_int(self):
+        return (self._t_fine * 5 + 128) >> 8
+
+    def _pressure_int(self):
+        var1 = (self._t_fine >> 1) - 64000
+        var2 = (((var1 >> 2) * (var1 >> 2)) >> 11) * self._P6
+        var2 = var2 + ((var1 * self._P5) << 1)
+        var2 = (var2 >> 2) + (self._P4 << 16)
+        var1 = (((self._P3 * (((var1 >> 2) * (var1 >> 2)) >> 13)) >> 3) + ((self._P2 * var1) >> 1)) >> 18
+        var1 = ((32768 + var1) * self._P1) >> 15
+
+        if var1 == 0:
+            return 0
+
+        # p = x * 3125 * 2 / var1 (x * 3125 / var1 * 2 for x * 3125 >= 2^31),
+        # split into quotient and remainder so x * 3125 is never formed
+        x = (1048576 - self._p_raw) - (var2 >> 12)
+        q = x // var1
+        r = x - q * var1
+        if x < 687195:
+            p = q * 6250 + (r * 6250) // var1
+        else:
+            p = (q * 3125 + (r * 3125) // var1) * 2
+        var1 = (self._P9 * (((p >> 3) * (p >> 3)) >> 13)) >> 12
+        var2 = ((p >> 2) * self._P8) >> 13
+        return p + ((var1 + var2 + self._P7) >> 4)
+
+    # write control and config if they differ from the shadow copies, in one
+    # transaction when both changed (register/data pairs, config first so a
+    # mode change in control already uses the new config)
+    def _commit(self, ctrl, config):
+        forced = ctrl & _BMP280_MASK_2 == BMP280_POWER_FORCED
+        if config != self._config and (ctrl != self._ctrl or forced):
+            self._write(_BMP280_REGISTER_CONFIG, bytearray((config, _BMP280_REGISTER_CONTROL, ctrl)))
+        elif config != self._config:
+            self._write(_BMP280_REGISTER_CONFIG, config)
+        elif ctrl != self._ctrl or forced:
+            self._write(_BMP280_REGISTER_CONTROL, ctrl)
+        self._config = config
+        if forced:
+            # the chip goes back to sleep by itself after a forced measurement
+            ctrl = ctrl & ~_BMP280_MASK_2 | BMP280_POWER_SLEEP
+        self._ctrl = ctrl
+
+    def _write_bits(self, address, value, mask, shift=0):
+        if address == _BMP280_REGISTER_CONTROL:
+            self._commit(self._ctrl & ~(mask << shift) | (value & mask) << shift, self._config)
+        else:
+            self._commit(self._ctrl, self._config & ~(mask << shift) | (value & mask) << shift)
+
+    def _read_bits(self, address, mask, shift=0):
+        if address == _BMP280_REGISTER_CONTROL:
+            d = self._ctrl
+        elif address == _BMP280_REGISTER_CONFIG:
+            d = self._config
+        else:
+            d = self._read(address)[0]
+        return d >> shift & mask
 
     @property
     def standby(self):
-        return self._read_bits(_BMP280_REGISTER_CONFIG, 3, 5)
+        return self._read_bits(_BMP280_REGISTER_CONFIG, _BMP280_MASK_3, _BMP280_SHIFT_T_SB)
 
     @standby.setter
     def standby(self, v):
         assert 0 <= v <= 7
-        self._write_bits(_BMP280_REGISTER_CONFIG, v, 3, 5)
+        self._write_bits(_BMP280_REGISTER_CONFIG, v, _BMP280_MASK_3, _BMP280_SHIFT_T_SB)
 
     @property
     def iir(self):
-        return self._read_bits(_BMP280_REGISTER_CONFIG, 3, 2)
+        return self._read_bits(_BMP280_REGISTER_CONFIG, _BMP280_MASK_3, _BMP280_SHIFT_FILTER)
 
     @iir.setter
     def iir(self, v):
         assert 0 <= v <= 4
-        self._write_bits(_BMP280_REGISTER_CONFIG, v, 3, 2)
+        self._write_bits(_BMP280_REGISTER_CONFIG, v, _BMP280_MASK_3, _BMP280_SHIFT_FILTER)
 
     @property
     def spi3w(self):
-        return self._read_bits(_BMP280_REGISTER_CONFIG, 1)
+        return self._read_bits(_BMP280_REGISTER_CONFIG, _BMP280_MASK_1, _BMP280_SHIFT_SPI3W)
 
     @spi3w.setter
     def spi3w(self, v):
         assert v in (0, 1)
-        self._write_bits(_BMP280_REGISTER_CONFIG, v, 1)
+        self._write_bits(_BMP280_REGISTER_CONFIG, v, _BMP280_MASK_1, _BMP280_SHIFT_SPI3W)
 
     @property
     def temp_os(self):
-        return self._read_bits(_BMP280_REGISTER_CONTROL, 3, 5)
+        return self._read_bits(_BMP280_REGISTER_CONTROL, _BMP280_MASK_3, _BMP280_SHIFT_OSRS_T)
 
     @temp_os.setter
     def temp_os(self, v):
         assert 0 <= v <= 5
-        self._write_bits(_BMP280_REGISTER_CONTROL, v, 3, 5)
+        self._write_bits(_BMP280_REGISTER_CONTROL, v, _BMP280_MASK_3, _BMP280_SHIFT_OSRS_T)
 
     @property
     def press_os(self):
-        return self._read_bits(_BMP280_REGISTER_CONTROL, 3, 2)
+        return self._read_bits(_BMP280_REGISTER_CONTROL, _BMP280_MASK_3, _BMP280_SHIFT_OSRS_P)
 
     @press_os.setter
     def press_os(self, v):
         assert 0 <= v <= 5
-        self._write_bits(_BMP280_REGISTER_CONTROL, v, 3, 2)
+        self._write_bits(_BMP280_REGISTER_CONTROL, v, _BMP280_MASK_3, _BMP280_SHIFT_OSRS_P)
 
     @property
     def power_mode(self):
-        return self._read_bits(_BMP280_REGISTER_CONTROL, 2)
+        return self._read_bits(_BMP280_REGISTER_CONTROL, _BMP280_MASK_2, _BMP280_SHIFT_MODE)
 
     @power_mode.setter
     def power_mode(self, v):
         assert 0 <= v <= 3
-        self._write_bits(_BMP280_REGISTER_CONTROL, v, 2)
+        self._write_bits(_BMP280_REGISTER_CONTROL, v, _BMP280_MASK_2, _BMP280_SHIFT_MODE)
 
     @property
     def is_measuring(self):
-        return bool(self._read_bits(_BMP280_REGISTER_STATUS, 1, 3))
+        return bool(self._read_bits(_BMP280_REGISTER_STATUS, _BMP280_MASK_1, _BMP280_SHIFT_MEASURING))
 
     @property
     def is_updating(self):
-        return bool(self._read_bits(_BMP280_REGISTER_STATUS, 1))
+        return bool(self._read_bits(_BMP280_REGISTER_STATUS, _BMP280_MASK_1, _BMP280_SHIFT_IM_UPDATE))
 
     @property
     def chip_id(self):
@@ -304,20 +448,61 @@ class BMP280:
     def force_measure(self):
         self.power_mode = BMP280_POWER_FORCED
 
+    # one-shot measurement in forced mode: trigger a conversion, wait the
+    # conversion time for the current oversampling without blocking, then
+    # return temperature (C) and pressure (Pa) from the new sample, or with
+    # integer=True the measure_int() values. Takes at most
+    # read_wait_ms + _BMP280_FORCED_POLLS ms and up to five bus transactions:
+    # the control write, _BMP280_FORCED_POLLS status polls and the data read.
+    async def forced_read(self, integer=False):
+        self.force_measure()
+        await asyncio.sleep_ms(self.read_wait_ms)
+        polls = _BMP280_FORCED_POLLS
+        while polls and self.is_measuring:
+            await asyncio.sleep_ms(1)
+            polls -= 1
+        if integer:
+            return self.measure_int()
+        return self.measure()
+
     def normal_measure(self):
         self.power_mode = BMP280_POWER_NORMAL
 
     def sleep(self):
         self.power_mode = BMP280_POWER_SLEEP
 
+    # apply several field changes with at most one bus transaction,
+    # fields left as None keep their current value
+    def configure(self, power_mode=None, temp_os=None, press_os=None, standby=None, iir=None, spi3w=None):
+        ctrl = self._ctrl
+        config = self._config
+        if temp_os is not None:
+            assert 0 <= temp_os <= 5
+            ctrl = ctrl & ~(_BMP280_MASK_3 << _BMP280_SHIFT_OSRS_T) | temp_os << _BMP280_SHIFT_OSRS_T
+        if press_os is not None:
+            assert 0 <= press_os <= 5
+            ctrl = ctrl & ~(_BMP280_MASK_3 << _BMP280_SHIFT_OSRS_P) | press_os << _BMP280_SHIFT_OSRS_P
+        if power_mode is not None:
+            assert 0 <= power_mode <= 3
+            ctrl = ctrl & ~_BMP280_MASK_2 | power_mode
+        if standby is not None:
+            assert 0 <= standby <= 7
+            config = config & ~(_BMP280_MASK_3 << _BMP280_SHIFT_T_SB) | standby << _BMP280_SHIFT_T_SB
+        if iir is not None:
+            assert 0 <= iir <= 4
+            config = config & ~(_BMP280_MASK_3 << _BMP280_SHIFT_FILTER) | iir << _BMP280_SHIFT_FILTER
+        if spi3w is not None:
+            assert spi3w in (0, 1)
+            config = config & ~_BMP280_MASK_1 | spi3w
+        self._commit(ctrl, config)
+
     def use_case(self, uc):
         assert 0 <= uc <= 5
         pm, oss, iir, sb = _BMP280_CASE_MATRIX[uc]
         p_os, t_os, self.read_wait_ms = _BMP280_OS_MATRIX[oss]
-        self._write(_BMP280_REGISTER_CONFIG, (iir << 2) + (sb << 5))
-        self._write(_BMP280_REGISTER_CONTROL, pm + (p_os << 2) + (t_os << 5))
+        self.configure(power_mode=pm, temp_os=t_os, press_os=p_os, standby=sb, iir=iir)
 
     def oversample(self, oss):
         assert 0 <= oss <= 4
         p_os, t_os, self.read_wait_ms = _BMP280_OS_MATRIX[oss]
-        self._write_bits(_BMP280_REGISTER_CONTROL, p_os + (t_os << 3), 2)
\ No newline at end of file
+        self.configure(temp_os=t_os, press_os=p_os)
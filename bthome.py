@@ -0,0 +1,101 @@
+# BTHome v2 service data for broadcasting readings in advertisements.
+#
+# The service data (AD type 0x16, UUID 0xFCD2) is a device information byte
+# followed by objects, each an object id and a little-endian value, sorted by
+# object id (https://bthome.io/format/). Any BTHome receiver (e.g. Home
+# Assistant) or testBleRead.py --scan can read the readings without
+# connecting. There is no BTHome object for PM1, it is only in the GATT
+# services.
+
+import struct
+import snapshot
+
+UUID = 0xFCD2
+# BTHome v2, not encrypted, sent at a regular interval
+_DEVICE_INFO = 0x40
+
+_OBJ_PACKET_ID = 0x00
+_OBJ_TEMPERATURE = 0x02     # sint16, 0.01 C
+_OBJ_HUMIDITY = 0x03        # uint16, 0.01 %
+_OBJ_PRESSURE = 0x04        # uint24, 0.01 hPa (Pa)
+_OBJ_PM25 = 0x0D            # uint16, ug/m3
+_OBJ_PM10 = 0x0E            # uint16, ug/m3
+_OBJ_POWER = 0x10           # uint8, on/off
+
+# object id -> (name, struct format or 3 for uint24, divisor)
+_OBJECTS = {
+    _OBJ_PACKET_ID: ("packet_id", "<B", 1),
+    _OBJ_TEMPERATURE: ("temperature", "<h", 100),
+    _OBJ_HUMIDITY: ("humidity", "<H", 100),
+    _OBJ_PRESSURE: ("pressure", 3, 1),
+    _OBJ_PM25: ("pm25", "<H", 1),
+    _OBJ_PM10: ("pm10", "<H", 1),
+    _OBJ_POWER: ("heat", "<B", 1),
+}
+
+# Largest service data produced by service_data(), without the AD header and UUID
+MAX_SIZE = 21
+
+
+# Desc: Encodes the valid readings of a snapshot as BTHome service data (without the UUID)
+# Args: out - Buffer with room for MAX_SIZE bytes, data - snapshot.Snapshot buffer,
+#       packetId - Counter so receivers can drop repeated advertisements
+# Returns: Number of bytes written
+def pack_into(out, data, packetId):
+    ts, flags, heat, temperature, humidity, pressure, pm1, pm25, pm10 = struct.unpack_from(snapshot.FORMAT, data, 0)[:9]
+    out[0] = _DEVICE_INFO
+    out[1] = _OBJ_PACKET_ID
+    out[2] = packetId & 0xFF
+    n = 3
+    if flags & snapshot.VALID_BMP280:
+        struct.pack_into("<Bh", out, n, _OBJ_TEMPERATURE, temperature)
+        n += 3
+    if flags & snapshot.VALID_DHT22:
+        struct.pack_into("<BH", out, n, _OBJ_HUMIDITY, humidity)
+        n += 3
+    if flags & snapshot.VALID_BMP280:
+        struct.pack_into("<BHB", out, n, _OBJ_PRESSURE, pressure & 0xFFFF, (pressure >> 16) & 0xFF)
+        n += 4
+    if flags & snapshot.VALID_PMS7003:
+        struct.pack_into("<BHBH", out, n, _OBJ_PM25, pm25, _OBJ_PM10, pm10)
+        n += 6
+    if flags & snapshot.VALID_HEAT:
+        struct.pack_into("<BB", out, n, _OBJ_POWER, heat)
+        n += 2
+    return n
+
+
+# Desc: Like pack_into(), returning a new bytes object
+def service_data(data, packetId):
+    out = bytearray(MAX_SIZE)
+    return bytes(out[:pack_into(out, data, packetId)])
+
+
+# Desc: Decodes BTHome service data (without the UUID), stops at the first unknown object
+# Returns: Dict of object name -> value (temperature in C, humidity in %, pressure in Pa)
+def decode(data):
+    readings = {}
+    if not data or data[0] & 0x01:
+        # empty or encrypted
+        return readings
+    i = 1
+    while i < len(data):
+        obj = _OBJECTS.get(data[i])
+        if obj is None:
+            break
+        name, fmt, divisor = obj
+        if fmt == 3:
+            if i + 4 > len(data):
+                break
+            value = data[i + 1] | data[i + 2] << 8 | data[i + 3] << 16
+            i += 4
+        else:
+            size = struct.calcsize(fmt)
+            if i + 1 + size > len(data):
+                break
+            value = struct.unpack_from(fmt, data, i + 1)[0]
+            i += 1 + size
+        readings[name] = value / divisor if divisor != 1 else value
+    if "heat" in readings:
+        readings["heat"] = bool(readings["heat"])
+    return readings
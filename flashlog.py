@@ -0,0 +1,213 @@
+# Append-only sample log on the flash filesystem (LittleFS on the Pico).
+#
+# Samples are fixed-size records: timestamp s (u32), value (i16), metric id
+# (u8), little-endian, 7 bytes. They are collected in a RAM batch and
+# appended to the current segment file with one write per batch, so the
+# flash is programmed in large pieces instead of a few bytes per sample.
+# Segments are files named <number>.log holding up to segment_records
+# records; when the current one is full the next is started, and once there
+# are more than max_segments the oldest file is deleted. Nothing is ever
+# rewritten in place, which leaves wear levelling to LittleFS.
+#
+# The index is the first timestamp and record count of every segment, kept
+# in RAM and rebuilt from the directory when the log is opened (one small
+# read per segment). A segment whose size is not a whole number of records
+# (power lost during a write) is not appended to again. Timestamps only go
+# forward in the log, so "records since T" is found with the index plus a
+# binary search in a single segment: append() drops (and counts) a record
+# older than the last one, and one older than min_ts. The Pico's RTC starts
+# again from its reset date on every boot, so min_ts is a date the real
+# clock is known to be past: until the clock has been set, nothing is
+# stored, rather than records with timestamps from the reset date.
+#
+# Only os.listdir/mkdir/stat/remove and open() are used, so the same code
+# runs on the host against a plain directory.
+
+import os
+import struct
+
+RECORD = "<IhB"
+RECORD_SIZE = 7
+
+
+class FlashLog:
+    # Args: root - Directory of the log, segment_records - Records per segment file,
+    #       max_segments - Segment files kept, batch_records - Records collected in RAM per write,
+    #       min_ts - Records with an earlier timestamp are dropped (clock not set)
+    def __init__(self, root, segment_records=512, max_segments=16, batch_records=64, min_ts=0):
+        self._root = root
+        self._minTs = min_ts
+        self._segmentRecords = segment_records
+        self._maxSegments = max_segments
+        self._batchRecords = batch_records
+        self._batch = bytearray(batch_records * RECORD_SIZE)
+        self._batched = 0
+        self._record = bytearray(RECORD_SIZE)
+        self._lastTs = 0
+        # start a new segment on the next flush
+        self._sealed = False
+
+        self.writes = 0
+        self.rotations = 0
+        self.dropped = 0
+
+        try:
+            os.mkdir(root)
+        except OSError:
+            pass
+        # index: [segment number, first timestamp, record count] per segment, oldest first
+        self._segments = []
+        numbers = []
+        for name in os.listdir(root):
+            if name.endswith(".log") and name[:-4].isdigit():
+                numbers.append(int(name[:-4]))
+        numbers.sort()
+        self._nextNumber = numbers[-1] + 1 if numbers else 0
+        for number in numbers:
+            size = os.stat(self._path(number))[6]
+            records = size // RECORD_SIZE
+            if records:
+                self._segments.append([number, self._readTs(number, 0), records])
+            else:
+                os.remove(self._path(number))
+            self._sealed = size % RECORD_SIZE != 0
+        if self._segments:
+            number, firstTs, records = self._segments[-1]
+            self._lastTs = self._readTs(number, records - 1)
+
+    def _path(self, number):
+        return "%s/%08d.log" % (self._root, number)
+
+    def _readTs(self, number, index):
+        with open(self._path(number), "rb") as f:
+            f.seek(index * RECORD_SIZE)
+            f.readinto(self._record)
+        return struct.unpack_from(RECORD, self._record, 0)[0]
+
+    # Desc: Number of records in the log, including the ones still in the RAM batch
+    def __len__(self):
+        count = self._batched
+        for segment in self._segments:
+            count += segment[2]
+        return count
+
+    # Desc: Adds a record, writing the batch to flash once it is full
+    # Returns: False if the record was dropped (older than min_ts or than the last record)
+    def append(self, metric, ts, value):
+        if ts < self._minTs or ts < self._lastTs:
+            self.dropped += 1
+            return False
+        struct.pack_into(RECORD, self._batch, self._batched * RECORD_SIZE, ts, value, metric)
+        self._batched += 1
+        self._lastTs = ts
+        if self._batched == self._batchRecords:
+            self.flush()
+        return True
+
+    # Desc: Writes the RAM batch to the current segment, starting new segments as needed
+    def flush(self):
+        batch = memoryview(self._batch)
+        pos = 0
+        while pos < self._batched:
+            if self._sealed or not self._segments or self._segments[-1][2] == self._segmentRecords:
+                self._rotate(struct.unpack_from(RECORD, self._batch, pos * RECORD_SIZE)[0])
+            segment = self._segments[-1]
+            n = min(self._batched - pos, self._segmentRecords - segment[2])
+            with open(self._path(segment[0]), "ab") as f:
+                f.write(batch[pos * RECORD_SIZE:(pos + n) * RECORD_SIZE])
+            self.writes += 1
+            segment[2] += n
+            pos += n
+        self._batched = 0
+
+    def _rotate(self, firstTs):
+        number = self._nextNumber
+        self._nextNumber += 1
+        self._sealed = False
+        self._segments.append([number, firstTs, 0])
+        while len(self._segments) > self._maxSegments:
+            oldest = self._segments.pop(0)
+            try:
+                os.remove(self._path(oldest[0]))
+            except OSError:
+                pass
+        self.rotations += 1
+
+    # Desc: Finds the first record at or after since
+    # Returns: (index in self._segments, record index in that segment),
+    #          (len(self._segments), 0) if it is in the RAM batch or there is none
+    def _locate(self, since):
+        segments = self._segments
+        k = len(segments)
+        while k > 0 and segments[k - 1][1] >= since:
+            k -= 1
+        if k == 0:
+            return 0, 0
+        # the first record >= since is in segment k - 1 or is the first one of segment k
+        number, firstTs, records = segments[k - 1]
+        lo, hi = 0, records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._readTs(number, mid) < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == records:
+            return k, 0
+        return k - 1, lo
+
+    def _batchStart(self, since):
+        i = 0
+        while i < self._batched and struct.unpack_from(RECORD, self._batch, i * RECORD_SIZE)[0] < since:
+            i += 1
+        return i
+
+    # Desc: Number of records at or after since
+    def count_since(self, since):
+        k, index = self._locate(since)
+        count = -index
+        for segment in self._segments[k:]:
+            count += segment[2]
+        return count + self._batched - self._batchStart(since)
+
+    # Desc: Reads the records at or after since into buf, one buffer at a time
+    # Returns: Generator of the number of bytes placed in buf for each step
+    def chunks(self, since, buf):
+        view = memoryview(buf)
+        capacity = (len(buf) // RECORD_SIZE) * RECORD_SIZE
+        k, index = self._locate(since)
+        segments = [segment[:] for segment in self._segments[k:]]
+        for number, firstTs, records in segments:
+            remaining = (records - index) * RECORD_SIZE
+            try:
+                f = open(self._path(number), "rb")
+            except OSError:
+                # rotated away since the transfer started
+                index = 0
+                continue
+            with f:
+                f.seek(index * RECORD_SIZE)
+                while remaining > 0:
+                    n = f.readinto(view[:min(capacity, remaining)])
+                    if not n:
+                        break
+                    remaining -= n
+                    yield n
+            index = 0
+        start = self._batchStart(since) * RECORD_SIZE
+        end = self._batched * RECORD_SIZE
+        while start < end:
+            n = min(capacity, end - start)
+            view[:n] = self._batch[start:start + n]
+            start += n
+            yield n
+
+
+# Desc: Decodes records as read by FlashLog.chunks()
+# Returns: List of (metric id, timestamp s, value)
+def decode(data, offset=0):
+    records = []
+    for pos in range(offset, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        ts, value, metric = struct.unpack_from(RECORD, data, pos)
+        records.append((metric, ts, value))
+    return records
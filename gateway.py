@@ -0,0 +1,560 @@
+# Gateway for many sensors at once, on the host.
+#
+# One long-lived scanner watches the advertisements. Every sensor whose name
+# or address matches is queued for a session. Up to max_sessions sessions
+# run at once, each connected to one sensor: it subscribes to the readings
+# (the snapshot characteristic, else the Environmental Sensing ones) and
+# asks for fresh ones right away and then every refresh_s.
+#
+# Each sensor has a state, driven by the session and the disconnect callback:
+#   scanning -> connecting -> subscribed <-> degraded
+#       ^            |             |            |
+#       +-- backoff <+-------------+------------+
+# A connection is degraded when refresh writes fail or no reading came for
+# stale_s; it is resubscribed once, and given up if that does not help. A
+# failed attempt or lost link waits a jittered, exponentially growing backoff
+# (reset once a connection lasted stable_s), then the sensor is connected
+# again on its next advertisement, resubscribing to everything. A flaky
+# sensor only delays itself: it holds no session while backing off and at
+# most max_connecting attempts run at once. Gateway.devices has the state,
+# uptime and reconnect latency of every sensor.
+#
+# The notifications of every session and the BTHome broadcasts of every
+# matching sensor go into one queue in the order they arrive, each with a
+# sequence number (Gateway.events()). When the consumer falls behind, the
+# oldest events are dropped and counted.
+#
+# The BLE stack is a backend with two factories following bleak's API:
+#   backend.scanner(detection_callback) -> object with async start() and stop()
+#   backend.client(address, disconnected_callback, services) -> object with async
+#     connect(), disconnect(), start_notify(char, callback), read_gatt_char(char),
+#     write_gatt_char(char, data) and services.get_characteristic(uuid or handle);
+#     services lists the service UUIDs to discover, None for all of them
+# Characteristics are used by handle. With a gattcache.GattCache the handles
+# of a known sensor come from the cache, so a reconnect only discovers the
+# services holding them and goes straight to start_notify.
+# BleakBackend uses bleak, sim.fakeble.FakeBackend simulates any number of
+# sensors for load tests without an adapter.
+#
+# readings() turns an event into (metric, value) pairs for tsstore.py; with
+# --store the readings are kept there instead of printed.
+#
+# Usage: python gateway.py [--match name] [--max-sessions N] [--cache file] [--store dir] [--stats s] [--fake N]
+
+import argparse
+import asyncio
+import random
+import struct
+import time
+from collections import deque
+
+import adparser
+import bthome
+import notifydecode
+import snapshot
+from gattcache import GattCache
+from tsstore import TimeSeriesStore
+
+# Vendor characteristic with every reading in one struct (see snapshot.py)
+SNAPSHOT_UUID = notifydecode.SNAPSHOT_UUID
+BTHOME_UUID = adparser.uuid_string(bthome.UUID)
+# Vendor history characteristic, request 0xFE followed by the Unix time (u32) sets the sensor clock
+HISTORY_UUID = "7a1c0011-3d4b-4c8e-9f21-5e6d7c8b9a01"
+_SET_TIME = 0xFE
+# Environmental Sensing characteristics, name -> UUID, all "<h"
+CHARACTERISTICS = {
+    "temperature": adparser.uuid_string(0x2A6E),
+    "humidity": adparser.uuid_string(0x2A6F),
+    "pressure": adparser.uuid_string(0x2A6D),
+    "PM1": adparser.uuid_string(0x2BD5),
+    "PM25": adparser.uuid_string(0x2BD6),
+    "PM10": adparser.uuid_string(0x2BD7),
+    "heat": adparser.uuid_string(0x2AE2),
+}
+# Writing to one of these makes the sensor read and notify again (one per sensor chip)
+_REFRESH = ("temperature", "humidity", "PM10")
+_REFRESH_DATA = b"\x00\x00"
+
+
+class Event:
+    __slots__ = ("seq", "time", "address", "uuid", "data")
+
+    # Args: seq - Position in the stream, time - time.monotonic() on arrival,
+    #       uuid - Characteristic UUID, or BTHOME_UUID for a broadcast, data - Raw bytes
+    def __init__(self, seq, time, address, uuid, data):
+        self.seq = seq
+        self.time = time
+        self.address = address
+        self.uuid = uuid
+        self.data = data
+
+    def __repr__(self):
+        return "Event(%d, %s, %s, %s)" % (self.seq, self.address, self.uuid, self.data.hex())
+
+
+class BleakBackend:
+    def __init__(self):
+        # only needed with a real adapter
+        import bleak
+        self._bleak = bleak
+
+    def scanner(self, detection_callback):
+        return self._bleak.BleakScanner(detection_callback=detection_callback)
+
+    def client(self, address, disconnected_callback, services=None):
+        if services is None:
+            return self._bleak.BleakClient(address, disconnected_callback=disconnected_callback)
+        return self._bleak.BleakClient(address, disconnected_callback=disconnected_callback, services=services)
+
+
+# Connection states of a sensor
+SCANNING = "scanning"       # waiting for an advertisement and a free session
+CONNECTING = "connecting"   # connecting, discovering and subscribing
+SUBSCRIBED = "subscribed"   # readings arrive
+DEGRADED = "degraded"       # connected, but refresh writes fail or no reading for stale_s
+BACKOFF = "backoff"         # waiting after a failed or lost connection
+
+
+class Device:
+    # Desc: Connection state and metrics of one sensor
+    def __init__(self, address, now):
+        self.address = address
+        self.state = SCANNING
+        self.queued = False
+        # failed or short sessions in a row, sets the backoff
+        self.failures = 0
+        self.retry_at = 0
+        self.first_seen = now
+        # start of the current outage (first seen before the first connection)
+        self.lost_at = now
+        self.subscribed_at = None
+        self.last_data = None
+        self.broadcast = None
+
+        self.attempts = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.resubscribes = 0
+        # time subscribed (degraded included), closed sessions only
+        self.uptime_s = 0.0
+        self.first_connect_s = None
+        # time from losing the link to being subscribed again
+        self.reconnect_count = 0
+        self.reconnect_total_s = 0.0
+        self.reconnect_max_s = 0.0
+        self.last_error = None
+
+    def uptime(self, now):
+        if self.subscribed_at is None:
+            return self.uptime_s
+        return self.uptime_s + now - self.subscribed_at
+
+    # Returns: Dict of the state and metrics
+    def stats(self, now):
+        seen = now - self.first_seen
+        return {
+            "state": self.state,
+            "attempts": self.attempts,
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "resubscribes": self.resubscribes,
+            "uptime_s": self.uptime(now),
+            "availability": self.uptime(now) / seen if seen > 0 else 0.0,
+            "first_connect_s": self.first_connect_s,
+            "reconnect_mean_s": self.reconnect_total_s / self.reconnect_count if self.reconnect_count else None,
+            "reconnect_max_s": self.reconnect_max_s if self.reconnect_count else None,
+            "last_error": self.last_error,
+        }
+
+
+class Gateway:
+    # Args: backend - BleakBackend or a fake, match - Case-insensitive substring of the name or address,
+    #       max_sessions - Most sensors connected at once, refresh_s - Time between refresh requests,
+    #       connect_timeout_s - Time allowed for connecting and subscribing, queue_size - Events kept,
+    #       cache - gattcache.GattCache or None to look the characteristics up on every connection,
+    #       backoff_s - First wait after a failure, doubled per failure in a row up to backoff_max_s,
+    #       stable_s - Time subscribed after which a lost link no longer counts as a failure,
+    #       stale_s - Time without a reading before a connection is degraded (default 3 refreshes),
+    #       max_connecting - Connection attempts at once, adapters handle few in parallel
+    def __init__(self, backend, match="pico", max_sessions=8, refresh_s=30, connect_timeout_s=20,
+                 queue_size=4096, cache=None, backoff_s=2, backoff_max_s=300, stable_s=60, stale_s=None,
+                 max_connecting=2):
+        self._backend = backend
+        self.cache = cache
+        self._match = match.lower()
+        self.max_sessions = max_sessions
+        self.refresh_s = refresh_s
+        self.connect_timeout_s = connect_timeout_s
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.stable_s = stable_s
+        self.stale_s = stale_s if stale_s is not None else 3 * refresh_s
+        self._connecting = asyncio.Semaphore(max_connecting)
+        self._queue = asyncio.Queue(queue_size)
+        self._seq = 0
+        self._rng = random.Random()
+        # address -> Device, every matching sensor seen
+        self.devices = {}
+        # address -> session task
+        self._sessions = {}
+        # devices waiting for a session, in discovery order
+        self._pending = deque()
+        self._wake = asyncio.Event()
+
+        self.connects = 0
+        self.failures = 0
+        self.notifications = 0
+        self.broadcasts = 0
+        self.dropped = 0
+
+    @property
+    def sessions(self):
+        return len(self._sessions)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    # Returns: Dict of state -> number of devices in it
+    def states(self):
+        counts = dict.fromkeys((SCANNING, CONNECTING, SUBSCRIBED, DEGRADED, BACKOFF), 0)
+        for device in self.devices.values():
+            counts[device.state] += 1
+        return counts
+
+    # Desc: Adds an event to the stream, dropping the oldest one if the queue is full
+    def _push(self, address, uuid, data):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(Event(self._seq, time.monotonic(), address, uuid, bytes(data)))
+        self._seq += 1
+
+    def _matches(self, address, name):
+        return self._match in address.lower() or (name is not None and self._match in name.lower())
+
+    # Desc: Scanner callback (device, advertisement data), as bleak calls it
+    def _detected(self, device, adv):
+        address = device.address
+        dev = self.devices.get(address)
+        if dev is None:
+            if not self._matches(address, adv.local_name or device.name):
+                return
+            dev = self.devices[address] = Device(address, time.monotonic())
+        data = adv.service_data.get(BTHOME_UUID)
+        if data is not None and dev.broadcast != data:
+            dev.broadcast = data
+            self.broadcasts += 1
+            self._push(address, BTHOME_UUID, data)
+        if dev.state == SCANNING and not dev.queued:
+            dev.queued = True
+            self._pending.append(dev)
+            self._wake.set()
+
+    # Desc: Runs the scanner and the sessions until cancelled
+    async def run(self):
+        scanner = self._backend.scanner(self._detected)
+        await scanner.start()
+        try:
+            while True:
+                await self._wake.wait()
+                self._wake.clear()
+                while self._pending and len(self._sessions) < self.max_sessions:
+                    dev = self._pending.popleft()
+                    dev.queued = False
+                    dev.state = CONNECTING
+                    self._sessions[dev.address] = asyncio.ensure_future(self._session(dev))
+        finally:
+            await scanner.stop()
+            sessions = list(self._sessions.values())
+            for task in sessions:
+                task.cancel()
+            await asyncio.gather(*sessions, return_exceptions=True)
+
+    # Returns: Async iterator over the events of all sensors, in arrival order
+    async def events(self):
+        while True:
+            yield await self._queue.get()
+
+    # Returns: ([(handle, callback)] subscribed to, [handle] written to ask for fresh readings)
+    async def _subscribe(self, client, dev):
+        address = dev.address
+
+        def handler(uuid):
+            def notified(characteristic, data):
+                dev.last_data = time.monotonic()
+                self.notifications += 1
+                self._push(address, uuid, data)
+            return notified
+
+        # the snapshot characteristic has every reading, the others are only needed without it
+        if client.services.get_characteristic(SNAPSHOT_UUID) is not None:
+            wanted = (SNAPSHOT_UUID, HISTORY_UUID)
+        else:
+            wanted = tuple(CHARACTERISTICS.values()) + (HISTORY_UUID,)
+        if self.cache is not None:
+            handles = await self.cache.resolve(client, address, wanted)
+            if handles is None:
+                raise LookupError("GATT cache of %s out of date" % address)
+        else:
+            handles = {}
+            for uuid in wanted:
+                char = client.services.get_characteristic(uuid)
+                if char is not None:
+                    handles[uuid] = char.handle
+        notify = []
+        refresh = []
+        handle = handles.get(SNAPSHOT_UUID)
+        if handle is not None:
+            notify.append((handle, handler(SNAPSHOT_UUID)))
+            refresh.append(handle)
+        else:
+            for name, uuid in CHARACTERISTICS.items():
+                handle = handles.get(uuid)
+                if handle is not None:
+                    notify.append((handle, handler(uuid)))
+                    if name in _REFRESH:
+                        refresh.append(handle)
+        for handle, callback in notify:
+            await client.start_notify(handle, callback)
+        # the sensor only logs to flash once its clock is set, it restarts from 2021 on every reset
+        handle = handles.get(HISTORY_UUID)
+        if handle is not None:
+            await client.write_gatt_char(handle, struct.pack("<BI", _SET_TIME, int(time.time())), response=True)
+        return notify, refresh
+
+    async def _resubscribe(self, client, dev, notify):
+        dev.resubscribes += 1
+        for handle, callback in notify:
+            try:
+                await client.stop_notify(handle)
+            except Exception:
+                pass
+            await client.start_notify(handle, callback)
+
+    async def _session(self, dev):
+        disconnected = asyncio.Event()
+        services = self.cache.services(dev.address) if self.cache is not None else None
+        client = self._backend.client(dev.address, lambda client: disconnected.set(), services)
+        dev.attempts += 1
+        try:
+            async with self._connecting:
+                await _wait_for(client.connect(), self.connect_timeout_s)
+                notify, refresh = await _wait_for(self._subscribe(client, dev), self.connect_timeout_s)
+            self._subscribed(dev)
+            # fresh readings right away, then every refresh_s
+            while not disconnected.is_set():
+                written = True
+                try:
+                    for handle in refresh:
+                        await client.write_gatt_char(handle, _REFRESH_DATA)
+                except Exception as e:
+                    written = False
+                    dev.last_error = "%s: %s" % (type(e).__name__, e)
+                try:
+                    await _wait_for(disconnected.wait(), self.refresh_s)
+                except asyncio.TimeoutError:
+                    pass
+                if disconnected.is_set():
+                    break
+                if written and time.monotonic() - dev.last_data < self.stale_s:
+                    dev.state = SUBSCRIBED
+                elif dev.state == SUBSCRIBED:
+                    # one resubscription before giving the connection up
+                    dev.state = DEGRADED
+                    await self._resubscribe(client, dev, notify)
+                else:
+                    raise TimeoutError("no readings for %.0f s" % (time.monotonic() - dev.last_data))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # BleakError, OSError, timeouts...
+            dev.last_error = "%s: %s" % (type(e).__name__, e)
+            self.failures += 1
+        finally:
+            del self._sessions[dev.address]
+            self._ended(dev)
+            self._wake.set()
+            if not disconnected.is_set():
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+
+    def _subscribed(self, dev):
+        now = time.monotonic()
+        latency = now - dev.lost_at
+        if dev.connects:
+            dev.reconnect_count += 1
+            dev.reconnect_total_s += latency
+            dev.reconnect_max_s = max(dev.reconnect_max_s, latency)
+        else:
+            dev.first_connect_s = latency
+        dev.connects += 1
+        self.connects += 1
+        dev.state = SUBSCRIBED
+        dev.subscribed_at = now
+        dev.last_data = now
+
+    # Desc: Closes a session and starts the backoff before the next attempt
+    def _ended(self, dev):
+        now = time.monotonic()
+        stable = False
+        if dev.subscribed_at is not None:
+            stable = now - dev.subscribed_at >= self.stable_s
+            dev.uptime_s += now - dev.subscribed_at
+            dev.subscribed_at = None
+            dev.disconnects += 1
+            dev.lost_at = now
+        if stable:
+            dev.failures = 0
+        dev.failures += 1
+        # exponential with jitter, half fixed so there is always a pause
+        delay = min(self.backoff_max_s, self.backoff_s * 2 ** (dev.failures - 1))
+        delay = delay / 2 + self._rng.uniform(0, delay / 2)
+        dev.state = BACKOFF
+        dev.retry_at = now + delay
+        asyncio.get_running_loop().call_later(delay, self._retry, dev)
+
+    def _retry(self, dev):
+        # back to waiting for an advertisement, which shows the sensor is still in range
+        if dev.state == BACKOFF:
+            dev.state = SCANNING
+
+
+# Desc: Decodes the data of an event, Environmental Sensing values scaled with notifydecode.SCALES
+def decode(event):
+    if event.uuid == SNAPSHOT_UUID:
+        return snapshot.decode(event.data)
+    if event.uuid == BTHOME_UUID:
+        return bthome.decode(event.data)
+    value = notifydecode.decode_one(event.uuid, event.data)
+    if value is not None:
+        return dict((value,))
+    return event.data
+
+
+# Desc: Readings of an event in the units of the store: temperature 0.01 C, humidity 0.01 %,
+#       pressure 10 Pa, PM ug/m3, heat 0/1
+# Returns: List of (metric, value)
+def readings(event):
+    if event.uuid == SNAPSHOT_UUID:
+        ts, flags, heat, temperature, humidity, pressure, pm1, pm25, pm10 = struct.unpack_from(
+            snapshot.FORMAT, event.data, 0)[:9]
+        result = []
+        if flags & snapshot.VALID_BMP280:
+            result += [("temperature", temperature), ("pressure", (pressure + 5) // 10)]
+        if flags & snapshot.VALID_DHT22:
+            result.append(("humidity", humidity))
+        if flags & snapshot.VALID_PMS7003:
+            result += [("pm1", pm1), ("pm25", pm25), ("pm10", pm10)]
+        if flags & snapshot.VALID_HEAT:
+            result.append(("heat", heat))
+        return result
+    if event.uuid == BTHOME_UUID:
+        result = []
+        for name, value in bthome.decode(event.data).items():
+            if name in ("temperature", "humidity"):
+                result.append((name, int(round(value * 100))))
+            elif name == "pressure":
+                result.append((name, (value + 5) // 10))
+            elif name in ("pm25", "pm10", "heat"):
+                result.append((name, int(value)))
+        return result
+    for name, uuid in CHARACTERISTICS.items():
+        if uuid == event.uuid:
+            value = struct.unpack_from("<h", event.data, 0)[0]
+            if name.startswith("PM"):
+                return [(name.lower(), value // 100)]
+            return [(name, value)]
+    return []
+
+
+# Desc: Stores the readings of every event, broadcasts only from sensors without a session
+async def storeEvents(gateway, store, flush_s=5):
+    lastFlush = time.monotonic()
+    try:
+        async for event in gateway.events():
+            if event.uuid == BTHOME_UUID and gateway.devices[event.address].state in (SUBSCRIBED, DEGRADED):
+                continue
+            now = int(time.time())
+            for metric, value in readings(event):
+                store.append(event.address, metric, now, value)
+            if event.time - lastFlush >= flush_s:
+                store.flush()
+                lastFlush = event.time
+    finally:
+        store.flush()
+
+
+async def printEvents(gateway):
+    async for event in gateway.events():
+        print("%6d %s %s" % (event.seq, event.address, decode(event)))
+
+
+async def printStats(gateway, interval_s):
+    while True:
+        await asyncio.sleep(interval_s)
+        now = time.monotonic()
+        print("states: %s" % gateway.states())
+        for address, device in sorted(gateway.devices.items()):
+            stats = device.stats(now)
+            print("%s %-10s up %5.1f%% connects %d reconnect mean %s s max %s s %s" % (
+                address, stats["state"], stats["availability"] * 100, stats["connects"],
+                _seconds(stats["reconnect_mean_s"]), _seconds(stats["reconnect_max_s"]), stats["last_error"] or ""))
+
+
+def _seconds(value):
+    return "-" if value is None else "%.2f" % value
+
+
+# Desc: asyncio.wait_for that never loses a cancellation: before Python 3.12, wait_for returns the
+#       result when the awaitable finishes in the loop iteration of the cancel, and a session
+#       cancelled by Gateway.run then goes on running
+# Returns: Result of the awaitable, raises asyncio.TimeoutError after timeout_s (the awaitable cancelled)
+async def _wait_for(awaitable, timeout_s):
+    task = asyncio.ensure_future(awaitable)
+    try:
+        done, pending = await asyncio.wait((task,), timeout=timeout_s)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel()
+        await asyncio.wait((task,))
+        raise asyncio.TimeoutError
+    return task.result()
+
+
+async def main(args):
+    if args.fake:
+        from sim.fakeble import FakeBackend
+        backend = FakeBackend.with_sensors(args.fake)
+    else:
+        backend = BleakBackend()
+    if args.cache is None:
+        # simulated addresses stay out of the cache of the real sensors
+        args.cache = "" if args.fake else "gatt_cache.json"
+    cache = GattCache(args.cache, save_delay_s=2) if args.cache else None
+    gateway = Gateway(backend, args.match, args.max_sessions, args.refresh, cache=cache)
+    tasks = [gateway.run(), storeEvents(gateway, TimeSeriesStore(args.store)) if args.store else printEvents(gateway)]
+    if args.stats:
+        tasks.append(printStats(gateway, args.stats))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if cache is not None:
+            cache.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reads many sensors at once and prints their readings")
+    parser.add_argument("--match", default="pico", help="part of the name or address of the sensors")
+    parser.add_argument("--max-sessions", type=int, default=8, help="sensors connected at once")
+    parser.add_argument("--refresh", type=float, default=30, help="seconds between refresh requests")
+    parser.add_argument("--cache", default=None,
+                        help="GATT handle cache file, empty for none (default gatt_cache.json, none with --fake)")
+    parser.add_argument("--store", default="", help="directory to store the readings in instead of printing them")
+    parser.add_argument("--stats", type=float, default=0, help="seconds between printing the device states")
+    parser.add_argument("--fake", type=int, default=0, help="simulate this many sensors instead of using bleak")
+    asyncio.run(main(parser.parse_args()))
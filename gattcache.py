@@ -0,0 +1,136 @@
+# On-disk cache of the GATT handles of each sensor, for fast reconnects.
+#
+# The first connection to a sensor finds the wanted characteristics in the
+# discovered services and stores, per device address, their handles, the
+# services holding them and the GATT Database Hash (0x2B2A) if the sensor
+# has one. On a reconnect:
+#   - services(address) lists the services to discover, so a client that
+#     supports it (bleak's services=...) skips the others,
+#   - resolve() reads the 16-byte hash (one ATT read) and checks that every
+#     cached handle still holds the same UUID, then returns the handles
+#     without walking the services or reading any descriptor.
+# A changed hash or a handle that moved (new firmware) drops the entry and
+# resolve() returns None: the services discovered for this connection may
+# not hold the characteristics any more, so the caller connects again and
+# the next resolve() looks them up in a full discovery.
+#
+# The file is JSON, rewritten through a temporary file so a crash never
+# leaves a partial cache. With save_delay_s the changes of that many seconds
+# are written together (a gateway meeting hundreds of new sensors at start
+# would otherwise rewrite the whole file for each one); call save() before
+# exiting.
+#   {"<address>": {"hash": "<hex>" or null, "services": [...], "handles": {"<uuid>": handle},
+#                  "uuids": [wanted UUIDs the entry was built for]}}
+# An entry built for other UUIDs (the caller now wants more) counts as stale.
+
+import asyncio
+import json
+import os
+
+import adparser
+
+DB_HASH_UUID = adparser.uuid_string(0x2B2A)
+GENERIC_ATTRIBUTE_UUID = adparser.uuid_string(0x1801)
+
+
+class GattCache:
+    # Args: path - JSON file, created on the first save,
+    #       save_delay_s - Seconds to collect changes before writing the file (0 = on every change)
+    def __init__(self, path, save_delay_s=0):
+        self.path = path
+        self.save_delay_s = save_delay_s
+        self._dirty = False
+        self._saveHandle = None
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.saves = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, address):
+        return address in self._entries
+
+    # Desc: Writes the file now if anything changed since the last save
+    def save(self):
+        if self._saveHandle is not None:
+            self._saveHandle.cancel()
+            self._saveHandle = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.saves += 1
+
+    def _changed(self):
+        self._dirty = True
+        if not self.save_delay_s:
+            self.save()
+        elif self._saveHandle is None:
+            self._saveHandle = asyncio.get_running_loop().call_later(self.save_delay_s, self.save)
+
+    # Returns: Service UUIDs to discover for a cached device, None to discover everything
+    def services(self, address):
+        entry = self._entries.get(address)
+        if entry is None:
+            return None
+        return [GENERIC_ATTRIBUTE_UUID] + entry["services"]
+
+    def forget(self, address):
+        if self._entries.pop(address, None) is not None:
+            self._changed()
+
+    # Desc: Handles of the characteristics of a connected client, from the cache when it is still valid
+    # Args: client - Connected BleakClient-like client, uuids - Characteristic UUIDs wanted
+    # Returns: Dict of UUID -> handle for the wanted characteristics the device has,
+    #          None if the cached entry is out of date (it is dropped)
+    async def resolve(self, client, address, uuids):
+        services = client.services
+        dbHash = await read_hash(client)
+        entry = self._entries.get(address)
+        if entry is not None:
+            if entry["hash"] == dbHash and entry.get("uuids") == sorted(uuids) and _valid(services, entry["handles"]):
+                self.hits += 1
+                return entry["handles"]
+            self.stale += 1
+            self.forget(address)
+            return None
+        self.misses += 1
+        handles = {}
+        serviceUuids = []
+        for uuid in uuids:
+            char = services.get_characteristic(uuid)
+            if char is None:
+                continue
+            handles[uuid] = char.handle
+            if char.service_uuid not in serviceUuids:
+                serviceUuids.append(char.service_uuid)
+        self._entries[address] = {"hash": dbHash, "services": serviceUuids, "handles": handles,
+                                  "uuids": sorted(uuids)}
+        self._changed()
+        return handles
+
+
+# Returns: Hex GATT Database Hash of a connected client, None if the device has none
+async def read_hash(client):
+    char = client.services.get_characteristic(DB_HASH_UUID)
+    if char is None:
+        return None
+    return bytes(await client.read_gatt_char(char)).hex()
+
+
+def _valid(services, handles):
+    for uuid, handle in handles.items():
+        char = services.get_characteristic(handle)
+        if char is None or char.uuid != uuid:
+            return False
+    return True
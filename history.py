@@ -0,0 +1,145 @@
+# Sample history kept in RAM, one fixed-size ring per metric.
+#
+# Every sample is stored as two 16-bit entries: the seconds since the
+# previous sample and the change of the value since the previous sample.
+# Values are the int16 characteristic values, deltas wrap modulo 2**16 so
+# every int16 value round-trips exactly. The oldest sample is kept as
+# absolute timestamp and value; when the ring is full it is dropped and the
+# next one becomes the base. A sample more than 65535 s after the last one,
+# or before it (the clock was set), cannot be stored as a gap: the ring is
+# emptied and that sample becomes the new base.
+#
+# export() writes the samples since a timestamp in the same delta form:
+#   count (u16), first timestamp s (u32), first value (i16),
+#   then count - 1 times: gap s (u16), delta (i16)
+# all little-endian, 4 bytes per sample. decode() reverses it.
+
+import struct
+from array import array
+
+EXPORT_HEADER = "<HIh"
+EXPORT_HEADER_SIZE = 8
+RECORD_SIZE = 4
+
+
+def _wrap16(v):
+    return ((v + 32768) & 0xFFFF) - 32768
+
+
+class MetricHistory:
+    # Args: capacity - Number of samples kept
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._gaps = array("H", bytes(2 * capacity))
+        self._deltas = array("h", bytes(2 * capacity))
+        self._start = 0
+        self._count = 0
+        # oldest and newest sample
+        self._firstTs = 0
+        self._firstValue = 0
+        self._lastTs = 0
+        self._lastValue = 0
+
+    def __len__(self):
+        return self._count
+
+    # Desc: Stores a sample, dropping the oldest one when the ring is full
+    # Args: ts - Timestamp in seconds, value - int16 value
+    def append(self, ts, value):
+        if self._count and not 0 <= ts - self._lastTs <= 0xFFFF:
+            self.clear()
+        if self._count == 0:
+            self._firstTs = self._lastTs = ts
+            self._firstValue = self._lastValue = value
+            self._gaps[self._start] = 0
+            self._deltas[self._start] = 0
+            self._count = 1
+            return
+        if self._count == self._capacity:
+            # the second oldest becomes the base
+            self._start = (self._start + 1) % self._capacity
+            self._firstTs += self._gaps[self._start]
+            self._firstValue = _wrap16(self._firstValue + self._deltas[self._start])
+            self._count -= 1
+        i = (self._start + self._count) % self._capacity
+        self._gaps[i] = ts - self._lastTs
+        self._deltas[i] = _wrap16(value - self._lastValue)
+        self._lastTs = ts
+        self._lastValue = value
+        self._count += 1
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+    # Desc: Largest export() of this ring in bytes
+    def export_size(self):
+        return EXPORT_HEADER_SIZE + RECORD_SIZE * max(self._capacity - 1, 0)
+
+    # Desc: Writes the samples taken at or after since into buf, see the layout above
+    # Returns: Number of bytes written
+    def export(self, since, buf, offset=0):
+        capacity = self._capacity
+        gaps = self._gaps
+        deltas = self._deltas
+        # skip the samples older than since
+        k = 0
+        ts = self._firstTs
+        value = self._firstValue
+        while k < self._count and ts < since:
+            k += 1
+            if k < self._count:
+                i = (self._start + k) % capacity
+                ts += gaps[i]
+                value = _wrap16(value + deltas[i])
+        count = self._count - k
+        if count <= 0:
+            struct.pack_into(EXPORT_HEADER, buf, offset, 0, 0, 0)
+            return EXPORT_HEADER_SIZE
+        struct.pack_into(EXPORT_HEADER, buf, offset, count, ts, value)
+        pos = offset + EXPORT_HEADER_SIZE
+        for j in range(k + 1, self._count):
+            i = (self._start + j) % capacity
+            struct.pack_into("<Hh", buf, pos, gaps[i], deltas[i])
+            pos += RECORD_SIZE
+        return pos - offset
+
+
+class History:
+    # Args: names - Metric names, their index is the metric id, capacity - Samples kept per metric
+    def __init__(self, names, capacity):
+        self.names = names
+        self._metrics = [MetricHistory(capacity) for name in names]
+        self._index = {name: i for i, name in enumerate(names)}
+
+    def metric(self, name):
+        return self._metrics[self._index[name]]
+
+    def __getitem__(self, id):
+        return self._metrics[id]
+
+    def __len__(self):
+        return len(self._metrics)
+
+    def append(self, name, ts, value):
+        self._metrics[self._index[name]].append(ts, value)
+
+    def export_size(self):
+        return max(m.export_size() for m in self._metrics)
+
+
+# Desc: Decodes an export
+# Returns: List of (timestamp s, value)
+def decode(data, offset=0):
+    count, ts, value = struct.unpack_from(EXPORT_HEADER, data, offset)
+    if count == 0:
+        return []
+    samples = [(ts, value)]
+    pos = offset + EXPORT_HEADER_SIZE
+    for k in range(count - 1):
+        gap, delta = struct.unpack_from("<Hh", data, pos)
+        ts += gap
+        value = _wrap16(value + delta)
+        samples.append((ts, value))
+        pos += RECORD_SIZE
+    return samples
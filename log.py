@@ -0,0 +1,136 @@
+# Logging with levels, lazy formatting and an optional RAM ring buffer.
+#
+# Messages are format strings with their arguments, formatted with % only
+# when they actually go to the console; the ring buffer keeps the format
+# string and arguments and formats them when it is dumped.
+#
+# Log calls in hot paths can be compiled out. A module that logs defines a
+# guard and wraps its calls in it:
+#
+#   _LOG = const(1)
+#   ...
+#   if _LOG:
+#       log.debug("sensor %s", state)
+#
+# With _LOG = const(0) the MicroPython compiler drops the whole block, so
+# the call, its argument tuple and the level check all disappear. Without
+# a guard a call costs the level check only.
+#
+# For a production build set console = False (no blocking USB-CDC/UART
+# I/O) and keep a ring buffer to dump with log.dump() from the REPL.
+
+import time
+from micropython import const
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+_LEVEL_NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+# Messages below this level are dropped
+level = INFO
+# Print messages as they are logged
+console = True
+
+_ring = None
+
+
+class RingSink:
+    # Args: size - Number of messages kept, older ones are overwritten
+    def __init__(self, size=64):
+        self._size = size
+        self._ts = [0] * size
+        self._levels = bytearray(size)
+        self._formats = [None] * size
+        self._args = [None] * size
+        self._next = 0
+        self._count = 0
+        self.dropped = 0
+
+    def add(self, lvl, fmt, args):
+        i = self._next
+        self._ts[i] = time.ticks_ms()
+        self._levels[i] = lvl
+        self._formats[i] = fmt
+        self._args[i] = args
+        self._next = (i + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+        else:
+            self.dropped += 1
+
+    def clear(self):
+        for i in range(self._size):
+            self._formats[i] = None
+            self._args[i] = None
+        self._next = 0
+        self._count = 0
+
+    # Desc: Formats the buffered messages, oldest first
+    # Returns: List of strings
+    def lines(self):
+        out = []
+        start = (self._next - self._count) % self._size
+        for k in range(self._count):
+            i = (start + k) % self._size
+            out.append("%d %s %s" % (self._ts[i], _LEVEL_NAMES.get(self._levels[i], "?"),
+                                     _format(self._formats[i], self._args[i])))
+        return out
+
+
+def _format(fmt, args):
+    if not args:
+        return fmt
+    try:
+        return fmt % args
+    except (TypeError, ValueError):
+        return "%s %r" % (fmt, args)
+
+
+# Desc: Keeps the last size messages in RAM (0 = no ring buffer)
+# Returns: The ring buffer or None
+def ring(size=64):
+    global _ring
+    _ring = RingSink(size) if size else None
+    return _ring
+
+
+def log(lvl, fmt, *args):
+    if lvl < level:
+        return
+    if _ring is not None:
+        _ring.add(lvl, fmt, args)
+    if console:
+        print(_format(fmt, args))
+
+
+def debug(fmt, *args):
+    if DEBUG >= level:
+        log(DEBUG, fmt, *args)
+
+
+def info(fmt, *args):
+    if INFO >= level:
+        log(INFO, fmt, *args)
+
+
+def warning(fmt, *args):
+    if WARNING >= level:
+        log(WARNING, fmt, *args)
+
+
+def error(fmt, *args):
+    if ERROR >= level:
+        log(ERROR, fmt, *args)
+
+
+# Desc: Prints the ring buffer, oldest message first
+# Args: clear - Empty the ring buffer afterwards
+def dump(clear=False):
+    if _ring is None:
+        return
+    for line in _ring.lines():
+        print(line)
+    if clear:
+        _ring.clear()
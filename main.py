@@ -9,12 +9,22 @@ import struct
 import time
 import machine
 import ubinascii
-from ble_advertising import advertising_payload
+import uasyncio as asyncio
+from ble_advertising import AdvertisingBuilder
 from micropython import const
 from machine import Pin
 from bmp280 import *
-from pms7003 import PMS7003
+from pms7003 import PMS7003, MODE_PASSIVE
+from scheduler import AcquisitionScheduler
+from publisher import GattPublisher
+from history import History
+from flashlog import FlashLog
+from snapshot import Snapshot
+import snapshot
+import bthome
 import dht
+import metrics
+import log
 
 
 # Bus and GPIO pin config for external sensors
@@ -28,6 +38,11 @@ PMS7003_UART_BUS_SEL = 1
 PMS7003_RX_PIN = 5
 PMS7003_TX_PIN = 4
 PMS7003_SLEEP_CRTL_PIN = 22
+PMS7003_STARTUP_S = 30
+# Seconds between PMS7003 wake-ups (0 keeps the sensor in active mode)
+PMS7003_DUTY_PERIOD_S = 300
+# Passive mode: the sensor only sends a frame when asked for one
+PMS7003_MODE = MODE_PASSIVE
 
 # DHT22 (Humidity and Temperature)
 DHT22_DAT_PIN = 17
@@ -36,14 +51,84 @@ DHT22_DAT_PIN = 17
 ONBOARD_TEMP_ADC_PIN = 4
 HEAT_RELAY_PIN = 16
 
+# Sampling cadence of each sensor task in ms (0 = only when a central requests it)
+BMP280_SAMPLE_MS = 10000
+DHT22_SAMPLE_MS = 10000
+PMS7003_SAMPLE_MS = 60000
+ONBOARD_SAMPLE_MS = 1000
+
+# Shortest time between a reading and a refresh forced by a central, per sensor task
+BMP280_MIN_REQUEST_MS = 2000
+DHT22_MIN_REQUEST_MS = 2000
+PMS7003_MIN_REQUEST_MS = 5000
+
+# Sample history kept in RAM for download over the history characteristic:
+# one sample of every metric per interval, samples kept per metric (12 h)
+HISTORY_INTERVAL_MS = 60000
+HISTORY_CAPACITY = 720
+# The metric id in history requests is the index in this tuple
+HISTORY_METRICS = ("temperature", "humidity", "pressure", "PM1", "PM25", "PM10", "heat")
+# Pause before retrying a history notification the controller had no room for
+HISTORY_RETRY_MS = 20
+# Sample log on flash, kept across resets (None = off): directory, records per
+# segment file (512 * 7 bytes fits a 4 KB block), segment files kept, records
+# collected in RAM per flash write
+FLASH_LOG_DIR = "/samples"
+FLASH_LOG_SEGMENT_RECORDS = 512
+FLASH_LOG_SEGMENTS = 16
+FLASH_LOG_BATCH = 64
+# The RTC starts again from its reset date (2021-01-01) on every boot: samples
+# are only logged once the clock is past this Unix time (2024-01-01), set by a
+# central (history request 0xFE, gateway.py and testBleRead.py send it on
+# connect) or by the host the board was started from (mpremote, Thonny)
+FLASH_LOG_MIN_TIME = 1704067200
+# Largest ATT MTU accepted, larger MTUs mean larger history chunks
+BLE_MTU = 247
+
+# Broadcast mode: the latest readings go into the advertisement as BTHome v2
+# service data after every snapshot, so any number of receivers can read them
+# without connecting. The name and services move to the scan response.
+BROADCAST = True
+
+# Readings arriving this close together go out in one snapshot notification
+SNAPSHOT_COALESCE_MS = 200
+
+# How often the diagnostics characteristic is refreshed (a GC is run each time)
+DIAGNOSTICS_MS = 30000
+# Shortest time between two diagnostics refreshes forced by a central, so a central
+# writing in a loop cannot run a GC on every write
+DIAGNOSTICS_MIN_REQUEST_MS = 5000
+
+# Notification policy per characteristic:
+# (min interval ms, heartbeat interval ms (0 = none), deadband in characteristic units)
+NOTIFY_POLICY = {
+    "temperature": (1000, 60000, 5),    # 0.05 C
+    "humidity": (1000, 60000, 10),      # 0.1 %
+    "pressure": (1000, 60000, 1),       # 10 Pa
+    "PM1": (5000, 300000, 100),         # 1 ug/m3
+    "PM25": (5000, 300000, 100),
+    "PM10": (5000, 300000, 100),
+    "heat": (0, 300000, 1),
+}
+
+# Logging: lowest level shown, print to the console (blocking I/O, off for
+# production builds), messages kept in RAM for log.dump() (0 = none)
+LOG_LEVEL = log.INFO
+LOG_CONSOLE = True
+LOG_RING_SIZE = 64
+# Set to 0 to compile the log calls in this file out
+_LOG = const(1)
+
 # Bluetooth event codes
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
 _IRQ_GATTS_WRITE = const(3)
 _IRQ_GATTS_INDICATE_DONE = const(20)
+_IRQ_MTU_EXCHANGED = const(21)
 
 # Bluetooth characteristic flags
 _FLAG_READ = bluetooth.FLAG_READ
+_FLAG_WRITE = bluetooth.FLAG_WRITE
 _FLAG_WRITE_NO_RESPONSE = bluetooth.FLAG_WRITE_NO_RESPONSE
 _FLAG_NOTIFY = bluetooth.FLAG_NOTIFY
 _FLAG_INDICATE = bluetooth.FLAG_INDICATE
@@ -91,6 +176,72 @@ _ENV_SENSE_SERVICE = (
     (_TEMP_CHAR, _HUMID_CHAR, _PRESS_CHAR, _PM1_CHAR, _PM25_CHAR, _PM10_CHAR, _HEAT_CHAR),
 )
 
+# Diagnostics service (vendor specific)
+_DIAG_UUID = bluetooth.UUID("7a1c0000-3d4b-4c8e-9f21-5e6d7c8b9a01")
+# Hot path metrics and heap state, see metrics.py for the layout.
+# Any write refreshes it and notifies the connected centrals with the 16-byte
+# header only (metrics.HEADER_SIZE): the whole value does not fit in a
+# notification, the central reads it (a long read) after the notification.
+_METRICS_CHAR = (
+    bluetooth.UUID("7a1c0001-3d4b-4c8e-9f21-5e6d7c8b9a01"),
+    _FLAG_READ | _FLAG_WRITE_NO_RESPONSE | _FLAG_NOTIFY,
+)
+
+_DIAG_SERVICE = (
+    _DIAG_UUID,
+    (_METRICS_CHAR,),
+)
+
+# Sample history service (vendor specific)
+_HISTORY_UUID = bluetooth.UUID("7a1c0010-3d4b-4c8e-9f21-5e6d7c8b9a01")
+# Every timestamp on the air (history, flash log, snapshot) is Unix time in seconds,
+# whatever the epoch of the port's time.time().
+# A central writes a request: metric id (u8, index in HISTORY_METRICS), since timestamp s (u32).
+# The response is notified in chunks of up to MTU - 3 bytes:
+#   metric id (u8), device time s (u32), then the samples as written by history.MetricHistory.export()
+# Metric id 0xFF reads the flash log instead (all metrics):
+#   0xFF (u8), device time s (u32), record count (u32), then the records as read by FlashLog.chunks()
+# Metric id 0xFE sets the device clock instead, to the Unix time in place of since (nothing is notified)
+_HISTORY_CHAR = (
+    bluetooth.UUID("7a1c0011-3d4b-4c8e-9f21-5e6d7c8b9a01"),
+    _FLAG_WRITE | _FLAG_NOTIFY,
+)
+
+_HISTORY_SERVICE = (
+    _HISTORY_UUID,
+    (_HISTORY_CHAR,),
+)
+
+# Snapshot service (vendor specific)
+_SNAPSHOT_UUID = bluetooth.UUID("7a1c0020-3d4b-4c8e-9f21-5e6d7c8b9a01")
+# Every reading in one fixed layout, see snapshot.py. Notified once per sampling
+# cycle (needs an MTU of at least snapshot.SIZE + 3), any write refreshes all sensors.
+_SNAPSHOT_CHAR = (
+    bluetooth.UUID("7a1c0021-3d4b-4c8e-9f21-5e6d7c8b9a01"),
+    _FLAG_READ | _FLAG_WRITE_NO_RESPONSE | _FLAG_NOTIFY,
+)
+
+_SNAPSHOT_SERVICE = (
+    _SNAPSHOT_UUID,
+    (_SNAPSHOT_CHAR,),
+)
+
+# Largest PM value of the Environmental Sensing characteristics (0.01 ug/m3, "<h")
+_PM_MAX = const(32767)
+
+_HISTORY_REQUEST = "<BI"
+_HISTORY_REQUEST_SIZE = const(5)
+_HISTORY_RESPONSE = "<BI"
+_HISTORY_RESPONSE_SIZE = const(5)
+_HISTORY_FLASH = const(0xFF)
+_HISTORY_SET_TIME = const(0xFE)
+# Seconds from the Unix epoch to the port's time.time() epoch
+_EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+# Desc: Unix time in seconds from the RTC
+def _unixTime():
+    return int(time.time()) + _EPOCH_OFFSET
+
 # org.bluetooth.characteristic.gap.appearance.xml
 _ADV_APPEARANCE_GENERIC_THERMOMETER = const(768)
 
@@ -109,25 +260,86 @@ class BLETemperature:
         self._handle["PM25"],
         self._handle["PM10"],
         self._handle["heat"],
-        ),) = self._ble.gatts_register_services((_ENV_SENSE_SERVICE,))
+        ), (
+        self._handle["metrics"],
+        ), (
+        self._handle["history"],
+        ), (
+        self._handle["snapshot"],
+        ),) = self._ble.gatts_register_services((_ENV_SENSE_SERVICE, _DIAG_SERVICE, _HISTORY_SERVICE, _SNAPSHOT_SERVICE))
+        self._metrics = bytearray(metrics.SIZE)
+        self._ble.gatts_set_buffer(self._handle["metrics"], metrics.SIZE)
+        self._ble.gatts_set_buffer(self._handle["history"], _HISTORY_REQUEST_SIZE)
+        self._ble.gatts_set_buffer(self._handle["snapshot"], snapshot.SIZE)
+        self._ble.config(mtu=BLE_MTU)
+        # negotiated ATT MTU per connection
+        self._mtu = {}
 
-        print(self._handle)
+        if _LOG:
+            log.debug("handles %s", self._handle)
+        # GATT write on a characteristic -> sensor task that refreshes it
+        self._refresh = {
+            self._handle["temperature"]: "bmp280",
+            self._handle["pressure"]: "bmp280",
+            self._handle["humidity"]: "dht22",
+            self._handle["PM1"]: "pms7003",
+            self._handle["PM25"]: "pms7003",
+            self._handle["PM10"]: "pms7003",
+            self._handle["metrics"]: "diagnostics",
+        }
+        self.scheduler = AcquisitionScheduler()
+        self.scheduler.add("bmp280", self._read_bmp280, BMP280_SAMPLE_MS, self._publish_bmp280, BMP280_MIN_REQUEST_MS)
+        self.scheduler.add("dht22", self._read_dht22, DHT22_SAMPLE_MS, self._publish_dht22, DHT22_MIN_REQUEST_MS)
+        self.scheduler.add("pms7003", self._read_pms7003, PMS7003_SAMPLE_MS, self._publish_pms7003, PMS7003_MIN_REQUEST_MS)
+        self.scheduler.add("diagnostics", self._read_metrics, DIAGNOSTICS_MS, self._publish_metrics,
+                           DIAGNOSTICS_MIN_REQUEST_MS)
+        self.scheduler.add_service(self.pms7003.run)
         self._connections = set()
+        self.publisher = GattPublisher(self._ble, self._connections)
+        for characteristic in ("temperature", "humidity", "pressure", "PM1", "PM25", "PM10", "heat"):
+            minMs, maxMs, deadband = NOTIFY_POLICY[characteristic]
+            self.publisher.add(characteristic, self._handle[characteristic], "<h", minMs, maxMs, deadband)
+        self.scheduler.add_service(self.publisher.run)
+
+        self.history = History(HISTORY_METRICS, HISTORY_CAPACITY)
+        self._historyBuffer = bytearray(_HISTORY_RESPONSE_SIZE + self.history.export_size())
+        self._historyFlag = asyncio.ThreadSafeFlag()
+        # conn_handle -> request written by that central, waiting for _serveHistory
+        self._historyRequests = {}
+        # FlashLog the history is also written to, set by the owner
+        self.flashLog = None
+        self.scheduler.add_service(self._recordHistory)
+        self.scheduler.add_service(self._serveHistory)
+
+        self.snapshot = Snapshot()
+        self._snapshotFlag = asyncio.ThreadSafeFlag()
+        self.scheduler.add_service(self._sendSnapshots)
         if len(name) == 0:
             name = 'Pico %s' % ubinascii.hexlify(self._ble.config('mac')[1],':').decode().upper()
-        print('Sensor name %s' % name)
-        self._payload = advertising_payload(
-            name=name, services=[_ENV_SENSE_UUID], appearance=_ADV_APPEARANCE_GENERIC_THERMOMETER
-        )
+        if _LOG:
+            log.info("Sensor name %s", name)
+        # Laid out once, the broadcast readings are patched in place
+        if BROADCAST:
+            # no room left for the appearance
+            self._adv = AdvertisingBuilder().flags().service_data(bthome.UUID, size=bthome.MAX_SIZE, key="bthome").build()
+            self._resp = AdvertisingBuilder().name(name).services([_ENV_SENSE_UUID]).build()
+            self._packetId = 0
+            self._bthome = bytearray(bthome.MAX_SIZE)
+            self._updateBroadcast()
+        else:
+            self._adv = AdvertisingBuilder().flags().name(name).services([_ENV_SENSE_UUID]).build()
+            self._resp = AdvertisingBuilder().appearance(_ADV_APPEARANCE_GENERIC_THERMOMETER).build()
         self._advertise()
 
     def init_sensors(self):
         i2c = machine.I2C(BMP280_I2C_BUS_SEL,scl=machine.Pin(BMP280_I2C_SCL_PIN),sda=machine.Pin(BMP280_I2C_SDA_PIN),freq=200000)
         self.bmp280 = BMP280(i2c)
-        self.bmp280.use_case(BMP280_CASE_INDOOR)
+        # Forced mode: one conversion per sensor task cycle instead of running continuously
+        self.bmp280.use_case(BMP280_CASE_WEATHER)
+        self.bmp280.oversample(BMP280_OS_ULTRAHIGH)
 
         uart = machine.UART(PMS7003_UART_BUS_SEL, baudrate=9600, bits=8, parity=None, stop=1, tx=machine.Pin(PMS7003_TX_PIN), rx=machine.Pin(PMS7003_RX_PIN))
-        self.pms7003 = PMS7003(uart, 30, PMS7003_SLEEP_CRTL_PIN)
+        self.pms7003 = PMS7003(uart, PMS7003_STARTUP_S, PMS7003_SLEEP_CRTL_PIN, PMS7003_DUTY_PERIOD_S, mode=PMS7003_MODE)
 
         self.dht22 = dht.DHT22(machine.Pin(DHT22_DAT_PIN))
 
@@ -138,64 +350,209 @@ class BLETemperature:
         if event == _IRQ_CENTRAL_CONNECT:
             conn_handle, _, _ = data
             self._connections.add(conn_handle)
-            print("added connection:", conn_handle)
+            if _LOG:
+                log.info("added connection: %d", conn_handle)
         elif event == _IRQ_CENTRAL_DISCONNECT:
             conn_handle, _, _ = data
+            self._mtu.pop(conn_handle, None)
+            self._historyRequests.pop(conn_handle, None)
             try: 
                 self._connections.remove(conn_handle)
             except:
-                print("disconnect irq error")
-                print(self._connections)
-            print("Client disconnect")
+                if _LOG:
+                    log.warning("disconnect of unknown connection %s, connections %s", conn_handle, self._connections)
+            if _LOG:
+                log.info("Client disconnect")
             # Start advertising again to allow a new connection.
             self._advertise()
         elif event == _IRQ_GATTS_INDICATE_DONE:
             conn_handle, value_handle, status = data
+        elif event == _IRQ_MTU_EXCHANGED:
+            conn_handle, mtu = data
+            self._mtu[conn_handle] = mtu
         elif event == _IRQ_GATTS_WRITE:
             conn_handle, attr_handle = data
-            if attr_handle == self._handle["temperature"]:
-                print("Update temperature")
-                updateValue = struct.pack("<h", int(round(self.bmp280.temperature * 100)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="temperature", value=updateValue)
-            elif attr_handle == self._handle["humidity"]:
-                print("Update humidity")
-                self.dht22.measure()
-                updateValue = struct.pack("<h", int(round(self.dht22.humidity() * 100)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="humidity", value=updateValue)
-            elif attr_handle == self._handle["pressure"]:
-                print("Update pressure")
-                print(self.bmp280.pressure)
-                updateValue = struct.pack("<h", int(round(self.bmp280.pressure / 10)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="pressure", value=updateValue)
-            elif attr_handle in (self._handle["PM1"], self._handle["PM25"], self._handle["PM10"]):
-                print("Update air particulate fields")
-                airQuality = self.pms7003.readAirQuality()
-                updateValue = struct.pack("<h", int(round(airQuality["pm1"] * 100)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="PM1", value=updateValue)
-                updateValue = struct.pack("<h", int(round(airQuality["pm25"] * 100)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="PM25", value=updateValue)
-                updateValue = struct.pack("<h", int(round(airQuality["pm10"] * 100)))
-                self.update_characteristic(notify=True, indicate=False, characteristic="PM10", value=updateValue)
-
-
-    def update_characteristic(self, notify=False, indicate=False, characteristic="temperature", value=b''):
-        # Write the local value, ready for a central to read.
-        # value = self.bmp280.temperature
-        print("write %s: %.2f" % (characteristic, float(struct.unpack("<h", value)[0])))
-        # self._ble.gatts_write(self._handle[characteristic], struct.pack("<h", int(value * 100)))
-        self._ble.gatts_write(self._handle[characteristic], value)
-        if notify or indicate:
+            if attr_handle == self._handle["history"]:
+                # kept per connection (the characteristic value is shared), _serveHistory sends the samples
+                self._historyRequests[conn_handle] = bytes(self._ble.gatts_read(attr_handle))
+                self._historyFlag.set()
+                return
+            if attr_handle == self._handle["snapshot"]:
+                # the fresh readings are coalesced into one snapshot notification
+                for sensor in ("bmp280", "dht22", "pms7003"):
+                    self.scheduler.request(sensor)
+                return
+            # Only queue the refresh here, the sensor task does the read and notifies.
+            sensor = self._refresh.get(attr_handle)
+            if sensor is not None:
+                self.scheduler.request(sensor)
+
+    async def _read_bmp280(self):
+        # (0.01 C, Pa) as ints, no float or bigint allocation
+        return await self.bmp280.forced_read(integer=True)
+
+    def _read_dht22(self):
+        t0 = time.ticks_us()
+        self.dht22.measure()
+        metrics.record(metrics.DHT, t0)
+        return self.dht22.humidity()
+
+    async def _read_pms7003(self):
+        # Latest frame (queried on demand in passive mode), no warm-up wait
+        airQuality, age = await self.pms7003.read()
+        return airQuality
+
+    def _read_metrics(self):
+        metrics.collect()
+        return metrics.snapshot(self._metrics)
+
+    def _publish_bmp280(self, sensor, value):
+        temperature, pressure = value
+        # a central that asked for the reading is notified even if it did not change
+        requested = self.scheduler.task(sensor).pending
+        self.publisher.stage("temperature", temperature, requested)
+        self.publisher.stage("pressure", (pressure + 5) // 10, requested)
+        self.publisher.flush()
+        self.snapshot.set_bmp280(temperature, pressure)
+        self._snapshotFlag.set()
+
+    def _publish_dht22(self, sensor, value):
+        humidity = int(round(value * 100))
+        self.publisher.stage("humidity", humidity, self.scheduler.task(sensor).pending)
+        self.publisher.flush()
+        self.snapshot.set_dht22(humidity)
+        self._snapshotFlag.set()
+
+    def _publish_pms7003(self, sensor, airQuality):
+        # 0.01 ug/m3 in a "<h" saturates at 327.67 ug/m3 (the PMS7003 reports up to 1000),
+        # the snapshot has the full value
+        requested = self.scheduler.task(sensor).pending
+        self.publisher.stage("PM1", min(airQuality["pm1"] * 100, _PM_MAX), requested)
+        self.publisher.stage("PM25", min(airQuality["pm25"] * 100, _PM_MAX), requested)
+        self.publisher.stage("PM10", min(airQuality["pm10"] * 100, _PM_MAX), requested)
+        self.publisher.flush()
+        self.snapshot.set_pms7003(airQuality)
+        self._snapshotFlag.set()
+
+    def _publish_metrics(self, sensor, snapshot):
+        handle = self._handle["metrics"]
+        self._ble.gatts_write(handle, snapshot)
+        # only notify when a central asked for it, not on the periodic refresh
+        if self.scheduler.task(sensor).pending:
+            header = memoryview(snapshot)[:metrics.HEADER_SIZE]
+            for conn_handle in self._connections:
+                self._ble.gatts_notify(conn_handle, handle, header)
+
+    # Desc: Writes and notifies the snapshot characteristic after new readings
+    async def _sendSnapshots(self):
+        handle = self._handle["snapshot"]
+        while True:
+            await self._snapshotFlag.wait()
+            await asyncio.sleep_ms(SNAPSHOT_COALESCE_MS)
+            self._snapshotFlag.clear()
+            heat = self.publisher.value("heat")
+            if heat is not None:
+                self.snapshot.set_heat(heat)
+            self.snapshot.set_time(_unixTime())
+            self._ble.gatts_write(handle, self.snapshot.buffer)
             for conn_handle in self._connections:
-                if notify:
-                    # Notify connected centrals.
-                    self._ble.gatts_notify(conn_handle, self._handle[characteristic])
-                if indicate:
-                    # Indicate connected centrals.
-                    self._ble.gatts_indicate(conn_handle, self._handle[characteristic])
+                t0 = time.ticks_us()
+                self._ble.gatts_notify(conn_handle, handle)
+                metrics.record(metrics.NOTIFY, t0)
+            if BROADCAST:
+                self._packetId = (self._packetId + 1) & 0xFF
+                self._updateBroadcast()
+                self._advertise()
 
+    # Desc: Stores the current value of every metric in the history once per HISTORY_INTERVAL_MS
+    async def _recordHistory(self):
+        while True:
+            await asyncio.sleep_ms(HISTORY_INTERVAL_MS)
+            now = _unixTime()
+            for i in range(len(HISTORY_METRICS)):
+                value = self.publisher.value(HISTORY_METRICS[i])
+                if value is not None:
+                    self.history[i].append(now, value)
+                    if self.flashLog is not None:
+                        self.flashLog.append(i, now, value)
+
+    # Desc: Answers history requests, notifying the samples in MTU sized chunks
+    async def _serveHistory(self):
+        view = memoryview(self._historyBuffer)
+        while True:
+            await self._historyFlag.wait()
+            # one transfer at a time, in the order of the requesting connections
+            while self._historyRequests:
+                conn_handle = next(iter(self._historyRequests))
+                request = self._historyRequests.pop(conn_handle)
+                await self._sendHistory(conn_handle, request, view)
+
+    # Desc: Answers one history request of a connection
+    async def _sendHistory(self, conn_handle, request, view):
+        handle = self._handle["history"]
+        buf = self._historyBuffer
+        if len(request) < _HISTORY_REQUEST_SIZE or \
+                (request[0] >= len(self.history) and request[0] != _HISTORY_SET_TIME and
+                 not (request[0] == _HISTORY_FLASH and self.flashLog is not None)):
+            if _LOG:
+                log.warning("bad history request %s", request)
+            return
+        metric, since = struct.unpack_from(_HISTORY_REQUEST, request, 0)
+        if metric == _HISTORY_SET_TIME:
+            self._setClock(since)
+            return
+        struct.pack_into(_HISTORY_RESPONSE, buf, 0, metric, _unixTime())
+        if metric == _HISTORY_FLASH:
+            struct.pack_into("<I", buf, _HISTORY_RESPONSE_SIZE, self.flashLog.count_since(since))
+            await self._notifyChunks(conn_handle, handle, view, _HISTORY_RESPONSE_SIZE + 4)
+            for size in self.flashLog.chunks(since, buf):
+                await self._notifyChunks(conn_handle, handle, view, size)
+        else:
+            size = _HISTORY_RESPONSE_SIZE + self.history[metric].export(since, buf, _HISTORY_RESPONSE_SIZE)
+            await self._notifyChunks(conn_handle, handle, view, size)
+        if _LOG:
+            log.debug("history %d since %d sent to %d", metric, since, conn_handle)
+
+    # Desc: Sets the RTC from a Unix time written by a central
+    def _setClock(self, unixTime):
+        shift = unixTime - _unixTime()
+        t = time.gmtime(unixTime - _EPOCH_OFFSET)
+        machine.RTC().datetime((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0))
+        metrics.clock_moved(shift)
+        # the RAM history is based on the old clock, its samples cannot be placed in the new one
+        if shift:
+            for i in range(len(self.history)):
+                self.history[i].clear()
+        if _LOG:
+            log.info("clock set to %d", unixTime)
+
+    # Desc: Notifies the first size bytes of view in chunks of the connection's MTU - 3
+    async def _notifyChunks(self, conn_handle, handle, view, size):
+        chunk = self._mtu.get(conn_handle, 23) - 3
+        pos = 0
+        while pos < size and conn_handle in self._connections:
+            try:
+                self._ble.gatts_notify(conn_handle, handle, view[pos:min(pos + chunk, size)])
+            except OSError:
+                # no room in the controller's queue, let it drain
+                await asyncio.sleep_ms(HISTORY_RETRY_MS)
+                continue
+            pos += chunk
+            await asyncio.sleep_ms(0)
+
+    # Desc: Publishes a single value, notifying connected centrals if it changed
+    def update_characteristic(self, characteristic, value, notify=True, indicate=False):
+        self.publisher.stage(characteristic, value)
+        self.publisher.flush(notify=notify, indicate=indicate)
+
+    # Desc: Patches the snapshot readings into the BTHome service data of the advertisement
+    def _updateBroadcast(self):
+        n = bthome.pack_into(self._bthome, self.snapshot.buffer, self._packetId)
+        # after the service UUID
+        self._adv.set("bthome", self._bthome, n, 2)
 
     def _advertise(self, interval_us=500000):
-        self._ble.gap_advertise(interval_us, adv_data=self._payload)
+        self._ble.gap_advertise(interval_us, adv_data=self._adv.payload, resp_data=self._resp.payload)
 
 class internalTemperatureSensor:
     def __init__(self, pin):
@@ -222,39 +579,49 @@ class heatingRelay:
         return self.relayStatus
 
 def demo():
+    log.level = LOG_LEVEL
+    log.console = LOG_CONSOLE
+    log.ring(LOG_RING_SIZE)
     ble = bluetooth.BLE()
     temp = BLETemperature(ble)
-    counter = 0
+    if FLASH_LOG_DIR:
+        temp.flashLog = FlashLog(FLASH_LOG_DIR, FLASH_LOG_SEGMENT_RECORDS, FLASH_LOG_SEGMENTS, FLASH_LOG_BATCH,
+                                 FLASH_LOG_MIN_TIME)
     iTemp = internalTemperatureSensor(ONBOARD_TEMP_ADC_PIN)
     heater = heatingRelay(HEAT_RELAY_PIN)
     led = Pin('LED', Pin.OUT)
-    try:
-        while True:
-            # if counter % 10 == 0:
-            #     tempValue = struct.pack("<h", int(temp.bmp280.temperature * 100))
-            #     temp.update_characteristic(notify=True, indicate=False, characteristic="temperature", value=tempValue)
-            led.toggle()
-            time.sleep_ms(1000)
-            counter += 1
-            internalTemp = iTemp.readTemperature()
-            heaterStatus = heater.getRelayState()
-            print(internalTemp)
-            if(internalTemp < 5):
-                if(not heaterStatus):
-                    heater.setRelayState(True)
-                    updateValue = struct.pack("<h", int(1))
-                    temp.update_characteristic(notify=True, indicate=False, characteristic="heat", value=updateValue)
-                print("heater on")
-            if(internalTemp > 10):
-                if(heaterStatus):
-                    heater.setRelayState(False)
-                    updateValue = struct.pack("<h", int(0))
-                    temp.update_characteristic(notify=True, indicate=False, characteristic="heat", value=updateValue)
-                print("heater off")
 
+    def readOnboard():
+        led.toggle()
+        return iTemp.readTemperature()
+
+    def controlHeater(sensor, internalTemp):
+        heaterStatus = heater.getRelayState()
+        if _LOG:
+            log.debug("internal temperature %s", internalTemp)
+        if(internalTemp < 5):
+            if(not heaterStatus):
+                heater.setRelayState(True)
+                temp.update_characteristic("heat", 1)
+                if _LOG:
+                    log.info("heater on at %s C", internalTemp)
+        if(internalTemp > 10):
+            if(heaterStatus):
+                heater.setRelayState(False)
+                temp.update_characteristic("heat", 0)
+                if _LOG:
+                    log.info("heater off at %s C", internalTemp)
+
+    temp.scheduler.add("onboard", readOnboard, ONBOARD_SAMPLE_MS, controlHeater)
+    try:
+        asyncio.run(temp.scheduler.run())
     except KeyboardInterrupt:
-        print("Disconnecting...")
-        for conn in temp._connections:
+        if _LOG:
+            log.info("Disconnecting...")
+        if temp.flashLog is not None:
+            temp.flashLog.flush()
+        # gap_disconnect removes the connection in the IRQ, iterate over a copy
+        for conn in tuple(temp._connections):
             ble.gap_disconnect(conn)
 
 if __name__ == "__main__":
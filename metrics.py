@@ -0,0 +1,140 @@
+# Hot path instrumentation.
+#
+# Every instrumented call site takes a time.ticks_us() timestamp before the
+# call and passes it to record() afterwards:
+#
+#   t0 = time.ticks_us()
+#   d = i2c.readfrom_mem(addr, reg, 6)
+#   metrics.record(metrics.I2C, t0)
+#
+# Each metric keeps a call count, the total and the worst duration, and a
+# histogram with power-of-4 buckets (<64 us, <256 us, <1 ms, ... >=262 ms).
+# Everything lives in preallocated arrays and all counters wrap at 2**30 so
+# they stay small ints, recording does not allocate.
+#
+# snapshot() packs the metrics together with the heap state into a fixed
+# binary layout (all little-endian):
+#   header: uptime s (u32), free heap (u32), allocated heap (u32), collections (u32)
+#   per metric, in the order of NAMES: count (u32), total us (u32), max us (u32),
+#                                      BUCKETS bucket counts (u32)
+# The whole snapshot (SIZE, 280 bytes) is larger than any notification
+# (ATT MTU - 3, at most 244), so only the header is notified: it fits the
+# default 20 bytes and tells the central to read the characteristic.
+
+import gc
+import struct
+import time
+from array import array
+from micropython import const
+
+# Metric ids
+I2C = const(0)       # BMP280 register reads and writes
+UART = const(1)      # PMS7003 UART readinto
+FRAME = const(2)     # PMS7003 frame search and checksum
+DHT = const(3)       # DHT22 measurement
+NOTIFY = const(4)    # gatts_notify / gatts_indicate
+GC = const(5)        # gc.collect()
+COUNT = const(6)
+NAMES = ("i2c", "uart", "frame", "dht", "notify", "gc")
+
+BUCKETS = const(8)
+# Bucket i holds durations below 64 * 4**i us, the last one everything above
+_BUCKET_BASE_US = const(64)
+
+_HEADER = "<IIII"
+_HEADER_SIZE = const(16)
+HEADER_SIZE = _HEADER_SIZE
+_METRIC = "<III" + "I" * BUCKETS
+_METRIC_SIZE = const(44)
+SIZE = _HEADER_SIZE + COUNT * _METRIC_SIZE
+
+_WRAP = const(0x3FFFFFFF)
+
+# Set to False to turn recording off at runtime
+enabled = True
+
+_count = array("I", bytes(4 * COUNT))
+_total = array("I", bytes(4 * COUNT))
+_max = array("I", bytes(4 * COUNT))
+_buckets = array("I", bytes(4 * COUNT * BUCKETS))
+_bootS = int(time.time())
+
+try:
+    _memFree = gc.mem_free
+    _memAlloc = gc.mem_alloc
+except AttributeError:
+    # CPython (host simulator) has no heap figures
+    _memFree = _memAlloc = lambda: 0
+
+
+# Desc: Records one call of an instrumented operation
+# Args: metric - Metric id, t0 - time.ticks_us() taken before the call
+def record(metric, t0):
+    if not enabled:
+        return
+    dt = time.ticks_diff(time.ticks_us(), t0)
+    _count[metric] = (_count[metric] + 1) & _WRAP
+    _total[metric] = (_total[metric] + dt) & _WRAP
+    if dt > _max[metric]:
+        _max[metric] = dt & _WRAP
+    bucket = 0
+    limit = _BUCKET_BASE_US
+    while dt >= limit and bucket < BUCKETS - 1:
+        limit <<= 2
+        bucket += 1
+    i = metric * BUCKETS + bucket
+    _buckets[i] = (_buckets[i] + 1) & _WRAP
+
+
+# Desc: Keeps the uptime right when the clock is set
+# Args: shift_s - Seconds the clock moved
+def clock_moved(shift_s):
+    global _bootS
+    _bootS += shift_s
+
+
+# Desc: Runs a garbage collection, recorded as the GC metric
+def collect():
+    t0 = time.ticks_us()
+    gc.collect()
+    record(GC, t0)
+
+
+def reset():
+    for i in range(COUNT):
+        _count[i] = 0
+        _total[i] = 0
+        _max[i] = 0
+    for i in range(COUNT * BUCKETS):
+        _buckets[i] = 0
+
+
+# Desc: Packs the heap state and all metrics into buf (at least SIZE bytes), see the layout above
+# Returns: buf
+def snapshot(buf):
+    struct.pack_into(_HEADER, buf, 0, (int(time.time()) - _bootS) & _WRAP, _memFree(), _memAlloc(), _count[GC])
+    offset = _HEADER_SIZE
+    for m in range(COUNT):
+        struct.pack_into("<III", buf, offset, _count[m], _total[m], _max[m])
+        offset += 12
+        for b in range(m * BUCKETS, (m + 1) * BUCKETS):
+            struct.pack_into("<I", buf, offset, _buckets[b])
+            offset += 4
+    return buf
+
+
+# Desc: Decodes a snapshot, e.g. one read from the diagnostics characteristic
+# Returns: Dict with uptime_s, mem_free, mem_alloc, collections and a dict per metric name
+def decode(data):
+    uptime, memFree, memAlloc, collections = struct.unpack_from(_HEADER, data, 0)
+    report = {"uptime_s": uptime, "mem_free": memFree, "mem_alloc": memAlloc, "collections": collections}
+    for m in range(COUNT):
+        fields = struct.unpack_from(_METRIC, data, _HEADER_SIZE + m * _METRIC_SIZE)
+        report[NAMES[m]] = {
+            "count": fields[0],
+            "total_us": fields[1],
+            "max_us": fields[2],
+            "mean_us": fields[1] // fields[0] if fields[0] else 0,
+            "buckets": fields[3:],
+        }
+    return report
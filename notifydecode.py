@@ -0,0 +1,213 @@
+# Batch decoding and unit scaling of notifications, on the host.
+#
+# BatchDecoder.add() only appends the raw payload of a notification to the
+# buffer of its characteristic, with its arrival time and device. decode()
+# then turns each buffer into typed columns in one go:
+#   - the Environmental Sensing characteristics are all "<h", so a buffer is
+#     one numpy.frombuffer (or array("h")) over the concatenated payloads,
+#     scaled with the characteristic's factor and offset from SCALES,
+#   - snapshot notifications are fixed 38-byte records, read with a
+#     structured dtype (or strided slices of array("H")) and split per
+#     reading, rows whose VALID_* flag is clear left out.
+# With NumPy the columns are numpy arrays, without it array.array.
+#
+# decode_one() is the same table applied to a single notification, for
+# printing.
+#
+#   decoder = BatchDecoder()
+#   decoder.add(address, uuid, data, time.time())
+#   columns = decoder.decode()
+#   columns["temperature"]["value"]   # C, float64
+
+import struct
+import sys
+from array import array
+from itertools import compress
+
+import adparser
+import snapshot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SNAPSHOT_UUID = "7a1c0021-3d4b-4c8e-9f21-5e6d7c8b9a01"
+
+# characteristic UUID -> (metric, scale, offset); value = raw "<h" * scale + offset
+SCALES = {
+    adparser.uuid_string(0x2A6E): ("temperature", 0.01, 0.0),     # 0.01 C
+    adparser.uuid_string(0x2A6F): ("humidity", 0.01, 0.0),        # 0.01 %
+    adparser.uuid_string(0x2A6D): ("pressure", 10.0, 0.0),        # 10 Pa
+    adparser.uuid_string(0x2BD5): ("pm1", 0.01, 0.0),             # 0.01 ug/m3
+    adparser.uuid_string(0x2BD6): ("pm25", 0.01, 0.0),
+    adparser.uuid_string(0x2BD7): ("pm10", 0.01, 0.0),
+    adparser.uuid_string(0x2AE2): ("heat", 1.0, 0.0),             # 0/1
+}
+
+# snapshot field -> (valid flag, scale)
+_SNAPSHOT_FIELDS = {
+    "temperature": (snapshot.VALID_BMP280, 0.01),
+    "pressure": (snapshot.VALID_BMP280, 1.0),
+    "humidity": (snapshot.VALID_DHT22, 0.01),
+    "heat": (snapshot.VALID_HEAT, 1.0),
+}
+for _field in snapshot.PMS_FIELDS:
+    _SNAPSHOT_FIELDS[_field] = (snapshot.VALID_PMS7003, 1.0)
+# byte offset of each reading in a snapshot (see snapshot.py), the PMS fields are u16 from 14
+_SNAPSHOT_OFFSETS = {"heat": 5, "temperature": 6, "humidity": 8, "pressure": 10}
+for _i, _field in enumerate(snapshot.PMS_FIELDS):
+    _SNAPSHOT_OFFSETS[_field] = 14 + 2 * _i
+
+if numpy is not None:
+    _SNAPSHOT_DTYPE = numpy.dtype([("timestamp", "<u4"), ("flags", "u1"), ("heat", "u1"), ("temperature", "<i2"),
+                                   ("humidity", "<u2"), ("pressure", "<u4")]
+                                  + [(field, "<u2") for field in snapshot.PMS_FIELDS])
+
+
+# Returns: (metric, value in SI-ish units) of one characteristic notification, None if unknown
+def decode_one(uuid, data):
+    entry = SCALES.get(uuid)
+    if entry is None or len(data) != 2:
+        return None
+    metric, scale, offset = entry
+    return metric, struct.unpack("<h", data)[0] * scale + offset
+
+
+class BatchDecoder:
+    # Args: scales - Characteristic UUID -> (metric, scale, offset)
+    def __init__(self, scales=SCALES):
+        self.scales = scales
+        # uuid -> (payloads bytearray, times array("d"), device indexes array("H"), payload size)
+        self._buffers = {}
+        # address -> index in devices
+        self._index = {}
+        self.devices = []
+        self.rejected = 0
+
+    # Returns: Notifications buffered
+    def __len__(self):
+        return sum(len(buffer[1]) for buffer in self._buffers.values())
+
+    # Desc: Buffers one notification, a payload of the wrong size or an unknown characteristic is counted in rejected
+    # Args: t - Arrival time (any clock, kept as float)
+    def add(self, address, uuid, data, t):
+        buffer = self._buffers.get(uuid)
+        if buffer is None:
+            if uuid == SNAPSHOT_UUID:
+                size = snapshot.SIZE
+            elif uuid in self.scales:
+                size = 2
+            else:
+                self.rejected += 1
+                return
+            buffer = self._buffers[uuid] = (bytearray(), array("d"), array("H"), size)
+        if len(data) != buffer[3]:
+            self.rejected += 1
+            return
+        device = self._index.get(address)
+        if device is None:
+            device = self._index[address] = len(self.devices)
+            self.devices.append(address)
+        buffer[0].extend(data)
+        buffer[1].append(t)
+        buffer[2].append(device)
+
+    # Desc: Decodes and clears the buffered notifications
+    # Returns: Dict of metric -> {"time", "device" (index in self.devices), "value"} columns,
+    #          the rows of the characteristics first, then the snapshot rows
+    def decode(self):
+        parts = {}
+        for uuid, (raw, times, devices, size) in self._buffers.items():
+            if uuid == SNAPSHOT_UUID:
+                for metric, columns in _snapshot_columns(raw, times, devices):
+                    if len(columns[0]):
+                        parts.setdefault(metric, []).append(columns)
+            else:
+                metric, scale, offset = self.scales[uuid]
+                parts.setdefault(metric, []).append((times, devices, _scaled(raw, scale, offset)))
+        self._buffers = {}
+        result = {}
+        for metric, columns in parts.items():
+            result[metric] = {name: _concatenate([c[k] for c in columns])
+                              for k, name in enumerate(("time", "device", "value"))}
+        return result
+
+
+def _concatenate(columns):
+    if len(columns) == 1:
+        return _typed(columns[0])
+    if numpy is not None:
+        return numpy.concatenate([_typed(c) for c in columns])
+    result = array(columns[0].typecode)
+    for c in columns:
+        result += c
+    return result
+
+
+# Desc: numpy array of an array.array when NumPy is there, else the array itself
+def _typed(column):
+    if numpy is not None and isinstance(column, array):
+        return numpy.frombuffer(column, dtype={"d": numpy.float64, "H": numpy.uint16}[column.typecode])
+    return column
+
+
+# Returns: Values of concatenated "<h" payloads, times scale plus offset
+def _scaled(raw, scale, offset):
+    if numpy is not None:
+        return numpy.frombuffer(raw, dtype="<i2") * scale + offset
+    values = array("h")
+    values.frombytes(raw)
+    if sys.byteorder == "big":
+        values.byteswap()
+    if scale == 1 and offset == 0:
+        return array("d", values)
+    return array("d", [v * scale + offset for v in values])
+
+
+# Returns: List of (metric, (times, devices, values)) of concatenated snapshot records
+def _snapshot_columns(raw, times, devices):
+    result = []
+    if numpy is not None:
+        rows = numpy.frombuffer(raw, dtype=_SNAPSHOT_DTYPE)
+        times = numpy.frombuffer(times, dtype=numpy.float64)
+        devices = numpy.frombuffer(devices, dtype=numpy.uint16)
+        flags = rows["flags"]
+        for metric, (flag, scale) in _SNAPSHOT_FIELDS.items():
+            valid = (flags & flag) != 0
+            values = rows[metric][valid].astype(numpy.float64)
+            if scale != 1:
+                values *= scale
+            result.append((metric, (times[valid], devices[valid], values)))
+        return result
+    halves = array("H")
+    halves.frombytes(raw)
+    signed = array("h")
+    signed.frombytes(raw)
+    if sys.byteorder == "big":
+        halves.byteswap()
+        signed.byteswap()
+    step = snapshot.SIZE // 2
+    columns = {"temperature": signed[3::step], "heat": raw[5::snapshot.SIZE],
+               "pressure": [lo | hi << 16 for lo, hi in zip(halves[5::step], halves[6::step])]}
+    for metric, offset in _SNAPSHOT_OFFSETS.items():
+        if metric not in columns:
+            columns[metric] = halves[offset // 2::step]
+    flags = raw[4::snapshot.SIZE]
+    # flag -> (valid rows, times, devices), None for the rows when none is left out
+    selected = {}
+    for metric, (flag, scale) in _SNAPSHOT_FIELDS.items():
+        rows = selected.get(flag)
+        if rows is None:
+            valid = [f & flag for f in flags]
+            if valid.count(0) == 0:
+                rows = selected[flag] = (None, times, devices)
+            else:
+                rows = selected[flag] = (valid, array("d", compress(times, valid)), array("H", compress(devices, valid)))
+        valid, validTimes, validDevices = rows
+        column = columns[metric]
+        if valid is not None:
+            column = compress(column, valid)
+        values = array("d", column) if scale == 1 else array("d", [v * scale for v in column])
+        result.append((metric, (validTimes, validDevices, values)))
+    return result
@@ -1,87 +1,393 @@
 import time
 import machine
+import uasyncio as asyncio
+import metrics
+import log
+from micropython import const
+
+# Set to 0 to compile the log calls out
+_LOG = const(1)
 
 UART_BUS_SEL = 1
 RX_PIN = 5
 TX_PIN = 4
 SLEEP_CRTL_PIN = 22
 
+# Frame layout: 0x42 0x4d header followed by 30 bytes of data
+FRAME_LENGTH = 32
+# Value of the frame length field (bytes 2-3) in a data frame
+_FRAME_DATA_LENGTH = 28
+# Receive ring buffer size, must be a power of two holding at least one frame
+RING_SIZE = 64
+# How often the background reader polls the UART for new bytes
+POLL_MS = 50
+
+# Operating modes. In active mode the sensor sends a frame about once per
+# second on its own, in passive mode only in response to a read command.
+MODE_ACTIVE = 0
+MODE_PASSIVE = 1
+
+# Command frames: 0x42 0x4d CMD DATAH DATAL LRCH LRCL
+_CMD_LENGTH = 7
+_CMD_READ_PASSIVE = 0xe2
+_CMD_CHANGE_MODE = 0xe1
+_CMD_SLEEP = 0xe4
+# DATAL values for _CMD_CHANGE_MODE and _CMD_SLEEP
+_MODE_DATA_PASSIVE = 0x00
+_MODE_DATA_ACTIVE = 0x01
+_SLEEP_DATA_SLEEP = 0x00
+_SLEEP_DATA_WAKEUP = 0x01
+# A passive read is answered within one frame time (32 bytes at 9600 baud)
+QUERY_TIMEOUT_MS = 500
+QUERY_POLL_MS = 10
+
+
+class UartError(Exception):
+    pass
+
+
+# Desc: Builds a command frame with its checksum
+# Args: buf - 7 byte buffer to fill, cmd - Command byte, data - Command data (DATAL)
+def commandFrame(buf, cmd, data=0):
+    buf[0] = 0x42
+    buf[1] = 0x4d
+    buf[2] = cmd
+    buf[3] = 0
+    buf[4] = data
+    checksum = 0x42 + 0x4d + cmd + data
+    buf[5] = checksum >> 8
+    buf[6] = checksum & 0xff
+    return buf
+
+
+# Reusable record holding the fields of one data frame. Readings can also be
+# accessed like the dict the driver used to return, e.g. readings["pm25"].
+class PMSReading:
+    __slots__ = ("pm1", "pm25", "pm10", "pm1env", "pm25env", "pm10env",
+                 "pbd3", "pbd5", "pbd10", "pbd25", "pbd50", "pbd100",
+                 "reserved", "checksum")
+
+    def __init__(self):
+        for field in PMSReading.__slots__:
+            setattr(self, field, 0)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return repr(self.todict())
+
+    # Desc: Updates the fields in place from a complete, validated frame
+    # Args: frame - 32 byte frame starting with the 0x42 0x4d header
+    def decode(self, frame):
+        self.pm1 = frame[4] << 8 | frame[5]
+        self.pm25 = frame[6] << 8 | frame[7]
+        self.pm10 = frame[8] << 8 | frame[9]
+        self.pm1env = frame[10] << 8 | frame[11]
+        self.pm25env = frame[12] << 8 | frame[13]
+        self.pm10env = frame[14] << 8 | frame[15]
+        self.pbd3 = frame[16] << 8 | frame[17]
+        self.pbd5 = frame[18] << 8 | frame[19]
+        self.pbd10 = frame[20] << 8 | frame[21]
+        self.pbd25 = frame[22] << 8 | frame[23]
+        self.pbd50 = frame[24] << 8 | frame[25]
+        self.pbd100 = frame[26] << 8 | frame[27]
+        self.reserved = frame[28] << 8 | frame[29]
+        self.checksum = frame[30] << 8 | frame[31]
+
+    def todict(self):
+        return {field: getattr(self, field) for field in PMSReading.__slots__}
+
+
+# Framing engine for the PMS7003 byte stream. Bytes are read from the UART with
+# readinto() straight into a preallocated ring buffer, junk is skipped with find()
+# and checksums are validated in place, so parsing allocates nothing. A frame is
+# summed and copied through preallocated views of the ring instead of byte by byte,
+# in two parts when it wraps around the end of the ring.
+class FrameParser:
+    def __init__(self, size=RING_SIZE):
+        self._ring = bytearray(size)
+        self._mask = size - 1
+        # One view per write offset, so filling the ring never slices a new memoryview
+        ringView = memoryview(self._ring)
+        self._views = [ringView[i:] for i in range(size)]
+        # Views of a whole frame at each offset it fits at, and of the first i bytes of
+        # the ring for the second part of a frame that wraps
+        self._frames = [ringView[i:i + FRAME_LENGTH] for i in range(size - FRAME_LENGTH + 1)]
+        self._heads = [ringView[:i] for i in range(FRAME_LENGTH)]
+        # A wrapped frame is put together here before it is validated
+        self._wrapped = bytearray(FRAME_LENGTH)
+        self._read = 0
+        self._write = 0
+        self._count = 0
+        # Last valid frame, contiguous
+        self.frame = bytearray(FRAME_LENGTH)
+
+        self.frames = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def reset(self):
+        self._read = 0
+        self._write = 0
+        self._count = 0
+
+    # Desc: Reads as many bytes as fit into the free part of the ring
+    # Returns: Number of bytes read
+    def fill(self, serial):
+        free = self._mask + 1 - self._count
+        if free == 0:
+            return 0
+        # Only the contiguous free space up to the end of the ring
+        n = min(free, self._mask + 1 - self._write)
+        t0 = time.ticks_us()
+        got = serial.readinto(self._views[self._write], n)
+        metrics.record(metrics.UART, t0)
+        if not got:
+            return 0
+        self._write = (self._write + got) & self._mask
+        self._count += got
+        return got
+
+    # Desc: Looks for the next valid frame in the buffered bytes and copies it to self.frame
+    # Returns: True if a frame was found
+    def next(self):
+        if self._count < FRAME_LENGTH:
+            # Nothing to parse, not timed either
+            return False
+        ring = self._ring
+        mask = self._mask
+        frame = self.frame
+        t0 = time.ticks_us()
+        while self._count >= FRAME_LENGTH:
+            r = self._read
+            if ring[r] != 0x42:
+                # Not a frame start, slide forward to the next 0x42 (or the end of the
+                # contiguous buffered bytes)
+                end = min(r + self._count, mask + 1)
+                i = ring.find(b"\x42", r + 1, end)
+                n = (i if i >= 0 else end) - r
+                self._read = (r + n) & mask
+                self._count -= n
+                self.skipped += n
+                continue
+            if (ring[(r + 1) & mask] != 0x4d or ring[(r + 2) & mask] != 0
+                    or ring[(r + 3) & mask] != _FRAME_DATA_LENGTH):
+                self._read = (r + 1) & mask
+                self._count -= 1
+                self.skipped += 1
+                continue
+            if r < len(self._frames):
+                view = self._frames[r]
+            else:
+                view = self._wrapped
+                split = mask + 1 - r
+                view[:split] = self._views[r]
+                view[split:] = self._heads[FRAME_LENGTH - split]
+            received = view[30] << 8 | view[31]
+            if sum(view) - view[30] - view[31] != received:
+                # Corrupted or partial frame, resync on the next header
+                self._read = (r + 1) & mask
+                self._count -= 1
+                self.errors += 1
+                continue
+            frame[:] = view
+            self._read = (r + FRAME_LENGTH) & mask
+            self._count -= FRAME_LENGTH
+            self.frames += 1
+            metrics.record(metrics.FRAME, t0)
+            return True
+        metrics.record(metrics.FRAME, t0)
+        return False
+
+
 class PMS7003:    
-    def __init__(self, serial, startupTime, sleepCtrlPin):
+    # Args: serial - UART connected to the sensor, startupTime - Seconds the fan needs after waking before readings are valid,
+    #       sleepCtrlPin - GPIO wired to the SET pin (None = sleep over UART), dutyPeriod - Seconds between wake-ups (0 = stay awake),
+    #       sampleTime - Seconds to keep streaming frames after the warm-up in each duty cycle (active mode),
+    #       mode - MODE_ACTIVE or MODE_PASSIVE
+    def __init__(self, serial, startupTime, sleepCtrlPin, dutyPeriod=0, sampleTime=5, mode=MODE_ACTIVE):
         self.serial = serial
+        self.mode = mode
         self.sensorState = False
         self.startupTime = startupTime
         self.sleepCtrlPin = sleepCtrlPin
+        self.dutyPeriod = dutyPeriod
+        self.sampleTime = sampleTime
 
-    # Desc: Updates sensor data on readings variable
-    # Args: data - Data read from sensor
-    def parseData(self, data, readings):
-        readings["pm1"] = data[2] << 8 | data[3]
-        readings["pm25"] = data[4] << 8 | data[5]
-        readings["pm10"] = data[6] << 8 | data[7]
-        readings["pm1env"] = data[8] << 8 | data[9]
-        readings["pm25env"] = data[10] << 8 | data[11]
-        readings["pm10env"] = data[12] << 8 | data[13]
-        readings["pbd3"] = data[14] << 8 | data[15]
-        readings["pbd5"] = data[16] << 8 | data[17]
-        readings["pbd10"] = data[18] << 8 | data[19]
-        readings["pbd25"] = data[20] << 8 | data[21]
-        readings["pbd50"] = data[22] << 8 | data[23]
-        readings["pbd100"] = data[24] << 8 | data[25]
-        readings["reserved"] = data[26] << 8 | data[27]
-        readings["checksum"] = data[28] << 8 | data[29]
-        readings["error"] = 0
-
-        # Checksum calculation
-        checksum = 0x42 + 0x4d
-        for i in range(0, 27):
-            checksum += data[i]
-        
-        if checksum != readings['checksum']:
-            readings['error'] = 1
-        
+        # Updated in place on every accepted frame
+        self.readings = PMSReading()
+        self._hasReading = False
+        self._readingTs = 0
+        self._wakeTs = 0
+        self._parser = FrameParser()
+        self._frameEvent = asyncio.Event()
+        self._cmdBuffer = bytearray(_CMD_LENGTH)
+        # query() resets the shared parser, so run() and read() take turns
+        self._queryLock = asyncio.Lock()
 
     # Desc: Turn sensor on or off
     # Args: state - true = on, false = off
     def setSensorState(self, state): 
-        print("sensor: ", state)
-        sleepControl = machine.Pin(self.sleepCtrlPin, machine.Pin.OUT)
-
-        if state:
-            sleepControl.on()
+        if _LOG:
+            log.debug("pms7003 sensor %s", state)
+        if self.sleepCtrlPin is None:
+            self.setSleepCommand(state)
         else:
-            sleepControl.off()
+            sleepControl = machine.Pin(self.sleepCtrlPin, machine.Pin.OUT)
+            if state:
+                sleepControl.on()
+            else:
+                sleepControl.off()
+
+        if state and not self.sensorState:
+            self._wakeTs = time.ticks_ms()
+        self.sensorState = state
 
     def setStartupTime(self, newStartupTime):
         self.startupTime = newStartupTime
 
+    # Desc: Sends a command frame. Responses to mode/sleep commands are 8 byte
+    #       frames that the frame parser skips, so they are not waited for.
+    def _command(self, cmd, data=0):
+        buf = commandFrame(self._cmdBuffer, cmd, data)
+        if self.serial.write(buf) != _CMD_LENGTH:
+            raise UartError('Failed to write to UART')
+
+    # Desc: Switches the sensor between active and passive mode
+    # Args: mode - MODE_ACTIVE or MODE_PASSIVE
+    def setMode(self, mode):
+        self._command(_CMD_CHANGE_MODE, _MODE_DATA_PASSIVE if mode == MODE_PASSIVE else _MODE_DATA_ACTIVE)
+        self.mode = mode
+
+    # Desc: Puts the sensor to sleep or wakes it up over UART, for boards without the SET pin wired
+    def setSleepCommand(self, state):
+        self._command(_CMD_SLEEP, _SLEEP_DATA_WAKEUP if state else _SLEEP_DATA_SLEEP)
+
+    # Desc: Requests a frame in passive mode and waits for the answer without blocking.
+    #       Concurrent callers are served one after the other.
+    # Returns: readings, or None if the sensor did not answer within timeout_ms
+    async def query(self, timeout_ms=QUERY_TIMEOUT_MS):
+        parser = self._parser
+        async with self._queryLock:
+            parser.reset()
+            self._command(_CMD_READ_PASSIVE)
+            start = time.ticks_ms()
+            while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+                parser.fill(self.serial)
+                if parser.next():
+                    self._accept()
+                    return self.readings
+                await asyncio.sleep_ms(QUERY_POLL_MS)
+        return None
+
+    # Desc: Latest readings, queried from the sensor first when in passive mode and warmed up
+    # Returns: (readings, age in ms) like latest()
+    async def read(self):
+        if self.mode == MODE_PASSIVE and self.isWarm():
+            await self.query()
+        return self.latest()
+
+    # Desc: Reads one frame from the sensor, which must already be awake
+    # Returns: readings, or -1 if no valid frame arrived within timeout_ms
+    def readFrame(self, timeout_ms=3000):
+        if self.mode == MODE_PASSIVE:
+            self._parser.reset()
+            self._command(_CMD_READ_PASSIVE)
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            self._parser.fill(self.serial)
+            if self._parser.next():
+                self._accept()
+                return self.readings
+            time.sleep_ms(POLL_MS)
+        return -1
+
     # Desc: Turns on sensor, waits 30 seconds for startup, then reads sensor data into the provided 'readings' variable
     # Args: serial - Serial connection eg. serial.Serial("/dev/ttyS0", 9600), readings - Object to put readings into, warmUpTime - Time to wait for sensor to wake from sleep
     def readAirQuality(self):
         self.setSensorState(True)
         for i in range(self.startupTime):
-            print("Sleeping... %d/%d seconds elapsed" % (i, self.startupTime))
+            if _LOG:
+                log.debug("pms7003 warming up %d/%d s", i, self.startupTime)
             time.sleep(1)
-        
-    #     first two bytes returned by sensor are 0x42 followed by 0x4d. Next 30 bytes are data
-        tryCounter = -1
-        while True:
-            tryCounter += 1
-            if ord(self.serial.read(1)) == 0x42:
-                if ord(self.serial.read(1)) == 0x4d:
-                    break
-            else:
-                if tryCounter <= 128:
-                    continue
-                else:
-                    return -1
-
-        sensorData = self.serial.read(30)
-        readings = {}
-        self.parseData(sensorData, readings)
+
+        readings = self.readFrame()
         self.setSensorState(False)
         return readings
 
+    # Desc: True once the sensor has been awake for longer than its startup time
+    def isWarm(self):
+        return self.sensorState and time.ticks_diff(time.ticks_ms(), self._wakeTs) >= self.startupTime * 1000
+
+    # Desc: Returns the most recent valid readings without touching the sensor
+    # Returns: (readings, age in ms), or (None, None) if no frame has been received yet
+    def latest(self):
+        if not self._hasReading:
+            return None, None
+        return self.readings, time.ticks_diff(time.ticks_ms(), self._readingTs)
+
+    # Desc: Waits for the next valid frame (about 1 Hz while the sensor is awake)
+    async def nextFrame(self):
+        self._frameEvent.clear()
+        await self._frameEvent.wait()
+        return self.readings
+
+    # Desc: Averages the standard PM fields over the next 'count' frames
+    async def average(self, count):
+        totals = {"pm1": 0, "pm25": 0, "pm10": 0}
+        for i in range(count):
+            readings = await self.nextFrame()
+            for key in totals:
+                totals[key] += readings[key]
+        for key in totals:
+            totals[key] /= count
+        return totals
+
+    def _accept(self):
+        self.readings.decode(self._parser.frame)
+        self._hasReading = True
+        self._readingTs = time.ticks_ms()
+        self._frameEvent.set()
+
+    # Desc: Parses frames as they arrive for duration_ms (None = forever)
+    async def _stream(self, duration_ms=None):
+        parser = self._parser
+        start = time.ticks_ms()
+        while duration_ms is None or time.ticks_diff(time.ticks_ms(), start) < duration_ms:
+            if parser.fill(self.serial):
+                while parser.next():
+                    # Frames sent during the fan warm-up are not accurate
+                    if self.isWarm():
+                        self._accept()
+            else:
+                await asyncio.sleep_ms(POLL_MS)
+
+    # Desc: Background reader. In active mode it keeps the sensor streaming, or wakes
+    #       it every dutyPeriod seconds for the warm-up plus sampleTime and then sleeps it
+    #       again. In passive mode frames are only requested by read(); with a duty
+    #       cycle one frame is queried at the end of each warm-up.
+    async def run(self):
+        while True:
+            self.setSensorState(True)
+            start = time.ticks_ms()
+            if self.mode == MODE_PASSIVE:
+                # The mode is re-sent after every wake-up in case the sensor was power cycled
+                self.setMode(MODE_PASSIVE)
+                if not self.dutyPeriod:
+                    return
+                await asyncio.sleep(self.startupTime)
+                await self.query()
+            else:
+                if not self.dutyPeriod:
+                    await self._stream()
+                await self._stream((self.startupTime + self.sampleTime) * 1000)
+                # query() resets the parser itself, under its lock
+                self._parser.reset()
+            self.setSensorState(False)
+            remaining = self.dutyPeriod * 1000 - time.ticks_diff(time.ticks_ms(), start)
+            if remaining > 0:
+                await asyncio.sleep_ms(remaining)
 
 if __name__ == '__main__':
     uart = machine.UART(UART_BUS_SEL, baudrate=9600, bits=8, parity=None, stop=1, tx=machine.Pin(TX_PIN), rx=machine.Pin(RX_PIN))
@@ -0,0 +1,189 @@
+# Batched GATT publishing with change detection and a notification policy.
+#
+# Every characteristic gets a preallocated value buffer that new readings are
+# packed into with struct.pack_into, plus a copy of the last value written to
+# the GATT database. Sensor tasks stage all the values of one snapshot and
+# then flush once: only characteristics whose encoded bytes changed are
+# written, and their notifications are sent together per connection.
+#
+# Notifications additionally follow a per-characteristic policy:
+#   min_interval_ms - never notify more often than this
+#   max_interval_ms - heartbeat, notify at least this often (0 = never)
+#   deadband - change of the encoded value needed to notify, in the units
+#              of the characteristic (e.g. 5 = 0.05 C for temperature x100)
+# A change that arrives inside the minimum interval is held back and sent by
+# run() once the interval has passed. A value staged with force=True (a
+# reading a central asked for) is notified on the next flush regardless.
+
+import struct
+import time
+import uasyncio as asyncio
+import metrics
+
+# How often run() checks for held back notifications and heartbeats
+TICK_MS = 1000
+
+
+class GattPublisher:
+    # Args: ble - bluetooth.BLE instance, connections - Set of connected central handles (kept up to date by the owner)
+    def __init__(self, ble, connections):
+        self._ble = ble
+        self._connections = connections
+        self._index = {}
+        self._handles = []
+        self._formats = []
+        self._buffers = []
+        self._published = []
+        self._dirty = bytearray(0)
+        self._dirtyCount = 0
+
+        # notification policy and state
+        self._minMs = []
+        self._maxMs = []
+        self._deadband = []
+        self._value = []
+        self._notifiedValue = []
+        self._notifiedMs = []
+        self._pending = bytearray(0)
+        self._forced = bytearray(0)
+        self._due = bytearray(0)
+
+        self.writes = 0
+        self.notifies = 0
+        self.skipped = 0
+
+    # Desc: Registers a characteristic
+    # Args: name - Key used by stage(), handle - GATT value handle, fmt - struct format of the value,
+    #       min_interval_ms, max_interval_ms, deadband - Notification policy, see above
+    def add(self, name, handle, fmt="<h", min_interval_ms=0, max_interval_ms=0, deadband=0):
+        self._index[name] = len(self._handles)
+        self._handles.append(handle)
+        self._formats.append(fmt)
+        size = struct.calcsize(fmt)
+        self._buffers.append(bytearray(size))
+        self._published.append(None)
+        self._minMs.append(min_interval_ms)
+        self._maxMs.append(max_interval_ms)
+        self._deadband.append(deadband)
+        self._value.append(0)
+        self._notifiedValue.append(0)
+        self._notifiedMs.append(None)
+        count = len(self._handles)
+        self._dirty = bytearray(count)
+        self._pending = bytearray(count)
+        self._forced = bytearray(count)
+        self._due = bytearray(count)
+
+    def handle(self, name):
+        return self._handles[self._index[name]]
+
+    # Desc: Changes the notification policy of a characteristic at runtime, None keeps a setting
+    def set_policy(self, name, min_interval_ms=None, max_interval_ms=None, deadband=None):
+        i = self._index[name]
+        if min_interval_ms is not None:
+            self._minMs[i] = min_interval_ms
+        if max_interval_ms is not None:
+            self._maxMs[i] = max_interval_ms
+        if deadband is not None:
+            self._deadband[i] = deadband
+
+    def policy(self, name):
+        i = self._index[name]
+        return self._minMs[i], self._maxMs[i], self._deadband[i]
+
+    # Desc: Last value staged for a characteristic, None until it has been flushed once
+    def value(self, name):
+        i = self._index[name]
+        if self._published[i] is None:
+            return None
+        return self._value[i]
+
+    # Desc: Packs a new value for a characteristic, marking it for the next flush if its bytes changed
+    # Args: force - Notify on the next flush even if the value did not change or the minimum interval has not passed
+    # Returns: True if the encoded value differs from the last published one
+    def stage(self, name, value, force=False):
+        i = self._index[name]
+        buf = self._buffers[i]
+        struct.pack_into(self._formats[i], buf, 0, value)
+        self._value[i] = value
+        # significant change since the last notification
+        self._pending[i] = self._notifiedMs[i] is None or \
+            abs(value - self._notifiedValue[i]) >= (self._deadband[i] or 1)
+        if force:
+            self._forced[i] = 1
+        published = self._published[i]
+        if published is not None and published == buf:
+            if not self._dirty[i]:
+                self.skipped += 1
+            return False
+        if not self._dirty[i]:
+            self._dirty[i] = 1
+            self._dirtyCount += 1
+        return True
+
+    def _isDue(self, i, now):
+        if self._published[i] is None:
+            return False
+        if self._notifiedMs[i] is None or self._forced[i]:
+            return True
+        elapsed = time.ticks_diff(now, self._notifiedMs[i])
+        if self._pending[i] and elapsed >= self._minMs[i]:
+            return True
+        return self._maxMs[i] and elapsed >= self._maxMs[i]
+
+    # Desc: Writes every changed characteristic to the GATT database, then notifies
+    #       (or indicates) connected centrals of those whose policy allows it
+    # Returns: Number of characteristics notified
+    def flush(self, notify=True, indicate=False):
+        ble = self._ble
+        dirty = self._dirty
+        due = self._due
+        if self._dirtyCount:
+            for i in range(len(dirty)):
+                if dirty[i]:
+                    buf = self._buffers[i]
+                    ble.gatts_write(self._handles[i], buf)
+                    published = self._published[i]
+                    if published is None:
+                        self._published[i] = bytearray(buf)
+                    else:
+                        for j in range(len(buf)):
+                            published[j] = buf[j]
+                    dirty[i] = 0
+                    self.writes += 1
+            self._dirtyCount = 0
+        if not (notify or indicate) or not self._connections:
+            return 0
+
+        now = time.ticks_ms()
+        count = 0
+        for i in range(len(due)):
+            if self._isDue(i, now):
+                due[i] = 1
+                count += 1
+        if not count:
+            return 0
+        for conn_handle in self._connections:
+            for i in range(len(due)):
+                if due[i]:
+                    t0 = time.ticks_us()
+                    if notify:
+                        ble.gatts_notify(conn_handle, self._handles[i])
+                    if indicate:
+                        ble.gatts_indicate(conn_handle, self._handles[i])
+                    metrics.record(metrics.NOTIFY, t0)
+                    self.notifies += 1
+        for i in range(len(due)):
+            if due[i]:
+                due[i] = 0
+                self._pending[i] = 0
+                self._forced[i] = 0
+                self._notifiedValue[i] = self._value[i]
+                self._notifiedMs[i] = now
+        return count
+
+    # Desc: Sends held back notifications and heartbeats
+    async def run(self):
+        while True:
+            await asyncio.sleep_ms(TICK_MS)
+            self.flush()
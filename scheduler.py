@@ -0,0 +1,136 @@
+# Cooperative acquisition scheduler.
+#
+# Every sensor gets its own uasyncio task that samples on a fixed cadence and
+# hands the result to a publish callback. A refresh can be requested from the
+# BLE IRQ handler with request(), which only sets a flag so the IRQ returns
+# immediately; the sensor task wakes up and does the actual (slow) read.
+# Requests are never dropped: one that comes within min_request_ms of the
+# last reading is served once that time has passed, together with any other
+# request made meanwhile.
+
+import time
+import uasyncio as asyncio
+import log
+from micropython import const
+
+# Set to 0 to compile the log calls out
+_LOG = const(1)
+
+
+class SensorTask:
+    def __init__(self, name, read, interval_ms, publish, min_request_ms=0):
+        self.name = name
+        self.read = read
+        self.interval_ms = interval_ms
+        self.publish = publish
+        # requests within this long after the last reading wait for the end of it
+        self.min_request_ms = min_request_ms
+        self.flag = asyncio.ThreadSafeFlag()
+        self.pending = False
+        self.requested_ms = 0
+        self.last_read_ms = 0
+        self.last_latency_ms = 0
+        self.value = None
+        self.errors = 0
+        self.deferred = 0
+
+
+class AcquisitionScheduler:
+    def __init__(self):
+        self._tasks = {}
+        self._services = []
+        self._running = []
+
+    # Desc: Registers a sensor task
+    # Args: name - Key used by request(), read - Function or coroutine function returning a reading,
+    #       interval_ms - Sampling cadence (0 = only on request), publish - Called as publish(name, value),
+    #       min_request_ms - Minimum time between a reading and a requested refresh
+    def add(self, name, read, interval_ms, publish, min_request_ms=0):
+        task = SensorTask(name, read, interval_ms, publish, min_request_ms)
+        self._tasks[name] = task
+        return task
+
+    # Desc: Registers a long-running coroutine function (e.g. a driver's background reader)
+    #       that is started and stopped together with the sensor tasks
+    def add_service(self, run):
+        self._services.append(run)
+
+    def task(self, name):
+        return self._tasks[name]
+
+    # Desc: Changes a task's cadence or request rate limit at runtime, None keeps a setting
+    def set_rate(self, name, interval_ms=None, min_request_ms=None):
+        task = self._tasks[name]
+        if interval_ms is not None:
+            task.interval_ms = interval_ms
+        if min_request_ms is not None:
+            task.min_request_ms = min_request_ms
+
+    # Desc: Asks for a fresh reading of a sensor. Safe to call from the BLE IRQ.
+    #       Served once the last reading is min_request_ms old, requests until then share one reading.
+    def request(self, name):
+        task = self._tasks[name]
+        if not task.pending:
+            task.pending = True
+            task.requested_ms = time.ticks_ms()
+            if task.last_read_ms and time.ticks_diff(task.requested_ms, task.last_read_ms) < task.min_request_ms:
+                task.deferred += 1
+        task.flag.set()
+
+    async def _sample(self, task):
+        try:
+            value = task.read()
+            if hasattr(value, "send"):
+                value = await value
+        except Exception as e:
+            task.errors += 1
+            if _LOG:
+                log.error("%s read error: %s", task.name, e)
+            return
+        task.last_read_ms = time.ticks_ms()
+        task.value = value
+        if value is not None:
+            try:
+                task.publish(task.name, value)
+            except Exception as e:
+                # a value the publisher cannot encode must not end the task
+                task.errors += 1
+                if _LOG:
+                    log.error("%s publish error: %s", task.name, e)
+        if task.pending:
+            # A request that arrived while reading is served by this reading.
+            task.pending = False
+            task.flag.clear()
+            task.last_latency_ms = time.ticks_diff(time.ticks_ms(), task.requested_ms)
+
+    async def _loop(self, task):
+        while True:
+            await self._sample(task)
+            try:
+                if task.interval_ms:
+                    await asyncio.wait_for_ms(task.flag.wait(), task.interval_ms)
+                else:
+                    await task.flag.wait()
+            except asyncio.TimeoutError:
+                pass
+            if task.pending:
+                wait = task.min_request_ms - time.ticks_diff(time.ticks_ms(), task.last_read_ms)
+                if task.last_read_ms and wait > 0:
+                    await asyncio.sleep_ms(wait)
+
+    # Desc: Starts the services and one uasyncio task per registered sensor
+    def start(self):
+        for run in self._services:
+            self._running.append(asyncio.create_task(run()))
+        for task in self._tasks.values():
+            self._running.append(asyncio.create_task(self._loop(task)))
+
+    def stop(self):
+        for t in self._running:
+            t.cancel()
+        self._running = []
+
+    async def run(self):
+        self.start()
+        while True:
+            await asyncio.sleep_ms(60000)
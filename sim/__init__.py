@@ -0,0 +1,55 @@
+# Host-side stand-ins for the MicroPython modules used by the firmware.
+#
+# Call install() before importing any firmware module so that
+# `import machine`, `import bluetooth`, `import uasyncio`, ... resolve to the
+# stand-ins in this package and the MicroPython-only helpers in `time`
+# (ticks_ms, ticks_diff, sleep_ms, ...) exist under CPython.
+#
+# The hardware behind the stand-ins is modelled in sim.devices (BMP280
+# register map, PMS7003 UART stream, DHT22, onboard temperature ADC), and
+# sim.central provides an in-process BLE central for the sim.bluetooth
+# peripheral. `python -m sim.run` runs the unmodified main.demo().
+# sim.fakeble is a fake bleak backend with any number of simulated sensors
+# for load-testing gateway.py; it needs no install().
+
+import sys
+import time
+
+_MODULES = ("machine", "bluetooth", "dht", "micropython", "ubinascii", "ustruct", "uasyncio")
+
+_T0 = time.monotonic_ns()
+
+
+def _ticks_ms():
+    return (time.monotonic_ns() - _T0) // 1000000
+
+
+def _ticks_us():
+    return (time.monotonic_ns() - _T0) // 1000
+
+
+def _ticks_diff(new, old):
+    return new - old
+
+
+def _ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def _patch_time():
+    # CPython ticks never wrap, so plain integer arithmetic is fine here.
+    if not hasattr(time, "ticks_ms"):
+        time.ticks_ms = _ticks_ms
+        time.ticks_us = _ticks_us
+        time.ticks_diff = _ticks_diff
+        time.ticks_add = _ticks_add
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+        time.sleep_us = lambda us: time.sleep(us / 1000000)
+
+
+def install():
+    _patch_time()
+    for name in _MODULES:
+        if name not in sys.modules:
+            module = __import__("sim." + name, fromlist=[name])
+            sys.modules[name] = module
@@ -0,0 +1,189 @@
+# Stand-in for the MicroPython `bluetooth` module.
+#
+# BLE() is a singleton like on the board. It keeps a GATT database and
+# delivers IRQs for connections and writes made by sim.central.Central
+# objects, which receive its notifications in-process.
+
+FLAG_BROADCAST = 0x0001
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+_IRQ_CENTRAL_CONNECT = 1
+_IRQ_CENTRAL_DISCONNECT = 2
+_IRQ_GATTS_WRITE = 3
+_IRQ_GATTS_INDICATE_DONE = 20
+_IRQ_MTU_EXCHANGED = 21
+
+MAC = b"\x28\xcd\xc1\x00\x00\x01"
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, int):
+            self._bytes = value.to_bytes(2, "little")
+        elif isinstance(value, str):
+            self._bytes = bytes.fromhex(value.replace("-", ""))[::-1]
+        elif isinstance(value, UUID):
+            self._bytes = value._bytes
+        else:
+            self._bytes = bytes(value)
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._bytes == other._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) == 2:
+            return "UUID(0x%04x)" % int.from_bytes(self._bytes, "little")
+        return "UUID(%r)" % self._bytes[::-1].hex()
+
+
+class BLE:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._reset()
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        """Drops the singleton, e.g. between benchmark runs."""
+        cls._instance = None
+
+    def _reset(self):
+        self._active = False
+        self._irq = None
+        self._values = {}
+        self._uuids = {}
+        self._next_handle = 1
+        self._next_conn = 64
+        self._centrals = {}
+        self._mtu = 23
+        self._connMtu = {}
+        self.adv_data = None
+        self.resp_data = None
+        self.advertising = False
+        self.adv_count = 0
+        self.notify_count = 0
+
+    def active(self, active=None):
+        if active is not None:
+            self._active = bool(active)
+        return self._active
+
+    def irq(self, handler):
+        self._irq = handler
+
+    def config(self, param=None, **kwargs):
+        if "mtu" in kwargs:
+            self._mtu = kwargs["mtu"]
+        if param is None:
+            return None
+        if param == "mac":
+            return (0, MAC)
+        if param == "mtu":
+            return self._mtu
+        raise ValueError(param)
+
+    def gatts_register_services(self, services_definition):
+        handles = []
+        for service_uuid, characteristics in services_definition:
+            service_handles = []
+            for characteristic in characteristics:
+                # declaration handle, then value handle
+                self._next_handle += 1
+                self._values[self._next_handle] = b""
+                self._uuids[self._next_handle] = characteristic[0]
+                service_handles.append(self._next_handle)
+                self._next_handle += 1
+            handles.append(tuple(service_handles))
+        return tuple(handles)
+
+    def gatts_read(self, value_handle):
+        return self._values[value_handle]
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        self._values[value_handle] = bytes(data)
+        if send_update:
+            for conn_handle in list(self._centrals):
+                self.gatts_notify(conn_handle, value_handle)
+
+    def gatts_set_buffer(self, value_handle, len, append=False):
+        pass
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        central = self._centrals.get(conn_handle)
+        if central is None:
+            raise OSError(128)  # ENOTCONN
+        self.notify_count += 1
+        data = self._values[value_handle] if data is None else data
+        # notifications carry at most ATT_MTU - 3 bytes
+        central._notified(value_handle, bytes(data[:self._connMtu.get(conn_handle, 23) - 3]))
+
+    def gatts_indicate(self, conn_handle, value_handle, data=None):
+        self.gatts_notify(conn_handle, value_handle, data)
+        if self._irq:
+            self._irq(_IRQ_GATTS_INDICATE_DONE, (conn_handle, value_handle, 0))
+
+    def gap_advertise(self, interval_us, adv_data=None, *, resp_data=None, connectable=True):
+        self.advertising = interval_us is not None
+        if adv_data is not None:
+            self.adv_data = bytes(adv_data)
+        if resp_data is not None:
+            self.resp_data = bytes(resp_data)
+        self.adv_count += 1
+        if self.advertising and connectable:
+            for central in list(self._waiting()):
+                central.connect(self)
+
+    def _waiting(self):
+        from sim.central import Central
+        return list(Central.waiting)
+
+    def gap_disconnect(self, conn_handle):
+        central = self._centrals.pop(conn_handle, None)
+        self._connMtu.pop(conn_handle, None)
+        if central is None:
+            return False
+        central._disconnected()
+        if self._irq:
+            self._irq(_IRQ_CENTRAL_DISCONNECT, (conn_handle, 0, MAC))
+        return True
+
+    # Called by sim.central.Central
+
+    def _connect(self, central):
+        conn_handle = self._next_conn
+        self._next_conn += 1
+        self._centrals[conn_handle] = central
+        self.advertising = False
+        if self._irq:
+            self._irq(_IRQ_CENTRAL_CONNECT, (conn_handle, 0, central.addr))
+        return conn_handle
+
+    def _disconnect(self, conn_handle):
+        self._connMtu.pop(conn_handle, None)
+        if self._centrals.pop(conn_handle, None) is not None and self._irq:
+            self._irq(_IRQ_CENTRAL_DISCONNECT, (conn_handle, 0, MAC))
+
+    def _exchange_mtu(self, conn_handle, mtu):
+        mtu = min(mtu, self._mtu)
+        self._connMtu[conn_handle] = mtu
+        if self._irq:
+            self._irq(_IRQ_MTU_EXCHANGED, (conn_handle, mtu))
+        return mtu
+
+    def _write(self, conn_handle, value_handle, data):
+        self._values[value_handle] = bytes(data)
+        if self._irq:
+            self._irq(_IRQ_GATTS_WRITE, (conn_handle, value_handle))
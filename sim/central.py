@@ -0,0 +1,65 @@
+# In-process BLE central for the sim.bluetooth peripheral.
+#
+#   central = Central(on_notify=print)
+#   central.connect(bluetooth.BLE())   # or Central(wait=True) to connect
+#                                      # as soon as the peripheral advertises
+#   central.write(central.handle(0x2A6E), b"\x00\x00")
+
+import time
+
+from sim import bluetooth
+
+
+class Central:
+    # centrals that connect on the peripheral's next gap_advertise() (once)
+    waiting = []
+
+    def __init__(self, on_notify=None, wait=False, addr=b"\x00\x11\x22\x33\x44\x55"):
+        self.on_notify = on_notify
+        self.addr = addr
+        self.peripheral = None
+        self.conn_handle = None
+        # (time.perf_counter(), value handle, data) of every notification
+        self.notifications = []
+        self.connects = 0
+        if wait:
+            Central.waiting.append(self)
+
+    def connect(self, peripheral):
+        if self in Central.waiting:
+            Central.waiting.remove(self)
+        self.peripheral = peripheral
+        self.conn_handle = peripheral._connect(self)
+        self.connects += 1
+        return self.conn_handle
+
+    def disconnect(self):
+        if self.conn_handle is not None:
+            self.peripheral._disconnect(self.conn_handle)
+            self.conn_handle = None
+
+    def handle(self, uuid):
+        """Value handle of the characteristic with this UUID (int or bluetooth.UUID)."""
+        uuid = bluetooth.UUID(uuid)
+        for handle, candidate in self.peripheral._uuids.items():
+            if candidate == uuid:
+                return handle
+        raise KeyError(uuid)
+
+    def exchange_mtu(self, mtu=247):
+        """Negotiates the ATT MTU, returns the agreed one."""
+        return self.peripheral._exchange_mtu(self.conn_handle, mtu)
+
+    def read(self, value_handle):
+        return self.peripheral.gatts_read(value_handle)
+
+    def write(self, value_handle, data):
+        self.peripheral._write(self.conn_handle, value_handle, data)
+
+    def _notified(self, value_handle, data):
+        self.notifications.append((time.perf_counter(), value_handle, data))
+        if self.on_notify:
+            self.on_notify(value_handle, data)
+
+    def _disconnected(self):
+        self.conn_handle = None
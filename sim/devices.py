@@ -0,0 +1,285 @@
+# Models of the hardware attached to the Pico, used by the sim stand-ins.
+#
+# The module-level `world` holds one model per device. The machine and dht
+# stand-ins look their device up here, so a host script can change readings,
+# noise and timing before or while the firmware runs:
+#
+#   import sim; sim.install()
+#   from sim.devices import world
+#   world.bmp280.set_conditions(18.5, 99500)
+#   world.pms7003.pm25 = 40
+
+import random
+import struct
+import time
+
+BMP280_ADDR = 0x76
+BMP280_CHIP_ID = 0x58
+PMS7003_SET_PIN = 22
+ONBOARD_TEMP_ADC = 4
+
+# BMP280 calibration and raw readings from the datasheet example
+BMP280_TEST_CALIBRATION = (27504, 26435, -1000, 36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+BMP280_TEST_T_RAW = 519888
+BMP280_TEST_P_RAW = 415148
+
+# osrs_x register value -> number of samples
+_BMP280_OVERSAMPLING = (0, 1, 2, 4, 8, 16, 16, 16)
+
+
+def _now_ms():
+    return time.monotonic() * 1000
+
+
+class BMP280Model:
+    """Register map of a BMP280: calibration block, chip id, ctrl/config with
+    register/data pair writes, soft reset, forced and normal mode conversions
+    with the datasheet measurement time, and the status measuring bit."""
+
+    def __init__(self, calibration=BMP280_TEST_CALIBRATION):
+        self.regs = bytearray(256)
+        self.calibration = calibration
+        self.regs[0x88:0xA0] = struct.pack("<HhhHhhhhhhhh", *calibration)
+        self.regs[0xD0] = BMP280_CHIP_ID
+        self.t_raw = BMP280_TEST_T_RAW
+        self.p_raw = BMP280_TEST_P_RAW
+        # standard deviation of the noise added to each conversion, in raw counts
+        self.noise = 0
+        self._conversion_end = None
+        self.conversions = 0
+        self.reads = 0
+        self.writes = 0
+        self._rng = random.Random(0)
+
+    # compensation from the datasheet (64-bit version), used to find raw values
+    def _t_fine(self, t_raw):
+        T1, T2, T3 = self.calibration[:3]
+        var1 = (((t_raw >> 3) - (T1 << 1)) * T2) >> 11
+        var2 = (((((t_raw >> 4) - T1) * ((t_raw >> 4) - T1)) >> 12) * T3) >> 14
+        return var1 + var2
+
+    def _pressure(self, t_fine, p_raw):
+        P1, P2, P3, P4, P5, P6, P7, P8, P9 = self.calibration[3:]
+        var1 = t_fine - 128000
+        var2 = var1 * var1 * P6
+        var2 = var2 + ((var1 * P5) << 17)
+        var2 = var2 + (P4 << 35)
+        var1 = ((var1 * var1 * P3) >> 8) + ((var1 * P2) << 12)
+        var1 = (((1 << 47) + var1) * P1) >> 33
+        if var1 == 0:
+            return 0
+        p = 1048576 - p_raw
+        p = (((p << 31) - var2) * 3125) // var1
+        var1 = (P9 * (p >> 13) * (p >> 13)) >> 25
+        var2 = (P8 * p) >> 19
+        return (((p + var1 + var2) >> 8) + (P7 << 4)) / 256
+
+    def set_conditions(self, temperature, pressure):
+        """Sets the raw readings that compensate to temperature (C) and pressure (Pa)."""
+        lo, hi = 0, (1 << 20) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ((self._t_fine(mid) * 5 + 128) >> 8) < temperature * 100:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.t_raw = lo
+        t_fine = self._t_fine(lo)
+        # pressure falls as the raw value rises
+        lo, hi = 0, (1 << 20) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._pressure(t_fine, mid) > pressure:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.p_raw = lo
+
+    def _measurement_ms(self):
+        ctrl = self.regs[0xF4]
+        t_os = _BMP280_OVERSAMPLING[ctrl >> 5]
+        p_os = _BMP280_OVERSAMPLING[(ctrl >> 2) & 0x07]
+        return 1.25 + 2.3 * t_os + (2.3 * p_os + 0.575 if p_os else 0)
+
+    def _store_sample(self):
+        t_raw = self.t_raw
+        p_raw = self.p_raw
+        if self.noise:
+            t_raw += int(self._rng.gauss(0, self.noise))
+            p_raw += int(self._rng.gauss(0, self.noise))
+        t_raw = min(max(t_raw, 0), (1 << 20) - 1)
+        p_raw = min(max(p_raw, 0), (1 << 20) - 1)
+        self.regs[0xF7] = p_raw >> 12
+        self.regs[0xF8] = (p_raw >> 4) & 0xFF
+        self.regs[0xF9] = (p_raw & 0x0F) << 4
+        self.regs[0xFA] = t_raw >> 12
+        self.regs[0xFB] = (t_raw >> 4) & 0xFF
+        self.regs[0xFC] = (t_raw & 0x0F) << 4
+        self.conversions += 1
+
+    def _update(self):
+        mode = self.regs[0xF4] & 0x03
+        if self._conversion_end is not None and _now_ms() >= self._conversion_end:
+            self._conversion_end = None
+            self._store_sample()
+            if mode == 1 or mode == 2:
+                # forced mode returns to sleep after one conversion
+                self.regs[0xF4] &= 0xFC
+        elif mode == 3 and self._conversion_end is None:
+            # normal mode, treat every read as a fresh conversion
+            self._store_sample()
+        measuring = self._conversion_end is not None
+        self.regs[0xF3] = 0x08 if measuring else 0x00
+
+    def _write_reg(self, reg, value):
+        if reg == 0xE0:
+            if value == 0xB6:
+                self.regs[0xF4] = 0
+                self.regs[0xF5] = 0
+                self._conversion_end = None
+        elif reg in (0xF4, 0xF5):
+            self.regs[reg] = value
+            if reg == 0xF4 and value & 0x03 in (1, 2):
+                self._conversion_end = _now_ms() + self._measurement_ms()
+
+    def readfrom_mem(self, memaddr, nbytes):
+        self._update()
+        self.reads += 1
+        return bytes(self.regs[memaddr:memaddr + nbytes])
+
+    def writeto_mem(self, memaddr, buf):
+        # first byte goes to memaddr, the rest are (register, data) pairs
+        self.writes += 1
+        self._write_reg(memaddr, buf[0])
+        for i in range(1, len(buf) - 1, 2):
+            self._write_reg(buf[i], buf[i + 1])
+        self._update()
+
+
+class PMS7003Model:
+    """PMS7003 behind a UART: 1 Hz frames in active mode, answers to the
+    passive read command, mode/sleep command responses, sleep through the
+    SET pin, zero readings during the fan warm-up, and optional line noise."""
+
+    def __init__(self):
+        self.pm1 = 8
+        self.pm25 = 12
+        self.pm10 = 15
+        self.startup_s = 0
+        self.frame_interval_ms = 1000
+        # probability per frame of junk bytes before it / of a corrupted byte in it
+        self.junk = 0.0
+        self.corrupt = 0.0
+        self.passive = False
+        self._awake_cmd = True
+        self._wake_ms = _now_ms()
+        self._was_awake = True
+        self._next_frame_ms = _now_ms()
+        self._rng = random.Random(0)
+        self.frames = 0
+        self.commands = 0
+
+    def awake(self):
+        from sim.machine import Pin
+        awake = self._awake_cmd and Pin.level(PMS7003_SET_PIN)
+        if awake and not self._was_awake:
+            self._wake_ms = _now_ms()
+            self._next_frame_ms = self._wake_ms + self.frame_interval_ms
+        self._was_awake = awake
+        return awake
+
+    def frame(self):
+        warm = _now_ms() - self._wake_ms >= self.startup_s * 1000
+        pm1, pm25, pm10 = (self.pm1, self.pm25, self.pm10) if warm else (0, 0, 0)
+        counts = (pm1 * 60, pm1 * 20, pm25 * 5, pm25, pm10 // 4, pm10 // 10)
+        body = struct.pack(">HHHHHHHHHHHHHH", 28, pm1, pm25, pm10, pm1, pm25, pm10, *counts, 0x9700)
+        frame = bytearray(b"\x42\x4d" + body)
+        frame += struct.pack(">H", sum(frame))
+        out = bytearray()
+        if self.junk and self._rng.random() < self.junk:
+            out += bytes(self._rng.randrange(256) for i in range(self._rng.randrange(1, 8)))
+        if self.corrupt and self._rng.random() < self.corrupt:
+            frame[self._rng.randrange(4, 30)] ^= 0xFF
+        self.frames += 1
+        return out + frame
+
+    def poll(self):
+        """Bytes the sensor sent since the last poll."""
+        if not self.awake() or self.passive:
+            return b""
+        out = bytearray()
+        now = _now_ms()
+        while now >= self._next_frame_ms:
+            out += self.frame()
+            self._next_frame_ms += self.frame_interval_ms
+        return bytes(out)
+
+    def command(self, buf):
+        """Handles a command frame written to the sensor, returns its response."""
+        self.commands += 1
+        if len(buf) != 7 or buf[0] != 0x42 or buf[1] != 0x4d or sum(buf[:5]) != (buf[5] << 8 | buf[6]):
+            return b""
+        cmd, data = buf[2], buf[4]
+        if cmd == 0xe2:
+            return self.frame() if self.awake() and self.passive else b""
+        if cmd == 0xe1:
+            self.passive = data == 0
+            self._next_frame_ms = _now_ms() + self.frame_interval_ms
+        elif cmd == 0xe4:
+            self._awake_cmd = data == 1
+            if data == 1:
+                # wake-up has no response
+                self.awake()
+                return b""
+        else:
+            return b""
+        response = bytearray((0x42, 0x4d, 0x00, 0x04, cmd, data))
+        return bytes(response + struct.pack(">H", sum(response)))
+
+
+class DHT22Model:
+    def __init__(self):
+        self.temperature = 21.5
+        self.humidity = 45.0
+        self.noise = 0.0
+        # a measurement blocks for about 5 ms on the Pico
+        self.measure_ms = 5
+        self.measurements = 0
+        self._rng = random.Random(0)
+
+    def measure(self):
+        if self.measure_ms:
+            time.sleep(self.measure_ms / 1000)
+        self.measurements += 1
+        t, h = self.temperature, self.humidity
+        if self.noise:
+            t += self._rng.gauss(0, self.noise)
+            h += self._rng.gauss(0, self.noise)
+        # DHT22 resolution is 0.1
+        return round(t, 1), round(min(max(h, 0), 100), 1)
+
+
+class OnboardTemperatureModel:
+    """RP2040 internal temperature sensor: 0.706 V at 27 C, -1.721 mV/C."""
+
+    def __init__(self):
+        self.temperature = 20.0
+
+    def read_u16(self):
+        volt = 0.706 - (self.temperature - 27) * 0.001721
+        return max(0, min(65535, int(volt / 3.3 * 65535)))
+
+
+class World:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bmp280 = BMP280Model()
+        self.pms7003 = PMS7003Model()
+        self.dht22 = DHT22Model()
+        self.onboard = OnboardTemperatureModel()
+        self.i2c = {BMP280_ADDR: self.bmp280}
+
+
+world = World()
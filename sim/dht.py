@@ -0,0 +1,19 @@
+# Stand-in for the MicroPython `dht` module, backed by sim.devices.world.dht22.
+
+from sim.devices import world
+
+
+class DHT22:
+    def __init__(self, pin):
+        self.pin = pin
+        self._temperature = 0
+        self._humidity = 0
+
+    def measure(self):
+        self._temperature, self._humidity = world.dht22.measure()
+
+    def temperature(self):
+        return self._temperature
+
+    def humidity(self):
+        return self._humidity
@@ -0,0 +1,309 @@
+# Fake bleak backend for the gateway: simulated sensors on the host.
+#
+# Follows the part of bleak's API that gateway.py uses (scanner with a
+# detection callback, client with connect/start_notify/write_gatt_char and a
+# disconnected callback), so hundreds of sensors can be load-tested on any
+# machine without an adapter:
+#
+#   backend = FakeBackend.with_sensors(300, drop=0.001)
+#   gateway = Gateway(backend, max_sessions=64)
+#
+# Each sensor advertises BTHome service data and notifies a snapshot (or the
+# Environmental Sensing values, with snapshot_char=False) every notify_s while a
+# client is subscribed, and immediately after a refresh write.
+#
+# The GATT table follows the firmware's services, with handles and a GATT
+# Database Hash (0x2B2A, unless has_hash=False). Connecting takes connect_s
+# plus discover_s per service, characteristic and descriptor discovered, so
+# the cost of a full discovery against one limited to a few services
+# (services=...) shows up in the timings.
+
+import asyncio
+import hashlib
+import random
+import struct
+import time
+
+import adparser
+import bthome
+import gateway
+import gattcache
+import snapshot
+
+_VENDOR = "7a1c%04x-3d4b-4c8e-9f21-5e6d7c8b9a01"
+# service UUID -> (characteristic UUID, descriptors) of the firmware
+_GATT = (
+    (adparser.uuid_string(0x1800), ((adparser.uuid_string(0x2A00), 0), (adparser.uuid_string(0x2A01), 0))),
+    (gattcache.GENERIC_ATTRIBUTE_UUID, ((adparser.uuid_string(0x2A05), 1), (gattcache.DB_HASH_UUID, 0))),
+    (adparser.uuid_string(0x181A), tuple((uuid, 1) for uuid in gateway.CHARACTERISTICS.values())),
+    (_VENDOR % 0x0000, ((_VENDOR % 0x0001, 1),)),
+    (_VENDOR % 0x0010, ((gateway.HISTORY_UUID, 1),)),
+    (_VENDOR % 0x0020, ((gateway.SNAPSHOT_UUID, 1),)),
+)
+
+
+class FakeDevice:
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+
+class FakeAdvertisement:
+    def __init__(self, local_name, service_data):
+        self.local_name = local_name
+        self.service_data = service_data
+
+
+class FakeCharacteristic:
+    def __init__(self, uuid, handle, service_uuid):
+        self.uuid = uuid
+        self.handle = handle
+        self.service_uuid = service_uuid
+
+
+class FakeServices:
+    # Args: table - (service UUID, [FakeCharacteristic]) of the discovered services
+    def __init__(self, table):
+        self._chars = {}
+        for serviceUuid, chars in table:
+            for char in chars:
+                self._chars[char.uuid] = char
+                self._chars[char.handle] = char
+
+    # Args: specifier - UUID or handle
+    def get_characteristic(self, specifier):
+        return self._chars.get(specifier)
+
+
+class FakeSensor:
+    # Args: snapshot_char - Has the snapshot characteristic, notify_s - Time between notifications,
+    #       connect_s - Connection setup time, fail - Probability that a connection attempt fails,
+    #       drop - Probability that the link drops after a notification,
+    #       discover_s - Discovery time per attribute, has_hash - Has the GATT Database Hash,
+    #       mute - Stays connected but sends no notifications
+    def __init__(self, address, name="pico", snapshot_char=True, notify_s=1.0, connect_s=0.05, fail=0.0, drop=0.0,
+                 seed=0, discover_s=0.0, has_hash=True, mute=False):
+        self.address = address
+        self.name = name
+        self.snapshot_char = snapshot_char
+        self.notify_s = notify_s
+        self.connect_s = connect_s
+        self.fail = fail
+        self.drop = drop
+        self.discover_s = discover_s
+        self.has_hash = has_hash
+        self.mute = mute
+        self.build_gatt()
+        self._rng = random.Random(seed)
+        self._snapshot = snapshot.Snapshot()
+        self._bthome = bytearray(bthome.MAX_SIZE)
+        self._packetId = 0
+        self.temperature = 2000 + self._rng.randrange(500)
+        self.humidity = 4000 + self._rng.randrange(2000)
+        self.pressure = 101325
+        self.pm = 5
+        self.client = None
+        # Unix time last written with a set time request, None until then
+        self.clock = None
+        self.notifications = 0
+        self.connects = 0
+        self.drops = 0
+        self.update()
+
+    # Desc: Moves the readings a little and rebuilds the snapshot and broadcast
+    def update(self):
+        rng = self._rng
+        self.temperature += rng.randint(-5, 5)
+        self.humidity = max(0, min(10000, self.humidity + rng.randint(-20, 20)))
+        self.pressure += rng.randint(-10, 10)
+        self.pm = max(0, self.pm + rng.randint(-1, 1))
+        s = self._snapshot
+        s.set_time(int(time.time()))
+        s.set_bmp280(self.temperature, self.pressure)
+        s.set_dht22(self.humidity)
+        s.set_pms7003(dict.fromkeys(snapshot.PMS_FIELDS, self.pm))
+        self._packetId = (self._packetId + 1) & 0xFF
+        n = bthome.pack_into(self._bthome, s.buffer, self._packetId)
+        self.service_data = bytes(self._bthome[:n])
+
+    # Desc: Lays out the GATT table, call again after changing snapshot_char or has_hash (a firmware update)
+    def build_gatt(self):
+        self.gatt = []
+        self.attributes = {}
+        handle = 1
+        for serviceUuid, chars in _GATT:
+            handle += 1
+            self.attributes[serviceUuid] = 1
+            table = []
+            for uuid, descriptors in chars:
+                if uuid == gateway.SNAPSHOT_UUID and not self.snapshot_char:
+                    continue
+                if uuid == gattcache.DB_HASH_UUID and not self.has_hash:
+                    continue
+                # declaration, value, descriptors
+                table.append(FakeCharacteristic(uuid, handle + 1, serviceUuid))
+                handle += 2 + descriptors
+                self.attributes[serviceUuid] += 1 + descriptors
+            self.gatt.append((serviceUuid, table))
+        # the real hash is an AES-CMAC of the table, any digest of the layout does here
+        self.db_hash = hashlib.md5(repr([(s, [(c.uuid, c.handle) for c in t]) for s, t in self.gatt]).encode()).digest()
+
+    # Returns: (discovered table, attributes discovered) for a services filter
+    def discover(self, services):
+        table = [(s, chars) for s, chars in self.gatt if services is None or s in services]
+        return table, sum(self.attributes[s] for s, chars in table)
+
+    # Returns: List of (characteristic UUID, data) notified for one update
+    def values(self):
+        if self.snapshot_char:
+            return [(gateway.SNAPSHOT_UUID, bytes(self._snapshot.buffer))]
+        c = gateway.CHARACTERISTICS
+        return [(c["temperature"], struct.pack("<h", self.temperature)),
+                (c["humidity"], struct.pack("<h", self.humidity)),
+                (c["pressure"], struct.pack("<h", (self.pressure + 5) // 10)),
+                (c["PM1"], struct.pack("<h", self.pm * 100)),
+                (c["PM25"], struct.pack("<h", self.pm * 100)),
+                (c["PM10"], struct.pack("<h", self.pm * 100))]
+
+
+class FakeScanner:
+    def __init__(self, backend, detection_callback):
+        self._backend = backend
+        self._callback = detection_callback
+        self._task = None
+
+    async def _advertise(self):
+        sensors = self._backend.sensors
+        while True:
+            for sensor in sensors.values():
+                self._callback(FakeDevice(sensor.address, sensor.name),
+                               FakeAdvertisement(sensor.name, {gateway.BTHOME_UUID: sensor.service_data}))
+            await asyncio.sleep(self._backend.adv_interval_s)
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class FakeClient:
+    def __init__(self, backend, address, disconnected_callback, services=None):
+        self._backend = backend
+        self.address = address
+        self._sensor = backend.sensors[address]
+        self._disconnected = disconnected_callback
+        self._filter = services
+        self.discovered = 0
+        self._callbacks = {}
+        self._task = None
+        self.is_connected = False
+        self.services = None
+
+    async def connect(self):
+        sensor = self._sensor
+        await asyncio.sleep(sensor.connect_s)
+        if sensor.client is not None or sensor._rng.random() < sensor.fail:
+            raise OSError("connection failed")
+        table, self.discovered = sensor.discover(self._filter)
+        await asyncio.sleep(sensor.discover_s * self.discovered)
+        sensor.client = self
+        sensor.connects += 1
+        self.is_connected = True
+        self.services = FakeServices(table)
+        self._task = asyncio.ensure_future(self._notifier())
+
+    async def disconnect(self):
+        self._close()
+
+    def _close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._sensor.client is self:
+            self._sensor.client = None
+        self.is_connected = False
+
+    def _check(self):
+        if not self.is_connected:
+            raise OSError("not connected")
+
+    # Desc: Characteristic of a specifier (object, UUID or handle), as bleak resolves it
+    def _char(self, specifier):
+        self._check()
+        if isinstance(specifier, FakeCharacteristic):
+            specifier = specifier.handle
+        char = self.services.get_characteristic(specifier)
+        if char is None:
+            raise OSError("characteristic %s not found" % (specifier,))
+        return char
+
+    async def start_notify(self, char, callback):
+        char = self._char(char)
+        self._callbacks[char.uuid] = (char, callback)
+
+    async def stop_notify(self, char):
+        self._callbacks.pop(self._char(char).uuid, None)
+
+    async def read_gatt_char(self, char):
+        char = self._char(char)
+        await asyncio.sleep(self._sensor.discover_s)
+        if char.uuid == gattcache.DB_HASH_UUID:
+            return bytearray(self._sensor.db_hash)
+        return bytearray(dict(self._sensor.values()).get(char.uuid, b""))
+
+    async def write_gatt_char(self, char, data, response=False):
+        char = self._char(char)
+        if char.uuid == gateway.HISTORY_UUID:
+            if data[0] == 0xFE:
+                self._sensor.clock = struct.unpack_from("<I", data, 1)[0]
+            return
+        self._notify()
+
+    def _notify(self):
+        sensor = self._sensor
+        if sensor.mute:
+            return
+        sensor.update()
+        for uuid, data in sensor.values():
+            entry = self._callbacks.get(uuid)
+            if entry is not None:
+                entry[1](entry[0], bytearray(data))
+                sensor.notifications += 1
+        if sensor.drop and sensor._rng.random() < sensor.drop:
+            self.drop_link()
+
+    # Desc: Loses the link, as when the sensor goes out of range
+    def drop_link(self):
+        self._sensor.drops += 1
+        self._close()
+        self._disconnected(self)
+
+    async def _notifier(self):
+        while True:
+            await asyncio.sleep(self._sensor.notify_s)
+            self._notify()
+
+
+class FakeBackend:
+    # Args: sensors - FakeSensor list, adv_interval_s - Time between advertisements of every sensor
+    def __init__(self, sensors, adv_interval_s=0.5):
+        self.sensors = {sensor.address: sensor for sensor in sensors}
+        self.adv_interval_s = adv_interval_s
+
+    # Desc: Backend with count sensors named pico-<n>, extra arguments go to FakeSensor
+    @classmethod
+    def with_sensors(cls, count, adv_interval_s=0.5, **kwargs):
+        sensors = []
+        for i in range(count):
+            address = "FA:KE:00:00:%02X:%02X" % (i >> 8, i & 0xFF)
+            sensors.append(FakeSensor(address, "pico-%d" % i, seed=i, **kwargs))
+        return cls(sensors, adv_interval_s)
+
+    def scanner(self, detection_callback):
+        return FakeScanner(self, detection_callback)
+
+    def client(self, address, disconnected_callback, services=None):
+        return FakeClient(self, address, disconnected_callback, services)
@@ -0,0 +1,118 @@
+# Stand-in for the MicroPython `machine` module.
+#
+# I2C, UART and ADC are backed by the device models in sim.devices.
+
+from sim.devices import world, ONBOARD_TEMP_ADC
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    # pin id -> level, shared by every Pin object for the same pin like on the board
+    _levels = {}
+
+    def __init__(self, id, mode=-1, *args, **kwargs):
+        self.id = id
+        self.mode = mode
+
+    # Desc: Level of a pin as seen by attached devices; unconfigured pins float high
+    @classmethod
+    def level(cls, id):
+        return cls._levels.get(id, 1)
+
+    def value(self, v=None):
+        if v is None:
+            return Pin._levels.get(self.id, 0)
+        Pin._levels[self.id] = 1 if v else 0
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self.value())
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+
+    def _device(self, addr):
+        try:
+            return world.i2c[addr]
+        except KeyError:
+            raise OSError(19)  # ENODEV, like a missing ACK on the board
+
+    def scan(self):
+        return sorted(world.i2c)
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        return self._device(addr).readfrom_mem(memaddr, nbytes)
+
+    def writeto_mem(self, addr, memaddr, buf):
+        self._device(addr).writeto_mem(memaddr, bytes(buf))
+
+
+class UART:
+    def __init__(self, id, baudrate=9600, bits=8, parity=None, stop=1, tx=None, rx=None, **kwargs):
+        self.id = id
+        self.device = world.pms7003
+        self._rx = bytearray()
+
+    def _pump(self):
+        self._rx.extend(self.device.poll())
+
+    def any(self):
+        self._pump()
+        return len(self._rx)
+
+    def read(self, nbytes=None):
+        self._pump()
+        if not self._rx:
+            return None
+        if nbytes is None:
+            nbytes = len(self._rx)
+        data = bytes(self._rx[:nbytes])
+        del self._rx[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        self._pump()
+        if not self._rx:
+            return None
+        if nbytes is None:
+            nbytes = len(buf)
+        n = min(nbytes, len(buf), len(self._rx))
+        buf[:n] = self._rx[:n]
+        del self._rx[:n]
+        return n
+
+    def write(self, buf):
+        self._pump()
+        self._rx.extend(self.device.command(bytes(buf)))
+        return len(buf)
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        if self.pin == ONBOARD_TEMP_ADC:
+            return world.onboard.read_u16()
+        return 0
+
+
+# The host clock is already set: datetime() only keeps what was written
+class RTC:
+    _datetime = None
+
+    def datetime(self, value=None):
+        if value is None:
+            return RTC._datetime
+        RTC._datetime = tuple(value)
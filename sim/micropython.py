@@ -0,0 +1,21 @@
+# Stand-in for the MicroPython `micropython` module.
+
+
+def const(value):
+    return value
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def schedule(func, arg):
+    func(arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
@@ -0,0 +1,55 @@
+# Runs the unmodified firmware (main.demo) on the host.
+#
+# A simulated central connects as soon as the sensor advertises and prints
+# the notifications it receives.
+#
+# Usage: python -m sim.run [seconds]
+
+import signal
+import struct
+import sys
+import tempfile
+
+import sim
+sim.install()
+
+import bluetooth
+from sim.central import Central
+from sim.devices import world
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    world.pms7003.startup_s = 2
+    world.dht22.noise = 0.5
+    world.bmp280.noise = 200
+
+    import main as firmware
+    # the flash filesystem is a temporary directory
+    flash = tempfile.TemporaryDirectory(prefix="pico-flash-")
+    firmware.FLASH_LOG_DIR = flash.name + "/samples"
+
+    names = {bluetooth.UUID(0x2A6E): "temperature", bluetooth.UUID(0x2A6F): "humidity",
+             bluetooth.UUID(0x2A6D): "pressure", bluetooth.UUID(0x2BD5): "PM1",
+             bluetooth.UUID(0x2BD6): "PM2.5", bluetooth.UUID(0x2BD7): "PM10",
+             bluetooth.UUID(0x2AE2): "heat"}
+
+    def on_notify(value_handle, data):
+        uuid = central.peripheral._uuids.get(value_handle)
+        print("notify %s: %d" % (names.get(uuid, value_handle), struct.unpack("<h", data[:2])[0]))
+
+    central = Central(on_notify=on_notify, wait=True)
+
+    if seconds:
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGALRM, stop)
+        signal.alarm(seconds)
+
+    firmware.demo()
+    print("%d notifications, %d BMP280 conversions, %d PMS7003 frames, %d DHT22 measurements" % (
+        len(central.notifications), world.bmp280.conversions, world.pms7003.frames, world.dht22.measurements))
+
+
+if __name__ == "__main__":
+    main()
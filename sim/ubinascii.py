@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython `ubinascii` module.
+
+from binascii import *
@@ -0,0 +1,3 @@
+# Stand-in for the MicroPython `ustruct` module.
+
+from struct import *
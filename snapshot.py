@@ -0,0 +1,83 @@
+# One packed snapshot of every reading, for the snapshot characteristic.
+#
+# Layout (little-endian, 38 bytes):
+#   timestamp Unix time s (u32), valid flags (u8), heater on (u8),
+#   temperature 0.01 C (i16), humidity 0.01 % (u16), pressure Pa (u32),
+#   pm1, pm25, pm10 ug/m3 (u16), pm1env, pm25env, pm10env ug/m3 (u16),
+#   pbd3, pbd5, pbd10, pbd25, pbd50, pbd100 particles per 0.1 l (u16)
+# A reading is only meaningful if its VALID_* bit is set in the flags.
+# The same module decodes the snapshot on the central side.
+
+import struct
+
+FORMAT = "<IBBhHI12H"
+SIZE = 38
+
+VALID_BMP280 = 0x01
+VALID_DHT22 = 0x02
+VALID_PMS7003 = 0x04
+VALID_HEAT = 0x08
+
+_OFFSET_TIME = 0
+_OFFSET_FLAGS = 4
+_OFFSET_HEAT = 5
+_OFFSET_BMP280 = 6
+_OFFSET_HUMIDITY = 8
+_OFFSET_PRESSURE = 10
+_OFFSET_PMS7003 = 14
+
+PMS_FIELDS = ("pm1", "pm25", "pm10", "pm1env", "pm25env", "pm10env",
+              "pbd3", "pbd5", "pbd10", "pbd25", "pbd50", "pbd100")
+
+
+class Snapshot:
+    def __init__(self):
+        self.buffer = bytearray(SIZE)
+
+    def _valid(self, flag):
+        self.buffer[_OFFSET_FLAGS] |= flag
+
+    def set_time(self, ts):
+        struct.pack_into("<I", self.buffer, _OFFSET_TIME, ts)
+
+    # Args: temperature - 0.01 C, pressure - Pa
+    def set_bmp280(self, temperature, pressure):
+        struct.pack_into("<h", self.buffer, _OFFSET_BMP280, temperature)
+        struct.pack_into("<I", self.buffer, _OFFSET_PRESSURE, pressure)
+        self._valid(VALID_BMP280)
+
+    # Args: humidity - 0.01 %
+    def set_dht22(self, humidity):
+        struct.pack_into("<H", self.buffer, _OFFSET_HUMIDITY, humidity)
+        self._valid(VALID_DHT22)
+
+    # Args: readings - pms7003.PMSReading
+    def set_pms7003(self, readings):
+        offset = _OFFSET_PMS7003
+        for field in PMS_FIELDS:
+            struct.pack_into("<H", self.buffer, offset, readings[field])
+            offset += 2
+        self._valid(VALID_PMS7003)
+
+    def set_heat(self, on):
+        self.buffer[_OFFSET_HEAT] = 1 if on else 0
+        self._valid(VALID_HEAT)
+
+
+# Desc: Decodes a snapshot read or notified from the characteristic
+# Returns: Dict of the valid readings (temperature C, humidity %, pressure Pa, PMS fields, heat) and timestamp
+def decode(data):
+    fields = struct.unpack_from(FORMAT, data, 0)
+    ts, flags, heat, temperature, humidity, pressure = fields[:6]
+    snapshot = {"timestamp": ts}
+    if flags & VALID_BMP280:
+        snapshot["temperature"] = temperature / 100
+        snapshot["pressure"] = pressure
+    if flags & VALID_DHT22:
+        snapshot["humidity"] = humidity / 100
+    if flags & VALID_PMS7003:
+        for field, value in zip(PMS_FIELDS, fields[6:]):
+            snapshot[field] = value
+    if flags & VALID_HEAT:
+        snapshot["heat"] = bool(heat)
+    return snapshot
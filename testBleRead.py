@@ -1,14 +1,31 @@
 import asyncio
+import sys
 from bleak import BleakScanner, BleakClient
 from bleak.exc import BleakError
 import struct
 import time
+import snapshot
+import bthome
+import notifydecode
+from gattcache import GattCache
 # Use this terminal command if bleak is stuck on install
 # export SKIP_CYTHON=false
+# Reads one sensor; gateway.py reads many at once
 
 # _DEVICE_SEARCH_NAME = "pico"
 _DEVICE_SEARCH_NAME = "28:CD:C1:0D:5C:C0"
 
+# Vendor characteristic with every reading in one struct (see snapshot.py)
+_SNAPSHOT_CHAR_UUID = "7a1c0021-3d4b-4c8e-9f21-5e6d7c8b9a01"
+
+# History characteristic: request 0xFE followed by the Unix time (u32) sets the sensor clock,
+# which restarts from 2021 on every reset (the sensor only logs to flash once it is set)
+_HISTORY_CHAR_UUID = "7a1c0011-3d4b-4c8e-9f21-5e6d7c8b9a01"
+_SET_TIME = 0xFE
+
+# Handles found on the first connection, reconnects skip the lookup and printing (see gattcache.py)
+_GATT_CACHE = GattCache("gatt_cache.json")
+
 # Scans nearby bluetooth BLE devices for name that matches input 
 async def searchBLEDeviceName(name = _DEVICE_SEARCH_NAME):
     foundDevices = []
@@ -27,6 +44,34 @@ async def searchBLEDeviceName(name = _DEVICE_SEARCH_NAME):
 
     return foundDevices
 
+# Scan-only reader: prints the readings the sensor broadcasts in its advertisements (BTHome
+# service data), without ever connecting, so any number of readers can watch one sensor
+_BTHOME_UUID = "0000fcd2-0000-1000-8000-00805f9b34fb"
+
+async def scanBroadcasts(name = _DEVICE_SEARCH_NAME):
+    lastPacket = {}
+
+    def detection(device, adv):
+        data = adv.service_data.get(_BTHOME_UUID)
+        if data is None:
+            return
+        if name.lower() not in device.address.lower() and name.lower() not in str(adv.local_name).lower():
+            return
+        readings = bthome.decode(data)
+        # the same advertisement is received many times until the readings change
+        if lastPacket.get(device.address) == readings.get("packet_id"):
+            return
+        lastPacket[device.address] = readings.get("packet_id")
+        print("Broadcast from %s: %s" % (device.address, readings))
+
+    scanner = BleakScanner(detection_callback=detection)
+    await scanner.start()
+    try:
+        while True:
+            await asyncio.sleep(1)
+    finally:
+        await scanner.stop()
+
 # Retry connecting to device if disconnected
 def clientDisconnectHandler(client):
     global _BLE_CLIENT
@@ -38,6 +83,14 @@ async def setBLEClient():
     _BLE_CLIENT = BleakClient(address_or_ble_device = foundDevices[0], disconnected_callback = clientDisconnectHandler)
     await _BLE_CLIENT.connect()
     print("Connected to: ", foundDevices[0].name)
+    await setSensorClock(_BLE_CLIENT)
+
+# Sets the sensor clock to this computer's time
+async def setSensorClock(client):
+    characteristic = client.services.get_characteristic(_HISTORY_CHAR_UUID)
+    if characteristic is None:
+        return
+    await client.write_gatt_char(characteristic, struct.pack("<BI", _SET_TIME, int(time.time())), response=True)
 
 # Print description and its value
 async def printDescriptorDetails(descriptor):
@@ -69,15 +122,29 @@ async def printServiceDetails(service):
 async def runBluetoothService():
 
     def characteristicUpdate(characteristic, data):
-        updatedVal = float(struct.unpack("<h", data)[0])
-        updatedVal = updatedVal/100
+        updatedVal = notifydecode.decode_one(characteristic.uuid, data)
         print("Update characteristic:", characteristic, " val:", updatedVal)
         # print(temp_characteristic.properties)
 
+    def snapshotUpdate(characteristic, data):
+        print("Snapshot:", snapshot.decode(data))
+
     async def connectBluetoothSensor():
         await setBLEClient()
-        global _BLE_CLIENT, tasks
-        
+        global _BLE_CLIENT, tasks, snapshot_characteristic
+
+        # One subscription and one refresh write per cycle if the sensor has the snapshot characteristic
+        address = _BLE_CLIENT.address
+        if address in _GATT_CACHE:
+            handles = await _GATT_CACHE.resolve(_BLE_CLIENT, address, [_SNAPSHOT_CHAR_UUID])
+            if handles is None:
+                # firmware changed, look it up again in the services of this connection
+                handles = await _GATT_CACHE.resolve(_BLE_CLIENT, address, [_SNAPSHOT_CHAR_UUID])
+            snapshot_characteristic = handles.get(_SNAPSHOT_CHAR_UUID)
+            if snapshot_characteristic is not None:
+                await _BLE_CLIENT.start_notify(snapshot_characteristic, snapshotUpdate)
+                return
+
         print("Descriptors: ")
         if len(_BLE_CLIENT.services.descriptors) == 0:
             print("None")
@@ -93,6 +160,12 @@ async def runBluetoothService():
             await printServiceDetails(service)
 
         
+        handles = await _GATT_CACHE.resolve(_BLE_CLIENT, address, [_SNAPSHOT_CHAR_UUID])
+        snapshot_characteristic = handles.get(_SNAPSHOT_CHAR_UUID)
+        if snapshot_characteristic is not None:
+            await _BLE_CLIENT.start_notify(snapshot_characteristic, snapshotUpdate)
+            return
+
         for serviceNumber in _BLE_CLIENT.services.services:
             global env_service
             service = _BLE_CLIENT.services.get_service(serviceNumber)
@@ -136,6 +209,9 @@ async def runBluetoothService():
         sendData = struct.pack("<h", int(0))
         try:
             print("Is connected: ", _BLE_CLIENT.is_connected)
+            if snapshot_characteristic is not None:
+                await _BLE_CLIENT.write_gatt_char(char_specifier=snapshot_characteristic, data=sendData)
+                continue
             await _BLE_CLIENT.write_gatt_char(char_specifier=temp_characteristic, data=sendData)
             await _BLE_CLIENT.write_gatt_char(char_specifier=humidity_characteristic, data=sendData)
             await _BLE_CLIENT.write_gatt_char(char_specifier=pressure_characteristic, data=sendData)
@@ -148,7 +224,10 @@ async def runBluetoothService():
         # temp = float(struct.unpack("<h", temperature)[0])
         # print("Temperature: ", temp, "C")
     
-    await _BLE_CLIENT.stop_notify(temp_characteristic.uuid)
+    if snapshot_characteristic is not None:
+        await _BLE_CLIENT.stop_notify(snapshot_characteristic)
+    else:
+        await _BLE_CLIENT.stop_notify(temp_characteristic.uuid)
     await _BLE_CLIENT.disconnect()
 
 
@@ -189,4 +268,9 @@ async def main():
     # foundDevices = asyncio.run(searchBLEDeviceName("pico"))
     # print("Found devices: ", foundDevices)
 if __name__ == "__main__":
-    asyncio.run(main())
+    # python testBleRead.py --scan [name or address] reads the broadcasts only
+    if "--scan" in sys.argv:
+        args = [a for a in sys.argv[1:] if a != "--scan"]
+        asyncio.run(scanBroadcasts(*args))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,328 @@
+# Columnar time-series store for the readings received by the gateway.
+#
+# Every (device address, metric) series is a directory of day segments.
+# A segment is two column files, <day>.t with the timestamps (u32, s) and
+# <day>.v with the values (i16), in native byte order (little-endian on the
+# hosts the gateway runs on). The day number is ts // 86400, so the time
+# index of a series is its sorted list of segment days and a range query
+# opens only the days it covers, then bisects the timestamp column.
+# Timestamps only go forward within a series (an earlier one is stored as
+# the last one), like flashlog.py on the sensor.
+#
+# append() only adds to RAM columns. flush() (automatic every batch
+# readings) appends each series' batch with one write per column file and
+# then fsyncs the files it wrote, so the disk sees few large writes instead
+# of one per reading. A crash during a flush can leave the two column files
+# of a day with different or partial lengths: opening a series cuts them
+# back to the last reading both hold whole before anything is appended.
+#
+# aggregate() returns min/max/sum/mean/count per window (e.g. 60 or 3600 s)
+# over whole segment columns: with NumPy one reduceat per column, without
+# it one bisect and C-level min()/max()/sum() per window. A day segment is
+# sealed once its series has a later day; the windows of sealed days are
+# kept as rollup files (<day>.<window>.r), written by the flush that seals
+# the day for the windows in rollups and on the first query for any other
+# window, so a month of hourly aggregates reads 30 small files per series.
+#
+#   store = TimeSeriesStore("readings")
+#   store.append("28:CD:C1:0D:5C:C0", "temperature", int(time.time()), 2345)
+#   store.flush()
+#   hourly = store.aggregate("28:CD:C1:0D:5C:C0", "temperature", start, end, 3600)
+
+import os
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY_S = 86400
+# rollup record columns
+_ROLLUP = (("time", "I"), ("min", "h"), ("max", "h"), ("sum", "q"), ("count", "I"))
+
+
+def _itemsize(code):
+    return array(code).itemsize
+
+
+class _Series:
+    def __init__(self, path):
+        self.path = path
+        self.ts = array("I")
+        self.values = array("h")
+        self.last = 0
+        days = []
+        try:
+            for name in os.listdir(path):
+                if name.endswith(".t") and name[:-2].isdigit():
+                    days.append(int(name[:-2]))
+        except OSError:
+            pass
+        days.sort()
+        self.days = days
+        for day in days:
+            self.repair(day)
+        if days:
+            last = array("I")
+            try:
+                with open(self.file(days[-1], "t"), "rb") as f:
+                    f.seek(-last.itemsize, 2)
+                    last.frombytes(f.read())
+                self.last = last[0]
+            except (OSError, ValueError):
+                pass
+
+    def file(self, day, column):
+        return "%s/%d.%s" % (self.path, day, column)
+
+    # Desc: Cuts both column files of a day to the readings they both hold whole, so the next
+    #       flush appends after the last complete reading (a crash can stop between or inside
+    #       the two column writes)
+    def repair(self, day):
+        sizes = []
+        for column, code in (("t", "I"), ("v", "h")):
+            try:
+                sizes.append((self.file(day, column), os.stat(self.file(day, column)).st_size, _itemsize(code)))
+            except OSError:
+                sizes.append((self.file(day, column), 0, _itemsize(code)))
+        n = min(size // itemsize for name, size, itemsize in sizes)
+        for name, size, itemsize in sizes:
+            if size > n * itemsize:
+                with open(name, "r+b") as f:
+                    f.truncate(n * itemsize)
+
+    # Returns: (timestamps, values) on disk for a day
+    def read(self, day):
+        ts = array("I")
+        values = array("h")
+        try:
+            for column, data in (("t", ts), ("v", values)):
+                with open(self.file(day, column), "rb") as f:
+                    raw = f.read()
+                data.frombytes(raw[:len(raw) - len(raw) % data.itemsize])
+        except OSError:
+            pass
+        n = min(len(ts), len(values))
+        del ts[n:]
+        del values[n:]
+        return ts, values
+
+
+class TimeSeriesStore:
+    # Args: root - Directory of the store, batch - Readings kept in RAM before a flush,
+    #       sync - fsync the written files on every flush, cache_segments - Day segments kept in RAM for queries,
+    #       rollups - Aggregate windows (s) whose rollup files are written as soon as a day is sealed
+    def __init__(self, root, batch=8192, sync=True, cache_segments=256, rollups=(300, 3600)):
+        self.root = root
+        self.batch = batch
+        self.sync = sync
+        self.rollups = rollups
+        self._series = {}
+        self._batched = 0
+        # (series path, day) -> (timestamps, values), least recently used first
+        self._cache = OrderedDict()
+        self._cacheSize = cache_segments
+        self.writes = 0
+        self.flushes = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, address, metric):
+        return "%s/%s/%s" % (self.root, address.replace(":", ""), metric)
+
+    def _get(self, address, metric, create=False):
+        key = (address, metric)
+        series = self._series.get(key)
+        if series is None:
+            path = self._path(address, metric)
+            if not create and not os.path.isdir(path):
+                return None
+            series = self._series[key] = _Series(path)
+        return series
+
+    # Returns: List of (address without colons, metric) of every series on disk
+    def series(self):
+        result = []
+        for device in sorted(os.listdir(self.root)):
+            for metric in sorted(os.listdir("%s/%s" % (self.root, device))):
+                result.append((device, metric))
+        return result
+
+    def append(self, address, metric, ts, value):
+        series = self._get(address, metric, True)
+        if ts < series.last:
+            ts = series.last
+        series.last = ts
+        series.ts.append(ts)
+        series.values.append(value)
+        self._batched += 1
+        if self._batched >= self.batch:
+            self.flush()
+
+    # Desc: Appends the RAM columns of every series to their segment files, then writes the
+    #       rollups of the days this sealed
+    def flush(self):
+        for series in self._series.values():
+            if not series.ts:
+                continue
+            os.makedirs(series.path, exist_ok=True)
+            # the last day on disk and the days written now, sealed if the series has a later day
+            days = series.days[-1:]
+            ts = series.ts
+            values = series.values
+            i = 0
+            while i < len(ts):
+                day = ts[i] // DAY_S
+                j = bisect_left(ts, (day + 1) * DAY_S, i)
+                for column, data in (("t", ts[i:j]), ("v", values[i:j])):
+                    name = series.file(day, column)
+                    with open(name, "ab") as f:
+                        f.write(data.tobytes())
+                        if self.sync:
+                            f.flush()
+                            os.fsync(f.fileno())
+                    self.writes += 1
+                if not series.days or series.days[-1] != day:
+                    series.days.append(day)
+                    days.append(day)
+                self._cache.pop((series.path, day), None)
+                i = j
+            series.ts = array("I")
+            series.values = array("h")
+            lastDay = series.last // DAY_S
+            for day in days:
+                if day < lastDay:
+                    for window_s in self.rollups:
+                        self._rollup(series, day, window_s)
+        self._batched = 0
+        self.flushes += 1
+
+    # Returns: (timestamps, values) of a day, from disk plus the RAM columns
+    def _segment(self, series, day):
+        key = (series.path, day)
+        segment = self._cache.get(key)
+        if segment is None:
+            segment = series.read(day)
+            self._cache[key] = segment
+            if len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        if series.ts and series.ts[-1] // DAY_S >= day:
+            i = bisect_left(series.ts, day * DAY_S)
+            j = bisect_left(series.ts, (day + 1) * DAY_S)
+            if i < j:
+                return segment[0] + series.ts[i:j], segment[1] + series.values[i:j]
+        return segment
+
+    def _days(self, series, start, end):
+        days = list(series.days)
+        if series.ts:
+            for day in range(series.ts[0] // DAY_S, series.ts[-1] // DAY_S + 1):
+                if day not in days:
+                    days.append(day)
+        days.sort()
+        return [day for day in days if start // DAY_S <= day <= (end - 1) // DAY_S]
+
+    # Desc: Readings with start <= timestamp < end
+    # Returns: (timestamps array("I"), values array("h"))
+    def query(self, address, metric, start, end):
+        ts = array("I")
+        values = array("h")
+        series = self._get(address, metric)
+        if series is None:
+            return ts, values
+        for day in self._days(series, start, end):
+            dayTs, dayValues = self._segment(series, day)
+            i = bisect_left(dayTs, start)
+            j = bisect_left(dayTs, end)
+            ts += dayTs[i:j]
+            values += dayValues[i:j]
+        return ts, values
+
+    # Desc: min/max/mean/count per window of window_s seconds with start <= timestamp < end,
+    #       start and end are rounded out to whole windows; windows without readings are left out
+    # Args: window_s - Window length, a divisor of a day (60, 300, 3600...)
+    # Returns: Dict of columns "time" (window start), "min", "max", "sum" (of the values, to merge
+    #          windows exactly), "mean", "count"
+    def aggregate(self, address, metric, start, end, window_s):
+        if DAY_S % window_s:
+            raise ValueError("window must divide a day")
+        start -= start % window_s
+        end += -end % window_s
+        result = {name: array(code) for name, code in _ROLLUP}
+        series = self._get(address, metric)
+        if series is not None:
+            # readings only go forward: a day before the last one with none left in RAM never changes
+            lastDay = series.last // DAY_S
+            for day in self._days(series, start, end):
+                if day < lastDay and (not series.ts or series.ts[0] // DAY_S > day):
+                    rollup = self._rollup(series, day, window_s)
+                else:
+                    ts, values = self._segment(series, day)
+                    rollup = _windows(ts, values, window_s)
+                i = bisect_left(rollup["time"], start)
+                j = bisect_left(rollup["time"], end)
+                for name, code in _ROLLUP:
+                    result[name] += rollup[name][i:j]
+        result["mean"] = array("d", [s / c for s, c in zip(result["sum"], result["count"])])
+        return result
+
+    # Returns: Window columns of a sealed day, from its rollup file or computed and saved
+    def _rollup(self, series, day, window_s):
+        name = "%s/%d.%d.r" % (series.path, day, window_s)
+        rollup = {}
+        try:
+            with open(name, "rb") as f:
+                data = f.read()
+            count = len(data) // sum(_itemsize(code) for n, code in _ROLLUP)
+            pos = 0
+            for column, code in _ROLLUP:
+                size = count * _itemsize(code)
+                rollup[column] = array(code, data[pos:pos + size])
+                pos += size
+            return rollup
+        except OSError:
+            pass
+        ts, values = self._segment(series, day)
+        rollup = _windows(ts, values, window_s)
+        tmp = name + ".tmp"
+        with open(tmp, "wb") as f:
+            for column, code in _ROLLUP:
+                f.write(rollup[column].tobytes())
+        os.replace(tmp, name)
+        return rollup
+
+
+# Returns: Columns "time", "min", "max", "sum", "count" of the windows of sorted readings
+def _windows(ts, values, window_s):
+    result = {name: array(code) for name, code in _ROLLUP}
+    n = len(ts)
+    if not n:
+        return result
+    if numpy is not None:
+        t = numpy.frombuffer(ts, dtype=numpy.uint32)
+        v = numpy.frombuffer(values, dtype=numpy.int16)
+        windows = t // window_s
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(windows)) + 1))
+        counts = numpy.diff(numpy.append(starts, n))
+        result["time"] = array("I", (windows[starts] * window_s).astype(numpy.uint32).tobytes())
+        result["min"] = array("h", numpy.minimum.reduceat(v, starts).tobytes())
+        result["max"] = array("h", numpy.maximum.reduceat(v, starts).tobytes())
+        result["sum"] = array("q", numpy.add.reduceat(v.astype(numpy.int64), starts).tobytes())
+        result["count"] = array("I", counts.astype(numpy.uint32).tobytes())
+        return result
+    i = 0
+    while i < n:
+        windowStart = ts[i] - ts[i] % window_s
+        j = bisect_left(ts, windowStart + window_s, i)
+        chunk = values[i:j]
+        result["time"].append(windowStart)
+        result["min"].append(min(chunk))
+        result["max"].append(max(chunk))
+        result["sum"].append(sum(chunk))
+        result["count"].append(j - i)
+        i = j
+    return result